@@ -1,9 +1,6 @@
-import subprocess
-from pathlib import Path
-import pkg_resources
-
 def get_git_version():
     """Retrieve the current Git tag version."""
+    import subprocess
     try:
         return subprocess.check_output(["git", "describe", "--tags"]).strip().decode("utf-8")
     except subprocess.CalledProcessError:
@@ -12,12 +9,20 @@ def get_git_version():
 
 def get_version():
     """Determine the version from either Git, a file, or package metadata."""
+    from pathlib import Path
     # Check if installed in editable mode by checking for .git folder
     if (Path(__file__).parent / ".git").exists():
         git_version = get_git_version()
         if git_version:
             return git_version
 
-    return pkg_resources.get_distribution("deputy").version
+    from importlib.metadata import version
+    return version("deputy")
 
-__version__ = get_version()
\ No newline at end of file
+def __getattr__(name):
+    # Resolving the version is slow (git subprocess, package metadata), so it's only done on
+    # first access of deputy.__version__ instead of on every import
+    if name == "__version__":
+        globals()["__version__"] = get_version()
+        return globals()["__version__"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,7 +1,7 @@
 import sys
 import traceback
 
-from magnum.cli import cli
+from deputy.magnum.cli import cli
 
 
 def main(argv=None):
@@ -11,6 +11,12 @@ def main(argv=None):
         argv = sys.argv
 
     try:
+        if len(argv) > 1 and argv[1] == "daemon":
+            from deputy.daemon.cli import cli as daemon_cli
+            return daemon_cli(argv[2:])
+        if len(argv) > 1 and argv[1] == "doctor":
+            from deputy.doctor import cli as doctor_cli
+            return doctor_cli(argv[2:])
         return cli(argv[1:])
     except KeyboardInterrupt:
         print("Aborted by user")
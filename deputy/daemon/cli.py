@@ -0,0 +1,43 @@
+import argparse
+
+from deputy.daemon.client import DaemonClient
+from deputy.daemon.protocol import daemon_supported
+
+
+def cli(argv):
+    parser = argparse.ArgumentParser(prog="deputy daemon",
+                                     description="Keep all Magnum probes open and serve them to the "
+                                                 "magnum CLI over a local socket.")
+    parser.add_argument("action", nargs="?", default="run", choices=["run", "status", "rescan", "stop"],
+                        help="run the daemon in the foreground (default), show its status, "
+                             "rescan for probes, or stop it")
+    parser.add_argument("--socket", help="Socket path (default: $XDG_RUNTIME_DIR/deputy.sock)")
+    args = parser.parse_args(argv)
+
+    if not daemon_supported():
+        print("ERROR: The deputy daemon needs Unix domain socket support")
+        return 1
+
+    if args.action == "run":
+        from deputy.daemon.server import run_daemon
+        run_daemon(args.socket)
+        return
+
+    client = DaemonClient.connect(args.socket)
+    if client is None:
+        print("deputy daemon is not running")
+        return 1
+    try:
+        if args.action == "status":
+            status = client.request("ping")
+            print(f"deputy daemon running (PID {status['pid']}) on {client.path}")
+            for serial in status["probes"]:
+                print(f"  {serial}")
+        elif args.action == "rescan":
+            for serial in client.request("rescan"):
+                print(serial)
+        elif args.action == "stop":
+            client.request("shutdown")
+            print("deputy daemon stopping")
+    finally:
+        client.close()
@@ -0,0 +1,297 @@
+import os
+import socket
+import threading
+
+from deputy.daemon.protocol import (FRAME_BATCH, FRAME_JSON, DaemonProtocolException, daemon_supported,
+                                    default_socket_path, encode_json, recv_frame, socket_peer_uid)
+from deputy.magnum.defs import MagnumProbeInfo, MagnumTelemetry
+from deputy.magnum.stream import MagnumSampleBatch
+
+
+class DaemonException(Exception):
+    """An error reported by the daemon, i.e. 'No Magnum device found!'"""
+    pass
+
+
+class DaemonClient:
+    """Connection to a running deputy daemon. Requests from multiple threads are serialized"""
+
+    def __init__(self, path: str = None, timeout: float = 10.0):
+        self.path = path or default_socket_path()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(self.path)
+            # Anyone can create the socket if it's in the temp directory. Only talk to a
+            # daemon of our own (or root's)
+            peer_uid = socket_peer_uid(self.sock, self.path)
+            if peer_uid not in (os.getuid(), 0):
+                raise PermissionError(f"{self.path} belongs to another user (uid {peer_uid}), not using it")
+        except OSError:
+            self.sock.close()
+            raise
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    @classmethod
+    def connect(cls, path: str = None):
+        """Returns a DaemonClient, or None if no daemon is running (or DEPUTY_NO_DAEMON is set)"""
+        if not daemon_supported() or os.environ.get("DEPUTY_NO_DAEMON"):
+            return None
+        path = path or default_socket_path()
+        if not os.path.exists(path):
+            return None
+        try:
+            return cls(path)
+        except PermissionError as e:
+            print(f"WARNING: Ignoring the deputy daemon socket: {e}")
+            return None
+        except OSError:
+            return None
+
+    def request(self, cmd: str, **args):
+        """Sends a request and returns the result. Raises DaemonException if the daemon reports an error"""
+        with self._lock:
+            message = dict(args, id=self._next_id, cmd=cmd)
+            self._next_id += 1
+            self.sock.sendall(encode_json(message))
+            frame = recv_frame(self.sock)
+        if frame is None:
+            raise DaemonProtocolException("Connection to the deputy daemon closed")
+        kind, response = frame
+        if kind != FRAME_JSON or response.get("id") != message["id"]:
+            raise DaemonProtocolException("Unexpected response from the deputy daemon")
+        if not response.get("ok"):
+            raise DaemonException(response.get("error"))
+        return response.get("result")
+
+    def close(self):
+        self.sock.close()
+
+
+class RemoteStream:
+    """
+    MagnumStream counterpart for a probe held by the daemon. The daemon does the sampling
+    (with the same scheduling as MagnumStream) and sends the batches over a dedicated
+    connection, which is opened with the first read.
+    """
+
+    def __init__(self, path, serial, rate_hz: float, batch_size: int = None, duration: float = None,
+                 start_ns: int = None, presence: bool = False):
+        if rate_hz <= 0:
+            raise ValueError(f"Invalid sample rate {rate_hz}")
+        self.path = path
+        self.serial = serial
+        self.rate_hz = rate_hz
+        self.batch_size = batch_size
+        self.duration = duration
+        self.start_ns = start_ns
+        self.presence = presence
+        self.samples = 0
+        self.missed = 0
+        self.overruns = 0
+        self._client = None
+        self._stopped = False
+        self._ended = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> MagnumSampleBatch:
+        batch = self.read_batch()
+        if len(batch) == 0:
+            raise StopIteration
+        return batch
+
+    def _start(self):
+        client = DaemonClient(self.path, timeout=None)
+        self.start_ns = client.request("stream", serial=self.serial, rate_hz=self.rate_hz,
+                                       batch_size=self.batch_size, duration=self.duration,
+                                       start_ns=self.start_ns, presence=self.presence)["start_ns"]
+        # Only now can stop() send to the connection without getting in the way of the request
+        self._client = client
+        if self._stopped:
+            self._send_stop()
+
+    def _send_stop(self):
+        try:
+            self._client.sock.sendall(encode_json({"cmd": "stop"}))
+        except OSError:
+            pass
+
+    def stop(self):
+        """Ends the stream after the batch in progress. Safe to call from another thread."""
+        self._stopped = True
+        if self._client is not None:
+            self._send_stop()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped or self._ended
+
+    def read_batch(self) -> MagnumSampleBatch:
+        if self._ended or (self._stopped and self._client is None):
+            return MagnumSampleBatch()
+        if self._client is None:
+            self._start()
+
+        frame = recv_frame(self._client.sock)
+        if frame is not None and frame[0] == FRAME_BATCH:
+            batch = frame[1]
+            self.samples += len(batch)
+            self.missed += batch.missed
+            self.overruns += batch.overruns
+            return batch
+
+        # The stream has ended. The last frame holds the daemon's totals (or its error)
+        self._ended = True
+        self._client.close()
+        if frame is None:
+            raise DaemonProtocolException("Connection to the deputy daemon closed")
+        response = frame[1]
+        if not response.get("ok"):
+            raise DaemonException(response.get("error"))
+        return MagnumSampleBatch()
+
+
+class RemoteMagnumProbe:
+    """
+    Stand-in for MagnumProbe that forwards every call to the probe held by the deputy
+    daemon. Has the same methods as MagnumProbe, except for raw access to the device.
+    """
+
+    def __init__(self, client: DaemonClient, serial: str = None):
+        self.client = client
+        self._info = self.client.request("info", serial=serial)
+        self.serial = self._info["serial"]
+
+    def _request(self, cmd, **args):
+        return self.client.request(cmd, serial=self.serial, **args)
+
+    def get_info(self):
+        info = self._request("info")
+        return MagnumProbeInfo(info["serial"], info["usb_path"], info["hw_id"], info["hw_rev"],
+                               info["fw_rev"], None)
+
+    def close(self):
+        self.client.close()
+
+    def get_target_serial_port(self):
+        return self._request("serial_port")
+
+    def get_telemetry(self):
+        return MagnumTelemetry(*self._request("telemetry"))
+
+    def get_power_state(self) -> bool:
+        return self.get_telemetry().power_state
+
+    def get_power_ctrl(self):
+        return self.get_telemetry().power_ctrl
+
+    def set_power_ctrl(self, power_ctrl):
+        self._request("set_power_ctrl", power_ctrl=int(power_ctrl))
+
+    def get_target_voltage(self) -> int:
+        return self.get_target_voltage_current()[0]
+
+    def get_target_current(self) -> int:
+        return self.get_target_voltage_current()[1]
+
+    def get_target_presence(self):
+        return self.get_telemetry().presence
+
+    def get_target_reference(self) -> int:
+        return self.get_telemetry().vref_mv
+
+    def get_target_voltage_current(self):
+        return tuple(self._request("voltage_current"))
+
+    def stream(self, rate_hz: float, batch_size: int = None, duration: float = None,
+               start_ns: int = None, presence: bool = False) -> RemoteStream:
+        return RemoteStream(self.client.path, self.serial, rate_hz, batch_size, duration, start_ns, presence)
+
+    def get_fusb303_regs(self):
+        return bytes(self._request("fusb303_regs"))
+
+    def set_fusb303_reg(self, reg_addr: int, reg_data: int):
+        self._request("set_fusb303_reg", reg=reg_addr, data=reg_data)
+
+
+def open_probe(serial: str = None):
+    """
+    Returns a probe to talk to: a RemoteMagnumProbe if the deputy daemon is running,
+    otherwise a MagnumProbe opened directly.
+    """
+    client = DaemonClient.connect()
+    if client is not None:
+        try:
+            return RemoteMagnumProbe(client, serial)
+        except DaemonException as e:
+            client.close()
+            raise Exception(str(e))
+    from deputy.magnum.magnum import MagnumProbe
+    return MagnumProbe(serial)
+
+
+def open_all_probes() -> list:
+    """Returns all probes held by the deputy daemon, or None if it isn't running"""
+    client = DaemonClient.connect()
+    if client is None:
+        return None
+    return [RemoteMagnumProbe(client, serial) for serial in client.request("rescan")]
+
+
+def list_probes() -> list:
+    """Like MagnumProbe.enumerate(), but asks the deputy daemon if it is running"""
+    from deputy.magnum.magnum import MagnumProbe
+    client = DaemonClient.connect()
+    if client is None:
+        return MagnumProbe.enumerate()
+    try:
+        return [MagnumProbeInfo(info["serial"], info["usb_path"], info["hw_id"], info["hw_rev"],
+                                info["fw_rev"], None) for info in client.request("list")]
+    finally:
+        client.close()
+
+
+def release_probe(serial: str = None):
+    """
+    Makes the deputy daemon (if running) close a probe, so it can be opened directly. The
+    daemon leaves it alone until acquire_probe(). Returns the serial of the released probe,
+    or None if the daemon didn't have it
+    """
+    client = DaemonClient.connect()
+    if client is None:
+        return None
+    try:
+        return client.request("release", serial=serial)
+    except DaemonException:
+        return None
+    finally:
+        client.close()
+
+
+def release_all_probes() -> list:
+    """Makes the deputy daemon (if running) close all its probes. Returns their serials"""
+    client = DaemonClient.connect()
+    if client is None:
+        return []
+    try:
+        return client.request("release_all")
+    except DaemonException:
+        return []
+    finally:
+        client.close()
+
+
+def acquire_probe(serial: str = None):
+    """Lets the deputy daemon (if running) open a released probe again (all of them if None)"""
+    client = DaemonClient.connect()
+    if client is None:
+        return
+    try:
+        client.request("acquire", serial=serial)
+    except DaemonException:
+        pass
+    finally:
+        client.close()
@@ -0,0 +1,125 @@
+"""
+Wire protocol between the deputy daemon and its clients.
+
+Every message is a frame: a 5 byte header (payload length as uint32, frame kind as uint8)
+followed by the payload. Requests and responses are compact JSON objects:
+
+  request:   {"id": 1, "cmd": "telemetry", "serial": "ABC123", ...}
+  response:  {"id": 1, "ok": true, "result": ...} or {"id": 1, "ok": false, "error": "..."}
+
+Sample batches of a stream subscription are sent as binary BATCH frames (see
+pack_batch()), so streaming doesn't pay for JSON encoding of every sample. A subscription
+ends with a regular JSON response carrying the stream's totals.
+"""
+
+import json
+import os
+import socket
+import struct
+
+from deputy.magnum.stream import MagnumSampleBatch
+
+FRAME_HEADER = struct.Struct("<IB")
+FRAME_JSON = 1
+FRAME_BATCH = 2
+
+# Sample count, missed, overruns. Followed by the ticks, timestamps, voltage and current arrays
+BATCH_HEADER = struct.Struct("<III")
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class DaemonProtocolException(Exception):
+    pass
+
+
+def default_socket_path() -> str:
+    """Returns $DEPUTY_SOCKET, or deputy.sock in $XDG_RUNTIME_DIR (or the temp directory)"""
+    path = os.environ.get("DEPUTY_SOCKET")
+    if path:
+        return path
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "deputy.sock")
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), f"deputy-{os.getuid()}.sock")
+
+
+def socket_peer_uid(sock, path: str) -> int:
+    """
+    Returns the uid of the process at the other end of the connected Unix socket (or, where
+    the OS can't tell, of the owner of the socket file)
+    """
+    if hasattr(socket, "SO_PEERCRED"):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        return struct.unpack("3i", creds)[1]
+    return os.stat(path).st_uid
+
+
+def daemon_supported() -> bool:
+    return hasattr(socket, "AF_UNIX")
+
+
+def encode_json(message: dict) -> bytes:
+    payload = json.dumps(message, separators=(",", ":")).encode()
+    return FRAME_HEADER.pack(len(payload), FRAME_JSON) + payload
+
+
+def pack_batch(batch: MagnumSampleBatch) -> bytes:
+    # The target presence, if the stream reads it, is one byte after the samples
+    presence = b"" if batch.presence is None else bytes((batch.presence,))
+    payload = b"".join((BATCH_HEADER.pack(len(batch), batch.missed, batch.overruns),
+                        batch.ticks.tobytes(), batch.timestamps.tobytes(),
+                        batch.voltage.tobytes(), batch.current.tobytes(), presence))
+    return FRAME_HEADER.pack(len(payload), FRAME_BATCH) + payload
+
+
+def unpack_batch(payload: bytes) -> MagnumSampleBatch:
+    count, missed, overruns = BATCH_HEADER.unpack_from(payload)
+    batch = MagnumSampleBatch()
+    batch.missed = missed
+    batch.overruns = overruns
+    pos = BATCH_HEADER.size
+    for values in (batch.ticks, batch.timestamps, batch.voltage, batch.current):
+        size = count * values.itemsize
+        values.frombytes(payload[pos:pos + size])
+        pos += size
+    if pos + 1 == len(payload):
+        batch.presence = payload[pos]
+        pos += 1
+    if pos != len(payload):
+        raise DaemonProtocolException("Malformed sample batch")
+    return batch
+
+
+def _recv_exactly(sock, size: int):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        n = sock.recv_into(view[pos:])
+        if n == 0:
+            return None
+        pos += n
+    return buf
+
+
+def recv_frame(sock):
+    """
+    Receives one frame. Returns (kind, payload), with JSON payloads already decoded, or
+    None if the peer closed the connection.
+    """
+    header = _recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    size, kind = FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise DaemonProtocolException(f"Frame too large ({size} bytes)")
+    payload = _recv_exactly(sock, size) if size else bytearray()
+    if payload is None:
+        raise DaemonProtocolException("Connection closed in the middle of a frame")
+    if kind == FRAME_JSON:
+        return kind, json.loads(payload)
+    if kind == FRAME_BATCH:
+        return kind, unpack_batch(payload)
+    raise DaemonProtocolException(f"Unknown frame kind {kind}")
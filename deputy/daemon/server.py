@@ -0,0 +1,307 @@
+"""
+The deputy daemon: keeps all Magnum probes open and serves them to local clients over a
+Unix domain socket (see deputy.daemon.protocol for the wire format).
+
+Opening a probe means enumerating USB devices and reading serial numbers, which dominates
+the run time of short commands like 'magnum power'. With the daemon running, a command is
+a single request/response over the socket instead.
+"""
+
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+
+from deputy.daemon.protocol import (FRAME_JSON, DaemonProtocolException, default_socket_path,
+                                    encode_json, pack_batch, recv_frame)
+from deputy.magnum.cache import usb_device_id, usb_path_to_ports
+from deputy.magnum.defs import MagnumTelemetry
+from deputy.magnum.magnum import MagnumProbe
+from deputy.magnum.stream import MagnumStream
+
+
+class _ProbeSlot:
+    """An open probe and the lock serializing the USB transfers of all clients using it"""
+
+    __slots__ = ("probe", "lock", "usb_path")
+
+    def __init__(self, probe, usb_path):
+        self.probe = probe
+        self.lock = threading.Lock()
+        self.usb_path = usb_path
+
+    def get_target_voltage_current(self):
+        # Lets a MagnumStream sample through the lock
+        with self.lock:
+            return self.probe.get_target_voltage_current()
+
+    def get_target_presence(self):
+        with self.lock:
+            return self.probe.get_target_presence()
+
+
+def _info_dict(info) -> dict:
+    return {"serial": info.serial, "usb_path": info.usb_path, "hw_id": info.hw_id,
+            "hw_rev": info.hw_rev, "fw_rev": info.fw_rev}
+
+
+class DeputyDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves the connected probes on a Unix domain socket, one thread per client connection"""
+
+    daemon_threads = True
+
+    def __init__(self, path: str = None):
+        self.path = path or default_socket_path()
+        self.slots = {}
+        # USB path -> serial of the probes released to another process. They aren't opened
+        # again by rescans until a client acquires them back
+        self.released = {}
+        self._slots_lock = threading.Lock()
+        self._remove_stale_socket()
+        # Create the socket private to us, so nobody else can connect between bind() and chmod()
+        umask = os.umask(0o177)
+        try:
+            super().__init__(self.path, DaemonRequestHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, 0o600)
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.path):
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            # Left behind by a daemon that didn't exit cleanly
+            os.remove(self.path)
+        else:
+            raise Exception(f"deputy daemon is already running on {self.path}")
+        finally:
+            sock.close()
+
+    def rescan(self) -> list:
+        """Opens newly connected probes and forgets disconnected ones. Returns the serials"""
+        with self._slots_lock:
+            for serial, slot in list(self.slots.items()):
+                if usb_device_id(slot.usb_path) is None:
+                    print(f"Probe {serial} disconnected")
+                    slot.probe.close()
+                    del self.slots[serial]
+            skip_ports = [usb_path_to_ports(path)[1]
+                          for path in [slot.usb_path for slot in self.slots.values()] + list(self.released)]
+            for descriptor in MagnumProbe._find_descriptors():
+                if list(descriptor.dev_path[0]) in skip_ports:
+                    continue
+                try:
+                    probe = MagnumProbe(descriptor=descriptor)
+                except Exception as e:
+                    print(f"WARNING: Unable to open Magnum device {descriptor}: {e}")
+                    continue
+                self.slots[probe.serial] = _ProbeSlot(probe, probe.device.device_path)
+                print(f"Probe {probe.serial} opened (USB {probe.device.device_path})")
+            return sorted(self.slots)
+
+    def release(self, serial: str):
+        """
+        Closes a probe so another process can take it over (i.e. for a firmware update). It
+        stays closed, whatever is at its USB path, until acquire()
+        """
+        with self._slots_lock:
+            slot = self.slots.pop(serial, None)
+            if slot is not None:
+                self.released[slot.usb_path] = serial
+        if slot is not None:
+            with slot.lock:
+                slot.probe.close()
+            print(f"Probe {serial} released")
+
+    def release_all(self) -> list:
+        with self._slots_lock:
+            serials = sorted(self.slots)
+        for serial in serials:
+            self.release(serial)
+        return serials
+
+    def acquire(self, serial: str = None) -> list:
+        """Takes back the released probe with that serial (all of them if None) and rescans"""
+        with self._slots_lock:
+            for usb_path, released_serial in list(self.released.items()):
+                if serial is None or serial == released_serial:
+                    del self.released[usb_path]
+        return self.rescan()
+
+    def get_slot(self, serial: str = None, rescan: bool = True) -> _ProbeSlot:
+        """
+        Returns the probe with the given serial number (or the only one containing it), or the
+        only probe if serial is None. Rescans once if there's no such probe (and rescan is True).
+        """
+        for attempt in range(2):
+            with self._slots_lock:
+                if serial is None:
+                    matches = list(self.slots)
+                elif serial in self.slots:
+                    matches = [serial]
+                else:
+                    matches = [s for s in self.slots if serial in s]
+                if len(matches) == 1:
+                    return self.slots[matches[0]]
+            if len(matches) > 1:
+                if serial is None:
+                    raise Exception("Multiple Magnum devices found! Select one by serial number")
+                raise Exception(f"Multiple Magnum devices match serial number {serial}!")
+            if attempt == 0 and rescan:
+                self.rescan()
+            else:
+                break
+        if serial is None:
+            raise Exception("No Magnum device found!")
+        raise Exception(f"No Magnum device with serial number {serial} found!")
+
+    def execute(self, message: dict):
+        """Runs a (non-streaming) request and returns its result"""
+        cmd = message.get("cmd")
+        if cmd == "ping":
+            return {"pid": os.getpid(), "probes": sorted(self.slots), "released": sorted(self.released.values())}
+        if cmd == "list":
+            self.rescan()
+            return [self.execute({"cmd": "info", "serial": serial}) for serial in sorted(self.slots)]
+        if cmd == "rescan":
+            return self.rescan()
+        if cmd == "release":
+            serial = self.get_slot(message.get("serial"), rescan=False).probe.serial
+            self.release(serial)
+            return serial
+        if cmd == "release_all":
+            return self.release_all()
+        if cmd == "acquire":
+            return self.acquire(message.get("serial"))
+        if cmd == "shutdown":
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return None
+
+        slot = self.get_slot(message.get("serial"))
+        probe = slot.probe
+        with slot.lock:
+            if cmd == "info":
+                return _info_dict(probe.get_info())
+            if cmd == "telemetry":
+                telemetry = probe.get_telemetry()
+                return [getattr(telemetry, name) for name in MagnumTelemetry.__slots__]
+            if cmd == "voltage_current":
+                return list(probe.get_target_voltage_current())
+            if cmd == "set_power_ctrl":
+                probe.set_power_ctrl(int(message["power_ctrl"]))
+                return None
+            if cmd == "fusb303_regs":
+                return list(probe.get_fusb303_regs())
+            if cmd == "set_fusb303_reg":
+                probe.set_fusb303_reg(int(message["reg"]), int(message["data"]))
+                return None
+            if cmd == "serial_port":
+                return probe.get_target_serial_port()
+        raise Exception(f"Unknown command '{cmd}'")
+
+    def close_probes(self):
+        with self._slots_lock:
+            for slot in self.slots.values():
+                slot.probe.close()
+            self.slots.clear()
+
+
+class DaemonRequestHandler(socketserver.BaseRequestHandler):
+    """Handles one client connection: requests until the client disconnects, or one stream"""
+
+    def handle(self):
+        while True:
+            try:
+                frame = recv_frame(self.request)
+            except (OSError, ValueError, DaemonProtocolException):
+                return
+            if frame is None or frame[0] != FRAME_JSON:
+                return
+            message = frame[1]
+            if message.get("cmd") == "stream":
+                # A stream takes over the connection until it ends
+                self.stream(message)
+                return
+            try:
+                response = {"id": message.get("id"), "ok": True, "result": self.server.execute(message)}
+            except Exception as e:
+                response = {"id": message.get("id"), "ok": False, "error": str(e)}
+            try:
+                self.request.sendall(encode_json(response))
+            except OSError:
+                return
+
+    def stream(self, message: dict):
+        """
+        Streams sample batches until the stream ends or the client sends anything (or
+        disconnects), then sends the stream totals.
+        """
+        request_id = message.get("id")
+        try:
+            slot = self.server.get_slot(message.get("serial"))
+            start_ns = message.get("start_ns") or time.monotonic_ns()
+            # Sample through the slot, so other clients' requests don't interleave with a transfer
+            stream = MagnumStream(slot, float(message["rate_hz"]), message.get("batch_size"),
+                                  message.get("duration"), start_ns, bool(message.get("presence")))
+            self.request.sendall(encode_json({"id": request_id, "ok": True,
+                                              "result": {"start_ns": start_ns}}))
+        except Exception as e:
+            self.request.sendall(encode_json({"id": request_id, "ok": False, "error": str(e)}))
+            return
+
+        def watch_client():
+            try:
+                self.request.recv(1)
+            except OSError:
+                pass
+            stream.stop()
+        threading.Thread(target=watch_client, daemon=True).start()
+
+        error = None
+        try:
+            for batch in stream:
+                self.request.sendall(pack_batch(batch))
+        except OSError:
+            # Client is gone
+            stream.stop()
+            return
+        except Exception as e:
+            error = str(e)
+        stream.stop()
+        totals = {"samples": stream.samples, "missed": stream.missed, "overruns": stream.overruns}
+        response = {"id": request_id, "ok": error is None, "result": totals}
+        if error is not None:
+            response["error"] = error
+        try:
+            self.request.sendall(encode_json(response))
+        except OSError:
+            pass
+
+
+def run_daemon(path: str = None):
+    """Opens all probes and serves them until SIGTERM/SIGINT or a shutdown request"""
+    server = DeputyDaemon(path)
+    serials = server.rescan()
+    print(f"deputy daemon listening on {server.path} with {len(serials)} probe(s)")
+
+    def terminate(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.close_probes()
+        try:
+            os.remove(server.path)
+        except OSError:
+            pass
+        print("deputy daemon stopped")
@@ -0,0 +1,151 @@
+"""
+'deputy doctor': checks in one pass that all Magnum probes and their serial ports can be
+used by the current user, and explains why not (missing udev rule, wrong group, ...).
+"""
+
+import argparse
+import os
+import sys
+
+from deputy.magnum.cache import SYSFS_USB_DEVICES, find_usb_paths
+from deputy.magnum.defs import MAGNUM_VID_PIDS
+from deputy.util import VersionAction
+
+
+def _read_sysfs(usb_path, name):
+    try:
+        with open(os.path.join(SYSFS_USB_DEVICES, usb_path, name)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _group_name(gid):
+    import grp
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return str(gid)
+
+
+def _user_groups() -> set:
+    return {_group_name(gid) for gid in set(os.getgroups()) | {os.getgid()}}
+
+
+class DoctorReport:
+    """Collects the results of the checks"""
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.problems = 0
+
+    def ok(self, text):
+        print(f"  OK    {text}")
+
+    def info(self, text):
+        if self.verbose:
+            print(f"        {text}")
+
+    def problem(self, text, hint=None):
+        self.problems += 1
+        print(f"  FAIL  {text}")
+        if hint:
+            print(f"        -> {hint}")
+
+
+def check_node(report, what, node, rules, groups):
+    """Checks that the current user can open the device node, and tells why not"""
+    try:
+        st = os.stat(node)
+    except OSError as e:
+        report.problem(f"{what}: {node} ({e.strerror})")
+        return
+    group = _group_name(st.st_gid)
+    details = f"mode {st.st_mode & 0o777:o}, group {group}"
+    if os.access(node, os.R_OK | os.W_OK):
+        report.ok(f"{what}: {node} ({details})")
+        return
+    # Checked first: serial ports are usually root:dialout 0660 without any rule of ours
+    if group not in groups and group != "root" and st.st_mode & 0o060 == 0o060:
+        hint = f"Add yourself to the '{group}' group: sudo usermod -aG {group} $USER (then log in again)"
+    elif not rules:
+        hint = "No udev rule grants access to it"
+    elif any(rule.uaccess for rule in rules):
+        hint = "The rule relies on TAG+=\"uaccess\", which only works in a local (seat) session"
+    else:
+        hint = ("A rule exists, but wasn't applied. Reload the rules: "
+                "sudo udevadm control --reload-rules && sudo udevadm trigger")
+    report.problem(f"{what}: {node} is not accessible ({details})", hint)
+
+
+def run_doctor(verbose=False) -> int:
+    if not sys.platform.startswith("linux"):
+        print("deputy doctor checks udev and device permissions, which only exist on Linux.")
+        return 0
+    from deputy.serialmon.serialmon import PortRegistry
+    from deputy.udev import UdevRulesIndex
+
+    report = DoctorReport(verbose)
+    index = UdevRulesIndex()
+    groups = _user_groups()
+    print(f"udev rules: {len(index.files)} files, {len(index.rules)} USB rules "
+          f"({index.parsed_files} files parsed, the rest from cache)")
+    if verbose:
+        print(f"Your groups: {', '.join(sorted(groups))}")
+
+    registry = None
+    found = 0
+    missing_rule = False
+    for vid_pid in MAGNUM_VID_PIDS:
+        rules = index.find(vid_pid)
+        print(f"\nMagnum ({vid_pid})")
+        if rules:
+            for rule in rules:
+                report.ok(f"Rule {rule.location}: {rule.grants}")
+        else:
+            missing_rule = True
+            report.problem("No udev rule for the Magnum probe",
+                           "See the instructions below")
+
+        usb_paths = find_usb_paths(vid_pid) or []
+        if not usb_paths:
+            report.info("No probe attached")
+        for usb_path in usb_paths:
+            found += 1
+            busnum, devnum = _read_sysfs(usb_path, "busnum"), _read_sysfs(usb_path, "devnum")
+            serial = _read_sysfs(usb_path, "serial") or "?"
+            print(f" Probe {serial} at USB {usb_path}")
+            if busnum is None or devnum is None:
+                report.problem(f"USB device {usb_path} went away")
+                continue
+            node = "/dev/bus/usb/%03d/%03d" % (int(busnum), int(devnum))
+            check_node(report, "USB device", node, rules, groups)
+
+            # The target serial port is an interface of the same USB device
+            if registry is None:
+                registry = PortRegistry()
+            ports = registry.find_by_usb_path(usb_path)
+            if not ports:
+                report.problem("No serial port found for the probe's target UART",
+                               "Check that the cdc_acm driver is loaded (lsmod | grep cdc_acm)")
+            tty_rules = [rule for rule in rules if rule.subsystem in (None, "tty")]
+            for port in ports:
+                check_node(report, "Serial port", port.path, tty_rules, groups)
+
+    if missing_rule:
+        from deputy.magnum.cli import __print_udev_instructions__
+        print()
+        __print_udev_instructions__()
+
+    print(f"\n{found} probe(s) checked, {report.problems} problem(s) found.")
+    return 1 if report.problems else 0
+
+
+def cli(argv):
+    parser = argparse.ArgumentParser(prog="deputy doctor",
+                                     description="Check that the attached probes and their serial "
+                                                 "ports are accessible, and why not.")
+    parser.add_argument('--version', action=VersionAction, help="Print package version")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Print more information")
+    args = parser.parse_args(argv)
+    return run_doctor(args.verbose)
@@ -0,0 +1,359 @@
+"""
+Hotplug events for serial ports and USB devices (i.e. Magnum probes).
+
+On Linux the kernel's uevents are read from a netlink socket, so a device is seen within
+milliseconds of appearing or going away. Where netlink isn't available (i.e. in some
+containers), /dev and /dev/bus/usb are watched with inotify instead. On other systems the
+serial port list is polled, and USB devices aren't reported.
+"""
+
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import select
+import socket
+import struct
+import time
+
+from deputy.magnum.cache import SYSFS_USB_DEVICES, usb_device_id
+from deputy.magnum.defs import MAGNUM_VID_PIDS
+from deputy.serialmon.serialmon import PortRegistry, SerialPort
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+
+# Names of the serial ports listed by serial.tools.list_ports on Linux
+TTY_PATTERNS = ["ttyS*", "ttyUSB*", "ttyXRUSB*", "ttyACM*", "ttyAMA*", "rfcomm*", "ttyAP*"]
+
+USB_DEV_DIR = "/dev/bus/usb"
+POLL_INTERVAL_S = 0.25
+
+
+class HotplugEvent:
+    """
+    A device that was added or removed. kind is 'port' for serial ports, 'probe' for Magnum
+    probes and 'usb' for all other USB devices. path is the port path (i.e. '/dev/ttyACM0')
+    or the USB path (i.e. '1-4.2'). t_ns is the time.monotonic_ns() the event was read.
+    """
+
+    __slots__ = ("action", "kind", "path", "usb_path", "vid_pid", "port", "t_ns")
+
+    def __init__(self, action, kind, path, usb_path=None, vid_pid=None, port=None):
+        self.action = action
+        self.kind = kind
+        self.path = path
+        self.usb_path = usb_path
+        self.vid_pid = vid_pid
+        self.port = port
+        self.t_ns = time.monotonic_ns()
+
+    def __repr__(self):
+        return (f"HotplugEvent(action={self.action}, kind={self.kind}, path={self.path}, "
+                f"usb_path={self.usb_path}, vid_pid={self.vid_pid})")
+
+
+def _read_line(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _scan_usb_devices() -> dict:
+    """Returns {usb_path: (vid_pid, (busnum, devnum))} of the USB devices in sysfs"""
+    devices = {}
+    if not os.path.isdir(SYSFS_USB_DEVICES):
+        return devices
+    for name in os.listdir(SYSFS_USB_DEVICES):
+        # Skip interfaces (i.e. '1-4.2:1.0') and root hubs (i.e. 'usb1')
+        if ":" in name or not name[0].isdigit():
+            continue
+        devices[name] = (usb_device_id(name), _usb_devnum(name))
+    return devices
+
+
+def _usb_devnum(usb_path):
+    busnum = _read_line(os.path.join(SYSFS_USB_DEVICES, usb_path, "busnum"))
+    devnum = _read_line(os.path.join(SYSFS_USB_DEVICES, usb_path, "devnum"))
+    if busnum is None or devnum is None:
+        return None
+    return int(busnum), int(devnum)
+
+
+def _make_port(path):
+    """Returns a SerialPort for path, like serial.tools.list_ports would list it, or None"""
+    if not any(fnmatch.fnmatch(os.path.basename(path), pattern) for pattern in TTY_PATTERNS):
+        return None
+    from serial.tools.list_ports_linux import SysFS
+    info = SysFS(path)
+    if info.subsystem == "platform":
+        # Non-present internal serial port
+        return None
+    return SerialPort(info)
+
+
+class _NetlinkSource:
+    """Kernel uevents. Yields ('uevent', properties) tuples"""
+
+    name = "netlink"
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        try:
+            # Re-enumerating a hub produces bursts of events
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            self.sock.bind((0, UEVENT_GROUP_KERNEL))
+        except OSError:
+            self.sock.close()
+            raise
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self) -> list:
+        messages = []
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                return messages
+            # 'action@devpath' followed by KEY=VALUE fields, all NUL terminated
+            props = {}
+            for field in data.split(b"\0")[1:]:
+                key, sep, value = field.decode(errors="replace").partition("=")
+                if sep:
+                    props[key] = value
+            messages.append(("uevent", props))
+
+    def close(self):
+        self.sock.close()
+
+
+class _InotifySource:
+    """Device node creation/removal in /dev and /dev/bus/usb. Yields (action, path) tuples"""
+
+    name = "inotify"
+
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1() failed")
+        self.dirs = {}
+        self._watch("/dev")
+        if os.path.isdir(USB_DEV_DIR):
+            self._watch(USB_DEV_DIR)
+            for bus in os.listdir(USB_DEV_DIR):
+                self._watch(os.path.join(USB_DEV_DIR, bus))
+
+    def _watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.IN_CREATE | self.IN_DELETE)
+        if wd >= 0:
+            self.dirs[wd] = path
+
+    def fileno(self):
+        return self.fd
+
+    def read(self) -> list:
+        messages = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return messages
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, pos)
+                name = data[pos + self.EVENT.size:pos + self.EVENT.size + length].rstrip(b"\0")
+                pos += self.EVENT.size + length
+                directory = self.dirs.get(wd)
+                if directory is None:
+                    continue
+                path = os.path.join(directory, os.fsdecode(name))
+                action = "add" if mask & self.IN_CREATE else "remove"
+                if directory == USB_DEV_DIR and action == "add":
+                    # A new bus
+                    self._watch(path)
+                messages.append((action, path))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _PollSource:
+    """Fallback for systems without netlink or inotify: compares port list snapshots"""
+
+    name = "poll"
+
+    def __init__(self):
+        self._paths = {port.path for port in SerialPort.get_port_list()}
+
+    def fileno(self):
+        return None
+
+    def read(self) -> list:
+        ports = {port.path: port for port in SerialPort.get_port_list()}
+        messages = [("add", ports[path]) for path in sorted(ports.keys() - self._paths)]
+        messages += [("remove", path) for path in sorted(self._paths - ports.keys())]
+        self._paths = set(ports)
+        return messages
+
+    def close(self):
+        pass
+
+
+class HotplugWatcher:
+    """
+    Watches for serial ports and USB devices coming and going, keeps registry (a
+    PortRegistry) and usb_devices up to date and calls the callbacks for every event.
+
+    Nothing happens in the background: events are processed by poll(), wait_for() or run().
+    """
+
+    def __init__(self, registry: PortRegistry = None, probe_vid_pids: list = None):
+        self.source = self._open_source()
+        # Snapshot after the source is open, so no event falls in between
+        self.registry = registry if registry is not None else PortRegistry()
+        self.usb_devices = _scan_usb_devices()
+        self.probe_vid_pids = probe_vid_pids if probe_vid_pids is not None else MAGNUM_VID_PIDS
+        self.callbacks = []
+
+    @staticmethod
+    def _open_source():
+        if hasattr(socket, "AF_NETLINK"):
+            try:
+                return _NetlinkSource()
+            except OSError:
+                pass
+            try:
+                return _InotifySource()
+            except (OSError, AttributeError):
+                pass
+        return _PollSource()
+
+    @property
+    def backend(self) -> str:
+        return self.source.name
+
+    @property
+    def probes(self) -> dict:
+        """{usb_path: vid_pid} of the connected Magnum probes"""
+        return {usb_path: vid_pid for usb_path, (vid_pid, _) in self.usb_devices.items()
+                if vid_pid in self.probe_vid_pids}
+
+    def add_callback(self, callback):
+        """Adds a function to call with every HotplugEvent"""
+        self.callbacks.append(callback)
+
+    def fileno(self):
+        return self.source.fileno()
+
+    def poll(self, timeout: float = None) -> list:
+        """Waits up to timeout seconds (forever if None) for events and returns them"""
+        if self.source.fileno() is None:
+            time.sleep(POLL_INTERVAL_S if timeout is None else min(timeout, POLL_INTERVAL_S))
+        else:
+            ready, _, _ = select.select([self.source], [], [], timeout)
+            if not ready:
+                return []
+        events = []
+        for message in self.source.read():
+            event = self._translate(*message)
+            if event is not None:
+                events.append(event)
+                for callback in self.callbacks:
+                    callback(event)
+        return events
+
+    def wait_for(self, predicate, timeout: float = None):
+        """Returns the first event for which predicate(event) is True, or None on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            for event in self.poll(remaining):
+                if predicate(event):
+                    return event
+
+    def run(self):
+        """Processes events until interrupted"""
+        while True:
+            self.poll()
+
+    def close(self):
+        self.source.close()
+
+    def _translate(self, what, arg):
+        if self.source.name == "netlink":
+            return self._from_uevent(arg)
+        if self.source.name == "poll":
+            if what == "add":
+                return self._port_event("add", arg.path, arg)
+            return self._port_event("remove", arg)
+        if os.path.dirname(os.path.dirname(arg)) == USB_DEV_DIR:
+            bus, dev = os.path.split(arg)
+            return self._usb_devnode_event(what, (int(os.path.basename(bus)), int(dev)))
+        if os.path.dirname(arg) == "/dev":
+            return self._port_event(what, arg)
+        return None
+
+    def _from_uevent(self, props):
+        action = props.get("ACTION")
+        if action not in ("add", "remove"):
+            return None
+        subsystem = props.get("SUBSYSTEM")
+        if subsystem == "tty" and "DEVNAME" in props:
+            return self._port_event(action, os.path.join("/dev", props["DEVNAME"]))
+        if subsystem == "usb" and props.get("DEVTYPE") == "usb_device":
+            vid_pid = None
+            if "PRODUCT" in props:
+                vid, pid = props["PRODUCT"].split("/")[:2]
+                vid_pid = "%04x:%04x" % (int(vid, 16), int(pid, 16))
+            return self._usb_event(action, os.path.basename(props.get("DEVPATH", "")), vid_pid)
+        return None
+
+    def _port_event(self, action, path, port=None):
+        if action == "add":
+            port = port or _make_port(path)
+            if port is None:
+                return None
+            self.registry.add(port)
+        else:
+            port = self.registry.remove(path)
+            if port is None:
+                # Not a port we know (i.e. a virtual tty)
+                return None
+        return HotplugEvent(action, "port", path, port.usb_path, port.vid_pid, port)
+
+    def _usb_event(self, action, usb_path, vid_pid=None, devnum=None):
+        if action == "add":
+            vid_pid = vid_pid or usb_device_id(usb_path)
+            self.usb_devices[usb_path] = (vid_pid, devnum or _usb_devnum(usb_path))
+        else:
+            known = self.usb_devices.pop(usb_path, None)
+            if known is not None:
+                vid_pid = vid_pid or known[0]
+        kind = "probe" if vid_pid in self.probe_vid_pids else "usb"
+        return HotplugEvent(action, kind, usb_path, usb_path, vid_pid)
+
+    def _usb_devnode_event(self, action, devnum):
+        # inotify only tells the device node (bus and device number), so find the USB path
+        if action == "add":
+            self.usb_devices.update((path, device) for path, device in _scan_usb_devices().items()
+                                    if path not in self.usb_devices)
+        for usb_path, (vid_pid, known_devnum) in self.usb_devices.items():
+            if known_devnum == devnum:
+                if action == "add":
+                    return HotplugEvent(action, "probe" if vid_pid in self.probe_vid_pids else "usb",
+                                        usb_path, usb_path, vid_pid)
+                return self._usb_event(action, usb_path)
+        return None
@@ -0,0 +1,148 @@
+"""
+On-disk cache of Magnum probe locations.
+
+Maps a probe's serial number to its USB path (i.e. '1-4.2'), VID:PID and target serial port,
+so a probe can be opened directly instead of enumerating and opening every probe on the
+host. Every entry is validated with a cheap check (is there still a device with that VID:PID
+at that USB path?) before it's used. Callers fall back to a full scan on a miss.
+"""
+
+import json
+import os
+
+CACHE_VERSION = 1
+SYSFS_USB_DEVICES = "/sys/bus/usb/devices"
+SYSFS_TTY = "/sys/class/tty"
+
+
+def default_cache_path() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "deputy", "probes.json")
+
+
+def usb_path_to_ports(usb_path: str) -> tuple:
+    """Splits a USB path like '1-4.2' into the bus number and the port number list"""
+    bus, ports = usb_path.split("-", 1)
+    return int(bus), [int(p) for p in ports.split(".")]
+
+
+def _read_sysfs(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def usb_device_id(usb_path: str):
+    """Returns the '<vid>:<pid>' string of the USB device at usb_path, or None if there's none"""
+    if os.path.isdir(SYSFS_USB_DEVICES):
+        vid = _read_sysfs(os.path.join(SYSFS_USB_DEVICES, usb_path, "idVendor"))
+        pid = _read_sysfs(os.path.join(SYSFS_USB_DEVICES, usb_path, "idProduct"))
+        if vid is None or pid is None:
+            return None
+        return f"{vid}:{pid}".lower()
+    # No sysfs (i.e. not Linux). Ask libusb instead
+    from recom.backend.usb import get_vid_pid_on_port
+    vid_pid = get_vid_pid_on_port(usb_path_to_ports(usb_path)[1])
+    if vid_pid is None:
+        return None
+    return "%04x:%04x" % vid_pid
+
+
+def find_usb_paths(vid_pid: str):
+    """
+    Returns the USB paths of all devices with the given '<vid>:<pid>', using sysfs only.
+    Returns None if sysfs isn't available.
+    """
+    if not os.path.isdir(SYSFS_USB_DEVICES):
+        return None
+    paths = []
+    for name in os.listdir(SYSFS_USB_DEVICES):
+        # Skip interfaces (i.e. '1-4.2:1.0') and root hubs (i.e. 'usb1')
+        if ":" in name or not name[0].isdigit():
+            continue
+        if usb_device_id(name) == vid_pid.lower():
+            paths.append(name)
+    return sorted(paths)
+
+
+def tty_on_usb_path(tty: str, usb_path: str) -> bool:
+    """Returns True if the serial port tty belongs to the USB device at usb_path"""
+    name = os.path.basename(tty)
+    if not os.path.exists(tty) or not os.path.isdir(SYSFS_TTY):
+        # Without sysfs there's no cheap way to tell, so let the caller look it up again
+        return False
+    device = os.path.realpath(os.path.join(SYSFS_TTY, name, "device"))
+    return f"/{usb_path}:" in device
+
+
+class ProbeCache:
+    """Probe discovery cache, stored as JSON (see default_cache_path())"""
+
+    def __init__(self, path: str = None):
+        self.path = path or default_cache_path()
+        self._entries = None
+
+    @property
+    def entries(self) -> dict:
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+                if data.get("version") == CACHE_VERSION:
+                    self._entries = data.get("probes", {})
+            except (OSError, ValueError, AttributeError):
+                pass
+        return self._entries
+
+    def get(self, serial: str):
+        """
+        Returns (serial, entry) of the cached probe with exactly this serial number, or None.
+
+        A partial serial number is never resolved from the cache: a connected probe that
+        isn't cached yet could match it too, and only a scan can tell it's ambiguous.
+        """
+        if serial in self.entries:
+            return serial, self.entries[serial]
+        return None
+
+    def find_by_usb_path(self, usb_path: str):
+        """Returns (serial, entry) of the cached probe at usb_path, or None"""
+        for serial, entry in self.entries.items():
+            if entry.get("usb_path") == usb_path:
+                return serial, entry
+        return None
+
+    def update(self, serial: str, **fields):
+        """Updates the entry of a probe and writes the cache if anything changed"""
+        entry = self.entries.get(serial, {})
+        if all(entry.get(k) == v for k, v in fields.items()):
+            return
+        # A USB path can only hold one probe
+        if "usb_path" in fields:
+            for other in [s for s, e in self.entries.items()
+                          if s != serial and e.get("usb_path") == fields["usb_path"]]:
+                del self.entries[other]
+        entry.update(fields)
+        self.entries[serial] = entry
+        self.save()
+
+    def remove(self, serial: str):
+        if self.entries.pop(serial, None) is not None:
+            self.save()
+
+    def save(self):
+        """Writes the cache atomically. Failing to write it (i.e. read-only home) is not an error"""
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump({"version": CACHE_VERSION, "probes": self.entries}, f, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
@@ -1,21 +1,14 @@
 import argparse
 import os
-import platform
-import shutil
 import sys
 import traceback
-from time import sleep
 
-from deputy.magnum.magnum import MagnumProbe, MagnumPowerCtrl, MagnumTargetPresence
-from deputy.powermon.plot import run_plot
-from deputy.serialmon.term import Term
-from deputy.util import find_udev_rule
-from deputy import __version__
-from recom import RecomDevice, RecomDeviceException
-from recom.backend.usb import get_vid_pid_on_port
+from deputy.daemon import client as daemon
+from deputy.magnum.defs import MagnumPowerCtrl, MagnumTargetPresence
+from deputy.util import VersionAction
 
-if platform.system() != 'Windows':
-    from recom.util import get_drive_mount_point_from_usb_port_path
+# Only what every command needs is imported here. Everything else (recom, numpy, matplotlib,
+# tkinter) is imported by the commands that use it, so that 'magnum power on' starts fast
 
 def __print_udev_instructions__():
     print("A Magnum device was found, but access was denied. This could be because the device is only available to root.")
@@ -32,35 +25,49 @@ def __print_udev_instructions__():
     print("3. Copy the file to /etc/udev/rules.d. For example: \"sudo cp 99-redhill-magnum.rules /etc/udev/rules.d\"")
     print("4. Reload the udev rules using \"sudo udevadm control --reload-rules && udevadm trigger\" or reboot your computer")
 
-def probe_info(args):
+def probe_list(args, serial=None):
+    probes = daemon.list_probes()
+    if len(probes) == 0:
+        print("No Magnum devices found.")
+        return
+    for i, info in enumerate(probes):
+        if info.serial is None:
+            print(f"{i+1}. USB {info.usb_path}: {info.error or 'Access denied!'}")
+        else:
+            print(f"{i+1}. {info.serial}\tUSB {info.usb_path}\tHW {info.hw_rev}\tFW {info.fw_rev}")
+
+
+def probe_info(args, serial=None):
+    from deputy.util import find_udev_rule
     try:
-        probe = MagnumProbe()
+        probe = daemon.open_probe(serial)
     except Exception as e:
         if "Access denied!" in e.args:
             if not find_udev_rule("2e8a", "db60"):
                 __print_udev_instructions__()
             else:
                 print("No access despite having a udev rule for Magnum device...")
+                print("Run 'deputy doctor' to find out why.")
         else:
             print(e)
     else:
-        print(f"HW ID: {probe.device.getHwID()}")
-        print(f"HW Version: {probe.device.getHwRev()}")
-        print(f"FW Version: {probe.device.getFwRev()}")
+        info = probe.get_info()
+        print(f"HW ID: {info.hw_id}")
+        print(f"HW Version: {info.hw_rev}")
+        print(f"FW Version: {info.fw_rev}")
 
 
-def power_ctrl(args):
-    probe = MagnumProbe()
+def power_ctrl(args, serial=None):
+    probe = daemon.open_probe(serial)
     if len(args) == 0:
-        power_state = "ON" if probe.get_power_state() else "OFF"
-        power_ctrl = probe.get_power_ctrl()
+        telemetry = probe.get_telemetry()
+        power_state = "ON" if telemetry.power_state else "OFF"
         print(f"Target power: {power_state}")
-        print(f"Power control: {MagnumPowerCtrl(power_ctrl).name}")
-        print(f"Target voltage: {probe.get_target_voltage()}mV")
-        print(f"Target current: {probe.get_target_current()}mA")
-        target_presence = probe.get_target_presence()
-        print(f"Target presence: {MagnumTargetPresence(target_presence).name}")
-        print(f"Target VREF: {probe.get_target_reference()}mV")
+        print(f"Power control: {MagnumPowerCtrl(telemetry.power_ctrl).name}")
+        print(f"Target voltage: {telemetry.voltage_mv}mV")
+        print(f"Target current: {telemetry.current_ma}mA")
+        print(f"Target presence: {MagnumTargetPresence(telemetry.presence).name}")
+        print(f"Target VREF: {telemetry.vref_mv}mV")
     else:
         if isinstance(args[0], int):
             power_ctrl = int(args[0])
@@ -80,131 +87,299 @@ def power_ctrl(args):
             print(f"Unable to set power control to {args[0]}: {exp}")
 
 
-def power_plot(args):
-    probe = MagnumProbe()
-    run_plot(probe)
+def power_analyze(args, serial=None):
+    parser = argparse.ArgumentParser(prog="magnum powermon analyze",
+                                     description="Summarize a recorded power capture.")
+    parser.add_argument("file", help="Capture file")
+    parser.add_argument("--start", type=float, help="Start of the time range in seconds")
+    parser.add_argument("--end", type=float, help="End of the time range in seconds")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    parser.add_argument("--probe", help="Serial number of the probe to analyze (fleet captures)")
+    an_args = parser.parse_args(args)
 
+    from deputy.powermon.analyze import analyze_capture, print_summary
 
-def serial_monitor(args):
-    probe = MagnumProbe()
-    probe_serial_port = probe.get_target_serial_port()
-    if probe_serial_port != None:
-        print(f"Opening serial port {probe_serial_port}")
-        term = Term(probe_serial_port, 115200)
-        return term.start()
+    summary = analyze_capture(an_args.file, an_args.start, an_args.end, probe=an_args.probe)
+    print_summary(summary, an_args.json)
+
+
+def power_trigger(args, serial=None):
+    parser = argparse.ArgumentParser(prog="magnum powermon trigger",
+                                     description="Save the samples around trigger events to disk.")
+    parser.add_argument("-t", "--trigger", action="append", required=True,
+                        help="Trigger condition, i.e. 'current>50', 'voltage<3000', 'di/dt>10', "
+                             "'dv/dt<-5' or 'presence'. Can be given multiple times")
+    parser.add_argument("-o", "--output", default=".", help="Output directory (default: .)")
+    parser.add_argument("--pre", type=float, default=100,
+                        help="Milliseconds to keep before each trigger (default: 100)")
+    parser.add_argument("--post", type=float, default=400,
+                        help="Milliseconds to keep after each trigger (default: 400)")
+    parser.add_argument("--holdoff", type=float, default=0,
+                        help="Milliseconds to ignore triggers after an event (default: 0)")
+    parser.add_argument("--rate", type=float, default=1000, help="Sample rate in Hz (default: 1000)")
+    parser.add_argument("--duration", type=float, help="Run time in seconds (default: until Ctrl-C)")
+    parser.add_argument("--max-events", type=int, help="Stop after this many events")
+    tr_args = parser.parse_args(args)
+
+    from deputy.powermon.trigger import parse_trigger, run_triggers
+
+    try:
+        triggers = [parse_trigger(t) for t in tr_args.trigger]
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        return
+    probe = daemon.open_probe(serial)
+    run_triggers(probe, triggers, tr_args.rate, tr_args.pre, tr_args.post, tr_args.output,
+                 tr_args.duration, tr_args.holdoff, tr_args.max_events)
+
+
+def power_session(args, serial=None):
+    parser = argparse.ArgumentParser(prog="magnum powermon session",
+                                     description="Record power and the target serial port on one clock, "
+                                                 "and line them up afterwards.")
+    parser.add_argument("action", choices=["record", "lines", "export", "plot"],
+                        help="record a session, list its serial lines with the power at each, "
+                             "export a merged CSV or plot it")
+    parser.add_argument("directory", help="Session directory")
+    parser.add_argument("--rate", type=float, default=1000, help="Sample rate in Hz (default: 1000)")
+    parser.add_argument("--duration", type=float, help="Recording duration in seconds (default: until Ctrl-C)")
+    parser.add_argument("-b", "--baud", type=int, default=115200, help="Baud rate (default: 115200)")
+    parser.add_argument("-p", "--port", help="Serial port (default: the probe's target serial port)")
+    parser.add_argument("--grep", metavar="REGEX", help="Only the serial lines matching REGEX")
+    parser.add_argument("--window", type=float, default=100,
+                        help="Milliseconds around a line to average the current over (default: 100)")
+    parser.add_argument("--context", type=float, metavar="MS",
+                        help="Also print the power trace MS milliseconds around each line (for 'lines')")
+    parser.add_argument("-o", "--output", help="CSV file (for 'export', default: <directory>/merged.csv)")
+    se_args = parser.parse_args(args)
+
+    from deputy.powermon import session
+
+    if se_args.action == "record":
+        probe = daemon.open_probe(serial)
+        session.record_session(probe, se_args.directory, se_args.rate, se_args.duration,
+                               se_args.baud, port=se_args.port)
+        return
+    recorded = session.Session(se_args.directory)
+    if se_args.action == "lines":
+        session.print_session_lines(recorded, se_args.grep, se_args.window, se_args.context)
+    elif se_args.action == "export":
+        output = se_args.output or os.path.join(se_args.directory, "merged.csv")
+        session.export_session_csv(recorded, output)
+        print(f"Exported {recorded.power.num_samples} samples and {len(recorded.lines)} lines to {output}")
+    elif se_args.action == "plot":
+        session.plot_session(recorded, se_args.grep)
+
+
+def power_plot(args, serial=None):
+    if len(args) > 0 and args[0] == "analyze":
+        return power_analyze(args[1:], serial)
+    if len(args) > 0 and args[0] == "trigger":
+        return power_trigger(args[1:], serial)
+    if len(args) > 0 and args[0] == "session":
+        return power_session(args[1:], serial)
+
+    parser = argparse.ArgumentParser(prog="magnum powermon",
+                                     description="Plot or record target voltage and current.")
+    parser.add_argument("--record", metavar="FILE",
+                        help="Record samples to a capture file (no GUI)")
+    parser.add_argument("--rate", type=float, default=1000,
+                        help="Recording sample rate in Hz (default: 1000)")
+    parser.add_argument("--duration", type=float,
+                        help="Recording duration in seconds (default: until Ctrl-C)")
+    pm_args = parser.parse_args(args)
+
+    probe = daemon.open_probe(serial)
+    if pm_args.record:
+        from deputy.powermon.record import record_power
+        record_power(probe, pm_args.record, pm_args.rate, pm_args.duration,
+                     label=probe.serial)
     else:
+        from deputy.powermon.plot import run_plot
+        run_plot(probe)
+
+
+def serial_monitor(args, serial=None):
+    parser = argparse.ArgumentParser(prog="magnum serialmon",
+                                     description="Use the target serial port of a Magnum probe.")
+    parser.add_argument("action", nargs="?", choices=["open", "serve"], default="open",
+                        help="Open a terminal (default) or share the port over sockets")
+    parser.add_argument("-b", "--baud", type=int, default=115200, help="Baud rate (default: 115200)")
+    parser.add_argument("-l", "--listen", action="append",
+                        help="Address to serve on, see 'serialmon serve' (for 'serve')")
+    parser.add_argument("--write-policy", choices=["lock", "all", "none"], default="lock",
+                        help="Which clients may write (for 'serve', default: lock)")
+    sm_args = parser.parse_args(args)
+
+    probe = daemon.open_probe(serial)
+    probe_serial_port = probe.get_target_serial_port()
+    if probe_serial_port is None:
         print("ERROR: Unable to find probe serial port!")
+        return
+    if sm_args.action == "serve":
+        from deputy.serialmon.share import run_server
+        return run_server(probe_serial_port, sm_args.baud, "8N1", sm_args.listen, sm_args.write_policy)
+    from deputy.serialmon.term import Term
+    print(f"Opening serial port {probe_serial_port}")
+    term = Term(probe_serial_port, sm_args.baud, "8N1", None)
+    return term.start()
 
 
-def update_fw(args):
-    if args is None:
-        print("Missing binary file paramter")
-    binary_file = args[0]
-
-    board = MagnumProbe()
-    print(f"Found Magnum probe {board.device.get_serial()}")
-    print(f"Current FW Rev = {board.device.getFwRev()}")
-
-    # Check if the passed file is a valid file (does exist)
-    file_ref = os.path.join(os.getcwd(), binary_file)
-    if not os.path.exists(file_ref):
-        print(f"ERROR: Cannot find the file/path {file_ref}")
-
-    # Get port path and reset board
-    port_path = board.device._comsBackend.get_device_path()
-    old_vp = get_vid_pid_on_port(port_path)
-
-    # Reset board
-    print("Rebooting to bootloader... ", end='')
-    board.device.reset(2)
-    sleep(0.5)
-
-    while True:
-        new_vp = get_vid_pid_on_port(port_path)
-        if new_vp is not None:
-            if new_vp[0] != old_vp[0] or new_vp[1] != old_vp[1]:
-                print("DONE")
-                print("Found device with VID=%04X, PID=%04X" % (new_vp[0], new_vp[1]))
-                break
-        sleep(0.1)
-
-    if platform.system() != 'Windows':
-        print("Looking for mass storage device... ", end='')
-        for i in range(10):
-            mp = get_drive_mount_point_from_usb_port_path(port_path, new_vp)
-            if mp is not None:
-                break
-            sleep(1)
-        if mp == None:
-            print("\nERROR: Bootloader not found")
-            return False
-        else:
-            print(mp)
-        print(f"Updating device with {binary_file}")
-        if not os.path.exists(mp):
-            print(f"ERROR: Bootloader path does not exist ({mp})")
-            return False
-        dest_ref = os.path.join(mp, binary_file)
-        try:
-            shutil.copy(file_ref, dest_ref)
-        except IOError as exp:
-            print(f"ERROR: Failed to copy file {binary_file} ({exp})")
+def update_fw(args, serial=None):
+    parser = argparse.ArgumentParser(prog="magnum update",
+                                     description="Update the firmware of one or all Magnum probes.")
+    parser.add_argument("file", help="Firmware file (.uf2)")
+    parser.add_argument("--all", action="store_true", help="Update all attached probes, in parallel")
+    parser.add_argument("--expect-rev", help="Fail unless the probes restart with this firmware revision")
+    up_args = parser.parse_args(args)
+
+    from deputy.magnum.update import FirmwareImage
+
+    # Check the image before any probe is rebooted
+    image = FirmwareImage(up_args.file)
+
+    # The update needs the devices themselves, so make the daemon (if any) let go of them
+    # before anything is opened directly, and take them back once they are updated
+    if up_args.all:
+        released = daemon.release_all_probes()
+    else:
+        released = [daemon.release_probe(serial)]
+    try:
+        return _update_probes(image, serial, up_args)
+    finally:
+        for released_serial in released:
+            if released_serial is not None:
+                daemon.acquire_probe(released_serial)
+
+def _update_probes(image, serial, up_args) -> bool:
+    from deputy.magnum.magnum import MagnumProbe
+    from deputy.magnum.update import ProbeUpdate, print_update_report, update_probes
+
+    # (serial, descriptor) of the probes to open. Enumerated ones are opened by their USB path
+    unavailable = []
+    if up_args.all:
+        found = []
+        for info in MagnumProbe.enumerate():
+            if info.serial is None:
+                unavailable.append(ProbeUpdate("?", info.usb_path, error=info.error))
+            else:
+                found.append((info.serial, info.descriptor))
+        if len(found) == 0 and len(unavailable) == 0:
+            print("No Magnum devices found.")
             return False
-        print("DONE")
-        return True
     else:
-        print(f"Please manually copy {binary_file} to the flash driver that just showd up!")
-        return True
+        found = [(serial, None)]
+
+    probes = []
+    for probe_serial, descriptor in found:
+        try:
+            probe = MagnumProbe(probe_serial, descriptor=descriptor)
+        except Exception as e:
+            if not up_args.all:
+                raise
+            unavailable.append(ProbeUpdate(probe_serial, "?", error=f"Unable to open ({e})"))
+            continue
+        print(f"Found Magnum probe {probe.serial} at USB {probe.device.device_path}, "
+              f"FW Rev = {probe.device.getFwRev()}")
+        probes.append(probe)
+    for update in unavailable:
+        print(f"Magnum device {update.serial} at USB {update.usb_path} won't be updated: {update.error}")
 
-def fusb303_diag(args):
-    probe = MagnumProbe()
+    updates = update_probes(probes, image) if probes else []
+    if up_args.expect_rev is not None:
+        for update in updates:
+            if update.ok and not update.manual_copy and str(update.new_rev) != up_args.expect_rev:
+                update.error = f"Restarted with FW Rev {update.new_rev}, expected {up_args.expect_rev}"
+    updates += unavailable
+    print_update_report(updates, image)
+    return all(update.ok for update in updates)
+
+def fusb303_watch(args, serial=None):
+    parser = argparse.ArgumentParser(prog="magnum fusb303 watch",
+                                     description="Poll the FUSB303 registers and print the fields that change.")
+    parser.add_argument("--interval", type=float, default=0,
+                        help="Seconds between polls (default: 0, as fast as the probe answers)")
+    parser.add_argument("--duration", type=float, help="Watch duration in seconds (default: until Ctrl-C)")
+    wa_args = parser.parse_args(args)
+
+    from deputy.magnum.fusb303 import watch_registers
+    probe = daemon.open_probe(serial)
+    try:
+        watch_registers(probe, wa_args.duration, wa_args.interval)
+    except KeyboardInterrupt:
+        pass
+
+def fusb303_diag(args, serial=None):
+    if args and args[0] == "watch":
+        return fusb303_watch(args[1:], serial)
+    from deputy.magnum.fusb303 import REGISTERS, print_registers
+    probe = daemon.open_probe(serial)
     if args is None or len(args) == 0:
         fusb303_regs = probe.get_fusb303_regs()
-        if len(fusb303_regs) != 14:
-            print(f"ERROR: Expected 14 values, got {len(fusb303_regs)} instead")
+        if len(fusb303_regs) != len(REGISTERS):
+            print(f"ERROR: Expected {len(REGISTERS)} values, got {len(fusb303_regs)} instead")
             print(f"{fusb303_regs}")
             return
-        print("DEVICE_ID:\t0x%02X" % fusb303_regs[0])
-        print("DEVICE_TYPE:\t0x%02X" % fusb303_regs[1])
-        print("PORT ROLE:\t0x%02X" % fusb303_regs[2])
-        print("CONTROL:\t0x%02X" % fusb303_regs[3])
-        print("CONTROL1:\t0x%02X" % fusb303_regs[4])
-        print("MANUAL:\t\t0x%02X" % fusb303_regs[5])
-        print("RESET:\t\t0x%02X" % fusb303_regs[6])
-        print("MASK:\t\t0x%02X" % fusb303_regs[7])
-        print("MASK1:\t\t0x%02X" % fusb303_regs[8])
-        print("STATUS:\t\t0x%02X" % fusb303_regs[9])
-        print("STATUS1:\t0x%02X" % fusb303_regs[10])
-        print("TYPE:\t\t0x%02X" % fusb303_regs[11])
-        print("INTERRUPT:\t0x%02X" % fusb303_regs[12])
-        print("INTERRUPT1:\t0x%02X" % fusb303_regs[13])
+        print_registers(bytes(fusb303_regs))
     else:
         if len(args) != 2:
             print(f"ERROR: Need 2 paramgeters (register address, register data) or nothing (read)")
             return
         probe.set_fusb303_reg(int(args[0], 0), int(args[1], 0))
 
+def fleet(args, serial=None):
+    parser = argparse.ArgumentParser(prog="magnum fleet",
+                                     description="Operate on all attached Magnum probes at once.")
+    parser.add_argument("action", choices=["status", "powermon"], help="Fleet command")
+    parser.add_argument("--record", metavar="FILE",
+                        help="Capture file for 'powermon' (one set of columns per probe)")
+    parser.add_argument("--rate", type=float, default=1000,
+                        help="Sample rate in Hz per probe (default: 1000)")
+    parser.add_argument("--duration", type=float,
+                        help="Recording duration in seconds (default: until Ctrl-C)")
+    fl_args = parser.parse_args(args)
+
+    from deputy.magnum.fleet import open_all_probes, fleet_status, print_fleet_status, record_fleet
+
+    probes = daemon.open_all_probes()
+    if probes is None:
+        probes = open_all_probes()
+    if len(probes) == 0:
+        print("No Magnum devices found.")
+        return
+    if fl_args.action == "status":
+        print_fleet_status(fleet_status(probes))
+    elif fl_args.action == "powermon":
+        if fl_args.record is None:
+            print("ERROR: 'magnum fleet powermon' requires --record FILE")
+            return
+        record_fleet(probes, fl_args.record, fl_args.rate, fl_args.duration)
+
+
+COMMANDS = {
+    "list": probe_list,
+    "info": probe_info,
+    "power": power_ctrl,
+    "powermon": power_plot,
+    "update": update_fw,
+    "fusb303": fusb303_diag,
+    "serialmon": serial_monitor,
+    "fleet": fleet,
+}
+
 def cli(argv):
     parser = argparse.ArgumentParser(description="Magnum CLI to interract with debug probe.")
     parser.add_argument("cmd", type=str, help="Command/Action")
-    parser.add_argument('--version', action='version', version=__version__,
-                                                help="Print package version")
+    parser.add_argument('--version', action=VersionAction, help="Print package version")
     parser.add_argument('-S', '--serial', help='Serial number to search for')
 
     args, remaining_args = parser.parse_known_args(argv)
 
-    if args.cmd == "info":
-        probe_info(remaining_args)
-    elif args.cmd == "power":
-        power_ctrl(remaining_args)
-    elif args.cmd == "powermon":
-        power_plot(remaining_args)
-    elif args.cmd == "update":
-        update_fw(remaining_args)
-    elif args.cmd == "fusb303":
-        fusb303_diag(remaining_args)
-    elif args.cmd == "serialmon":
-        serial_monitor(remaining_args)
+    command = COMMANDS.get(args.cmd)
+    if command is None:
+        print(f"Unknown command {args.cmd}. Valid commands are: {', '.join(COMMANDS)}")
+        return
+    command(remaining_args, args.serial)
 
 def main(argv=None):
     """Magnum CLI Main entry point"""
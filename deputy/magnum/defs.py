@@ -0,0 +1,80 @@
+"""
+Magnum probe protocol definitions. Kept apart from MagnumProbe, so they can be used without
+importing recom (i.e. when talking to the probes through the deputy daemon).
+"""
+
+from enum import IntEnum
+import struct
+
+# USB VID:PIDs of Magnum probes
+MAGNUM_VID_PIDS = ["2e8a:db60"]
+
+
+class MagnumCtrlOpcode(IntEnum):
+    POWER_STATE         = 0
+    POWER_CTRL          = 1
+    TARGET_VOLTAGE      = 2
+    TARGET_CURRENT      = 3
+    TARGET_PRESENCE     = 4
+    TARGET_REFERENCE    = 5
+    TELEMETRY           = 6
+    FUSB303_REGS        = 0xF0
+
+class MagnumPowerCtrl(IntEnum):
+    AUTOMATIC   = 0
+    FORCE_ON    = 1
+    FORCE_OFF   = 2
+
+class MagnumTargetPresence(IntEnum):
+    NONE            = 0
+    DEBUG_HEADER    = 1
+    USB             = 2
+
+class MagnumTelemetry:
+    """Snapshot of the probe's power and target state, as returned by the TELEMETRY opcode"""
+
+    __slots__ = ("power_state", "power_ctrl", "voltage_mv", "current_ma", "presence", "vref_mv")
+
+    # Wire format: power state, power control, voltage (mV), current (mA), presence, VREF (mV)
+    STRUCT = struct.Struct("<BBHHBH")
+
+    def __init__(self, power_state, power_ctrl, voltage_mv, current_ma, presence, vref_mv):
+        self.power_state = power_state
+        self.power_ctrl = power_ctrl
+        self.voltage_mv = voltage_mv
+        self.current_ma = current_ma
+        self.presence = presence
+        self.vref_mv = vref_mv
+
+    def __repr__(self):
+        return (f"MagnumTelemetry(power_state={self.power_state}, power_ctrl={self.power_ctrl}, "
+                f"voltage_mv={self.voltage_mv}, current_ma={self.current_ma}, "
+                f"presence={self.presence}, vref_mv={self.vref_mv})")
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(*cls.STRUCT.unpack(data))
+
+class MagnumProbeInfo:
+    """Identification of a connected Magnum probe, as returned by MagnumProbe.enumerate()"""
+
+    __slots__ = ("serial", "usb_path", "hw_id", "hw_rev", "fw_rev", "descriptor", "error")
+
+    def __init__(self, serial, usb_path, hw_id, hw_rev, fw_rev, descriptor, error=None):
+        self.serial = serial
+        self.usb_path = usb_path
+        self.hw_id = hw_id
+        self.hw_rev = hw_rev
+        self.fw_rev = fw_rev
+        self.descriptor = descriptor
+        # Why the probe couldn't be opened (i.e. "Access denied!"), if it couldn't
+        self.error = error
+
+    def __repr__(self):
+        return (f"MagnumProbeInfo(serial={self.serial}, usb_path={self.usb_path}, hw_id={self.hw_id}, "
+                f"hw_rev={self.hw_rev}, fw_rev={self.fw_rev})")
+
+    def open(self):
+        """Opens the probe and returns a MagnumProbe"""
+        from deputy.magnum.magnum import MagnumProbe
+        return MagnumProbe(descriptor=self.descriptor)
@@ -0,0 +1,195 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+import numpy as np
+
+from deputy.magnum.magnum import MagnumProbe, MagnumPowerCtrl, MagnumTargetPresence
+from deputy.powermon.acquire import AcquisitionThread
+from deputy.powermon.capture import CaptureWriter
+
+# Delay between opening the probes and the first (shared) sample deadline
+FLEET_START_DELAY_S = 0.1
+# How far a probe may lag behind the others before rows are written without its samples
+FLEET_MAX_LAG_S = 2.0
+
+
+def open_all_probes(max_workers: int = 16) -> list:
+    """Opens all connected Magnum probes in parallel and returns them sorted by USB path"""
+    probes = MagnumProbe.enumerate()
+    accessible = [info for info in probes if info.serial is not None]
+    for info in probes:
+        if info.serial is None:
+            print(f"WARNING: Magnum device at USB {info.usb_path}: {info.error}")
+    if len(accessible) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(accessible))) as pool:
+        return list(pool.map(lambda info: info.open(), accessible))
+
+
+def fleet_status(probes, max_workers: int = 16) -> list:
+    """Reads the telemetry of all probes concurrently. Returns (serial, telemetry) tuples"""
+    def read(probe):
+        try:
+            return probe.serial, probe.get_telemetry()
+        except Exception as e:
+            return probe.serial, e
+    if len(probes) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(probes))) as pool:
+        return list(pool.map(read, probes))
+
+
+def print_fleet_status(status):
+    print("Serial\t\t\tPower\tControl\t\tVoltage\tCurrent\tPresence\tVREF")
+    for serial, telemetry in status:
+        if isinstance(telemetry, Exception):
+            print(f"{serial}\tERROR: {telemetry}")
+            continue
+        print(f"{serial}\t{'ON' if telemetry.power_state else 'OFF'}\t"
+              f"{MagnumPowerCtrl(telemetry.power_ctrl).name:<10}\t{telemetry.voltage_mv}mV\t"
+              f"{telemetry.current_ma}mA\t{MagnumTargetPresence(telemetry.presence).name:<12}\t"
+              f"{telemetry.vref_mv}mV")
+
+
+def fleet_columns(serials) -> list:
+    """Capture columns of a fleet recording: t_ns, voltage_mv and current_ma per probe"""
+    columns = []
+    for serial in serials:
+        columns += [(f"{serial}.t_ns", "<i8"), (f"{serial}.voltage_mv", "<u2"),
+                    (f"{serial}.current_ma", "<u2")]
+    return columns
+
+
+class FleetRecorder:
+    """
+    Samples all probes at the same time, one acquisition thread per probe, and writes them to
+    a single capture file with per-probe columns.
+
+    All streams share their start time and rate, so a sample's tick identifies the same
+    deadline on every probe. Rows are written per tick once every probe has moved past it,
+    or once a probe has stopped or lags more than FLEET_MAX_LAG_S behind the others, so one
+    stalled probe doesn't hold back (and buffer) everyone else's samples. Deadlines a probe
+    missed are written with a t_ns of 0, and samples arriving after their row was written
+    are counted in late_samples. A probe that fails (i.e. unplugged) is treated as stopped,
+    with its error in errors, and the other probes keep recording.
+    """
+
+    def __init__(self, probes, path, rate_hz: float, duration: float = None):
+        self.probes = probes
+        self.serials = [probe.serial for probe in probes]
+        self.rate_hz = rate_hz
+        start_ns = time.monotonic_ns() + round(FLEET_START_DELAY_S * 1e9)
+        self.writer = CaptureWriter(path, fleet_columns(self.serials), rate_hz=rate_hz,
+                                    label=f"fleet of {len(probes)}", start_mono_ns=start_ns)
+        self.acquisitions = [AcquisitionThread(probe, rate_hz, duration=duration, start_ns=start_ns)
+                             for probe in probes]
+        # Per probe: list of (ticks, t, v, i) arrays not written yet
+        self._pending = [[] for _ in probes]
+        # Highest tick seen per probe
+        self._last_tick = [-1] * len(probes)
+        self._next_tick = 0
+        self._max_lag_ticks = max(1, round(FLEET_MAX_LAG_S * rate_hz))
+        self.late_samples = [0] * len(probes)
+        self.errors = [None] * len(probes)
+
+    def start(self):
+        for acquisition in self.acquisitions:
+            acquisition.start()
+
+    @property
+    def running(self) -> bool:
+        return any(acquisition.is_alive() for acquisition in self.acquisitions)
+
+    def poll(self):
+        """Collects the queued batches of all probes and writes all complete rows"""
+        self._check_errors()
+        for n, acquisition in enumerate(self.acquisitions):
+            for batch in acquisition.drain():
+                self._add(n, batch)
+        self._write_rows(self._complete_tick())
+
+    def _check_errors(self):
+        """Notes (once) the probes whose acquisition failed. They're treated as stopped"""
+        for n, acquisition in enumerate(self.acquisitions):
+            if acquisition.error is not None and self.errors[n] is None:
+                self.errors[n] = acquisition.error
+                print(f"\nWARNING: {self.serials[n]} failed, recording the other probes: {acquisition.error}")
+
+    def _complete_tick(self) -> int:
+        """Last tick that can be written: the slowest probe's, unless it stopped or lags too far"""
+        lead = max(self._last_tick)
+        complete = lead
+        for acquisition, last_tick in zip(self.acquisitions, self._last_tick):
+            if acquisition.is_alive() and acquisition.error is None:
+                complete = min(complete, max(last_tick, lead - self._max_lag_ticks))
+        return complete
+
+    def _add(self, n, batch):
+        if len(batch) == 0:
+            return
+        self._pending[n].append((np.frombuffer(batch.ticks, dtype=np.int64),
+                                 np.frombuffer(batch.timestamps, dtype=np.int64),
+                                 np.frombuffer(batch.voltage, dtype=np.uint16),
+                                 np.frombuffer(batch.current, dtype=np.uint16)))
+        self._last_tick[n] = max(self._last_tick[n], batch.ticks[-1])
+
+    def _write_rows(self, last_tick):
+        rows = last_tick - self._next_tick + 1
+        if rows <= 0:
+            return
+        columns = []
+        for n, pending in enumerate(self._pending):
+            t = np.zeros(rows, dtype=np.int64)
+            v = np.zeros(rows, dtype=np.uint16)
+            i = np.zeros(rows, dtype=np.uint16)
+            if pending:
+                ticks, pt, pv, pi = (np.concatenate(c) for c in zip(*pending))
+                # Samples of a lagging probe whose rows were already written are lost
+                late = ticks < self._next_tick
+                self.late_samples[n] += int(late.sum())
+                use = ~late & (ticks <= last_tick)
+                idx = ticks[use] - self._next_tick
+                t[idx] = pt[use]
+                v[idx] = pv[use]
+                i[idx] = pi[use]
+                keep = ticks > last_tick
+                self._pending[n] = [(ticks[keep], pt[keep], pv[keep], pi[keep])] if keep.any() else []
+            columns += [t, v, i]
+        self.writer.write(*columns)
+        self._next_tick = last_tick + 1
+
+    def stop(self):
+        for acquisition in self.acquisitions:
+            acquisition.stream.stop()
+        for acquisition in self.acquisitions:
+            acquisition.stop(timeout=1)
+            for batch in acquisition.drain():
+                self._add(self.acquisitions.index(acquisition), batch)
+        self._check_errors()
+        self._write_rows(max(self._last_tick))
+        self.writer.close()
+
+
+def record_fleet(probes, path, rate_hz: float, duration: float = None):
+    """Records all probes into one capture file until duration has passed or Ctrl-C"""
+    recorder = FleetRecorder(probes, path, rate_hz, duration)
+    print(f"Recording {len(probes)} probes to {path} at {rate_hz:g} Hz" +
+          (f" for {duration:g}s" if duration else " (Ctrl-C to stop)"))
+    recorder.start()
+    try:
+        while recorder.running:
+            time.sleep(0.1)
+            recorder.poll()
+    finally:
+        recorder.stop()
+        print(f"Recorded {recorder.writer.samples} rows ({os.path.getsize(path)} bytes)")
+        for serial, acquisition, late, error in zip(recorder.serials, recorder.acquisitions,
+                                                    recorder.late_samples, recorder.errors):
+            stream = acquisition.stream
+            print(f"  {serial}: {stream.samples} samples, missed: {stream.missed}, "
+                  f"overruns: {stream.overruns}, dropped: {acquisition.dropped_samples}, "
+                  f"late: {late}" + (f", FAILED: {error}" if error is not None else ""))
+    if all(error is not None for error in recorder.errors):
+        raise recorder.errors[0]
+    return recorder.writer.samples
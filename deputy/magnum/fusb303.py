@@ -0,0 +1,140 @@
+"""
+FUSB303 (USB Type-C port controller) register map, and a watcher that logs its changes.
+
+The probe returns the 14 registers below in one control transfer, in this order. Registers
+are described by their bitfields, so a change is reported as i.e. "STATUS.ORIENT CC1 -> none"
+rather than as two hex bytes.
+"""
+
+import time
+
+
+class Field:
+    """Bits [shift, shift + width) of a register, with optional names for their values"""
+
+    __slots__ = ("name", "shift", "mask", "values")
+
+    def __init__(self, name: str, shift: int, width: int = 1, values: dict = None):
+        self.name = name
+        self.shift = shift
+        self.mask = (1 << width) - 1
+        self.values = values
+
+    def get(self, reg: int) -> int:
+        return (reg >> self.shift) & self.mask
+
+    def format(self, value: int) -> str:
+        if self.values is not None:
+            return self.values.get(value, str(value))
+        return str(value)
+
+
+class Register:
+    __slots__ = ("name", "address", "fields")
+
+    def __init__(self, name: str, address: int, fields: list = ()):
+        self.name = name
+        self.address = address
+        self.fields = fields
+
+    def decode(self, reg: int) -> str:
+        """i.e. 'ATTACH=1 BC_LVL=1.5A ORIENT=CC1'"""
+        return " ".join(f"{field.name}={field.format(field.get(reg))}" for field in self.fields)
+
+
+_ORIENT = {0: "none", 1: "CC1", 2: "CC2", 3: "fault"}
+_BC_LVL = {0: "Ra", 1: "default", 2: "1.5A", 3: "3.0A"}
+_INTERRUPTS = [Field("ATTACH", 0), Field("DETACH", 1), Field("BC_LVL", 2), Field("AUTOSNK", 3),
+               Field("VBUS_CHG", 4), Field("FAULT", 5), Field("ORIENT", 6)]
+_INTERRUPTS1 = [Field("REMEDY", 0), Field("FRC_SUCC", 1), Field("FRC_FAIL", 2), Field("REM_FAIL", 3),
+                Field("REM_VBON", 4), Field("REM_VBOFF", 5)]
+
+# In the order get_fusb303_regs() returns them
+REGISTERS = [
+    Register("DEVICE_ID", 0x01, [Field("REVISION_ID", 0, 4), Field("VERSION_ID", 4, 4)]),
+    Register("DEVICE_TYPE", 0x02),
+    Register("PORTROLE", 0x03, [Field("SRC", 0), Field("SNK", 1), Field("DRP", 2), Field("AUDIOACC", 3),
+                                Field("TRY", 4, 2, {0: "none", 1: "Try.SNK", 2: "Try.SRC", 3: "none"}),
+                                Field("ORIENTDEB", 6)]),
+    Register("CONTROL", 0x04, [Field("INT_MASK", 0),
+                               Field("HOST_CUR", 1, 2, {0: "reserved", 1: "default", 2: "1.5A", 3: "3.0A"}),
+                               Field("DCABLE_EN", 3), Field("DRPTOGGLE", 4, 2), Field("T_DRP", 6, 2)]),
+    Register("CONTROL1", 0x05, [Field("ENABLE", 3), Field("TCCDEB", 4, 3)]),
+    Register("MANUAL", 0x09, [Field("ERROR_REC", 0), Field("DISABLED", 1), Field("UNATT_SRC", 2),
+                              Field("UNATT_SNK", 3), Field("FORCE_SNK", 4), Field("FORCE_SRC", 5)]),
+    Register("RESET", 0x0A, [Field("SW_RES", 0)]),
+    Register("MASK", 0x0E, _INTERRUPTS),
+    Register("MASK1", 0x0F, _INTERRUPTS1),
+    Register("STATUS", 0x11, [Field("ATTACH", 0), Field("BC_LVL", 1, 2, _BC_LVL), Field("VBUSOK", 3),
+                              Field("ORIENT", 4, 2, _ORIENT), Field("VSAFE0V", 6), Field("AUTOSNK", 7)]),
+    Register("STATUS1", 0x12, [Field("REMEDY", 0), Field("FAULT", 1)]),
+    Register("TYPE", 0x13, [Field("AUDIO", 0), Field("AUDIOVBUS", 1), Field("ACTIVECABLE", 2),
+                            Field("SOURCE", 3), Field("SINK", 4), Field("DEBUGSNK", 5), Field("DEBUGSRC", 6)]),
+    Register("INTERRUPT", 0x14, _INTERRUPTS),
+    Register("INTERRUPT1", 0x15, _INTERRUPTS1),
+]
+
+
+def register_changes(old: bytes, new: bytes) -> list:
+    """Returns (register, field, old value, new value) for every field that differs"""
+    changes = []
+    for register, old_reg, new_reg in zip(REGISTERS, old, new):
+        if old_reg == new_reg:
+            continue
+        if not register.fields:
+            changes.append((register, None, old_reg, new_reg))
+            continue
+        for field in register.fields:
+            old_value, new_value = field.get(old_reg), field.get(new_reg)
+            if old_value != new_value:
+                changes.append((register, field, old_value, new_value))
+    return changes
+
+
+def format_change(change) -> str:
+    register, field, old_value, new_value = change
+    if field is None:
+        return f"{register.name} 0x{old_value:02X} -> 0x{new_value:02X}"
+    return f"{register.name}.{field.name} {field.format(old_value)} -> {field.format(new_value)}"
+
+
+def print_registers(regs: bytes):
+    for register, reg in zip(REGISTERS, regs):
+        print(f"{register.name + ':':<13}0x{reg:02X}  {register.decode(reg)}".rstrip())
+
+
+def watch_registers(probe, duration: float = None, interval: float = 0, out=print) -> int:
+    """
+    Polls the registers as fast as the probe answers (or every interval seconds) and prints
+    the fields that changed, one line per poll with a change, until duration seconds have
+    passed or until interrupted (Ctrl-C). Returns the number of polls.
+
+    A poll that changed nothing costs the transfer and a bytes comparison, so the registers
+    are sampled at close to the USB control transfer rate.
+    """
+    read = probe.get_fusb303_regs
+    regs = bytes(read())
+    if len(regs) != len(REGISTERS):
+        raise Exception(f"Expected {len(REGISTERS)} registers, got {len(regs)} instead")
+    start_ns = time.monotonic_ns()
+    end_ns = start_ns + int(duration * 1e9) if duration else None
+    out(f"{0:12.6f}  " + "  ".join(f"{register.name}=0x{reg:02X}" for register, reg in zip(REGISTERS, regs)))
+    polls = 1
+    last_ns = start_ns
+    try:
+        while end_ns is None or last_ns < end_ns:
+            if interval:
+                time.sleep(max(0.0, interval - (time.monotonic_ns() - last_ns) / 1e9))
+            new_regs = bytes(read())
+            last_ns = time.monotonic_ns()
+            polls += 1
+            if new_regs == regs:
+                continue
+            changes = register_changes(regs, new_regs)
+            regs = new_regs
+            out(f"{(last_ns - start_ns) / 1e9:12.6f}  " + ", ".join(format_change(c) for c in changes))
+    finally:
+        elapsed_s = (last_ns - start_ns) / 1e9
+        if elapsed_s > 0:
+            out(f"{polls} polls in {elapsed_s:.2f}s ({polls / elapsed_s:.0f}/s)")
+    return polls
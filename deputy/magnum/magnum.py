@@ -1,58 +1,266 @@
-
-from enum import IntEnum
 import struct
 
+import usb1
 from recom import RecomDevice
-from recom.util import get_serial_port_list
+from recom.backend.backend import RecomDeviceDescriptor
+from recom.backend.usb import find_device_by_id
 from recom.exceptions import RecomDeviceException
 
+from deputy.magnum.cache import ProbeCache, find_usb_paths, tty_on_usb_path, usb_device_id, usb_path_to_ports
+from deputy.magnum.defs import (MAGNUM_VID_PIDS, MagnumCtrlOpcode, MagnumPowerCtrl, MagnumProbeInfo,
+                                MagnumTargetPresence, MagnumTelemetry)
+from deputy.magnum.stream import MagnumStream
+
+
+def _is_stall(e: RecomDeviceException.TransportException) -> bool:
+    """True if the wrapped USB error is a stall (LIBUSB_ERROR_PIPE)"""
+    return any(isinstance(arg, usb1.USBErrorPipe) for arg in e.args)
+
 
-class MagnumCtrlOpcode(IntEnum):
-    POWER_STATE         = 0
-    POWER_CTRL          = 1
-    TARGET_VOLTAGE      = 2
-    TARGET_CURRENT      = 3
-    TARGET_PRESENCE     = 4
-    TARGET_REFERENCE    = 5
-    FUSB303_REGS        = 0xF0
+def _usb_path_key(usb_path: str) -> tuple:
+    """Sort key of a USB path, by bus and then port numbers"""
+    try:
+        return usb_path_to_ports(usb_path)
+    except ValueError:
+        return (-1, [])
 
-class MagnumPowerCtrl(IntEnum):
-    AUTOMATIC   = 0
-    FORCE_ON    = 1
-    FORCE_OFF   = 2
 
-class MagnumTargetPresence(IntEnum):
-    NONE            = 0
-    DEBUG_HEADER    = 1
-    USB             = 2
+def _close_device(device):
+    """Closes a RecomDevice that was opened only to look at it"""
+    device._comsBackend.close()
+
 
 class MagnumProbe():
     
-    KNOWN_VID_PID = ["2e8a:db60"]
+    KNOWN_VID_PID = MAGNUM_VID_PIDS
     ITF_ID = 0xDB
     ITF_PROT = 0x00
 
-    def __init__(self):
-        try:
-            self.device = RecomDevice(id=self.KNOWN_VID_PID[0])
-        except RecomDeviceException.AccessDenied:
-            raise Exception("Access denied!")
-        except Exception as e:
-            raise e
+    def __init__(self, serial: str = None, descriptor=None, use_cache: bool = True):
+        """
+        Opens a Magnum probe.
+
+        If serial is given, opens the probe with that serial number (or the only probe whose
+        serial number contains it). If descriptor is given, opens the probe described by that
+        RecomDeviceDescriptor. Otherwise opens the only connected probe.
+
+        Unless use_cache is False, the probe discovery cache (see deputy.magnum.cache) is
+        tried first, and only if that misses are the connected probes scanned.
+        """
+        self._serial = None
+        self._cache = ProbeCache() if use_cache else None
+        self.device = None
+        if descriptor is not None:
+            self.device = self._open_device(descriptor)
+        elif self._cache is not None:
+            self.device = self._open_from_cache(serial)
+
+        if self.device is None and serial is not None:
+            self.device = self._open_by_serial(serial, self._cache)
+        elif self.device is None:
+            try:
+                self.device = RecomDevice(id=self.KNOWN_VID_PID[0])
+            except RecomDeviceException.AccessDenied:
+                raise Exception("Access denied!")
+            except RecomDeviceException.MultipleDevicesFound:
+                raise Exception("Multiple Magnum devices found! Select one by serial number")
+            except RecomDeviceException.NoDeviceFound:
+                raise Exception("No Magnum device found!")
         if self.device is None:
             raise Exception("No Magnum device found!")
         self.interface = self.device.getInterfaceHandleFromID((self.ITF_ID, self.ITF_PROT))
         if self.interface is None:
             raise Exception("No Magnum control interface found!")
-        
-    def get_target_serial_port(self):
-        serial_ports = get_serial_port_list(self.device)
-        if len(serial_ports) == 1:
-            return serial_ports[0]
-        elif len(serial_ports) > 1:
-            return None
+        # None until the first get_telemetry() call tells us if the firmware has the opcode
+        self._telemetry_supported = None
+        if self._cache is not None:
+            self._cache.update(self.serial, usb_path=self.device.device_path,
+                               vid_pid=self.KNOWN_VID_PID[0])
+
+    def _open_from_cache(self, serial: str):
+        """Opens the probe at the USB path stored in the cache. Returns None on a cache miss"""
+        if serial is not None:
+            cached = self._cache.get(serial)
         else:
+            # Without a serial number the cache only helps if there is exactly one probe
+            usb_paths = []
+            for vid_pid in self.KNOWN_VID_PID:
+                paths = find_usb_paths(vid_pid)
+                if paths is None:
+                    return None
+                usb_paths += paths
+            if len(usb_paths) != 1:
+                return None
+            cached = self._cache.find_by_usb_path(usb_paths[0])
+        if cached is None:
+            return None
+
+        cached_serial, entry = cached
+        usb_path = entry.get("usb_path")
+        vid_pid = entry.get("vid_pid")
+        if usb_path is None or vid_pid is None or usb_device_id(usb_path) != vid_pid:
+            return None
+        vid, pid = (int(x, 16) for x in vid_pid.split(":"))
+        descriptor = RecomDeviceDescriptor("usb", (vid, pid), (usb_path_to_ports(usb_path)[1],))
+        try:
+            device = RecomDevice(device=descriptor)
+        except RecomDeviceException.AccessDenied:
+            raise Exception("Access denied!")
+        except Exception:
+            return None
+        # Make sure it's still the same probe, and not just one with the same VID:PID
+        if device.device_path != usb_path or device.get_serial() != cached_serial:
             return None
+        self._serial = cached_serial
+        return device
+
+    @classmethod
+    def _find_descriptors(cls):
+        descriptors = []
+        for vid_pid in cls.KNOWN_VID_PID:
+            descriptors.extend(find_device_by_id(vid_pid) or [])
+        # Sort by USB port path so the order doesn't depend on the bus enumeration order
+        return sorted(descriptors, key=lambda d: list(d.dev_path[0]))
+
+    @staticmethod
+    def _open_device(descriptor):
+        try:
+            return RecomDevice(device=descriptor)
+        except RecomDeviceException.AccessDenied:
+            raise Exception("Access denied!")
+
+    @staticmethod
+    def _try_open(descriptor):
+        """
+        Opens the device and reads its serial number. Returns (device, serial, None), or
+        (None, None, reason) if it can't be opened (i.e. no access rights, or another process
+        has it)
+        """
+        try:
+            device = RecomDevice(device=descriptor)
+        except RecomDeviceException.AccessDenied:
+            return None, None, "Access denied!"
+        except usb1.USBErrorBusy:
+            return None, None, "Busy (in use by another process)"
+        except Exception as e:
+            # i.e. RecomDeviceException.Generic, or it was unplugged while we were looking
+            return None, None, f"Unable to open ({e})"
+        try:
+            return device, device.get_serial(), None
+        except Exception as e:
+            _close_device(device)
+            return None, None, f"Unable to open ({e})"
+
+    @classmethod
+    def _open_by_serial(cls, serial: str, cache: ProbeCache = None):
+        """
+        Opens the probe whose serial number is (or contains) serial. Probes that can't be
+        opened are skipped, and only reported if no probe matches.
+        """
+        matches = []
+        errors = []
+        for descriptor in cls._find_descriptors():
+            device, device_serial, error = cls._try_open(descriptor)
+            if device is None:
+                errors.append(error)
+                continue
+            if cache is not None:
+                # We had to open the probe anyway, so remember where it is
+                cache.update(device_serial, usb_path=device.device_path,
+                             vid_pid="%04x:%04x" % descriptor.dev_id)
+            if device_serial == serial:
+                for other in matches:
+                    _close_device(other)
+                return device
+            if serial in device_serial:
+                matches.append(device)
+            else:
+                # Don't keep the interface claimed, or opening it again later fails with Busy
+                _close_device(device)
+        if len(matches) == 1:
+            return matches[0]
+        for device in matches:
+            _close_device(device)
+        if len(matches) > 1:
+            raise Exception(f"Multiple Magnum devices match serial number {serial}!")
+        # The probe may be one of those we couldn't open
+        if "Access denied!" in errors:
+            raise Exception("Access denied!")
+        if errors:
+            raise Exception(f"No Magnum device with serial number {serial} found! "
+                            f"{len(errors)} device(s) couldn't be checked: {', '.join(sorted(set(errors)))}")
+        raise Exception(f"No Magnum device with serial number {serial} found!")
+
+    @staticmethod
+    def _descriptor_usb_path(descriptor) -> str:
+        """
+        Returns the '<bus>-<port>.<port>' USB path of the device, like device.device_path, but
+        without opening it (descriptors don't have the bus number)
+        """
+        ports = list(descriptor.dev_path[0])
+        for usb_path in find_usb_paths("%04x:%04x" % descriptor.dev_id) or []:
+            if usb_path_to_ports(usb_path)[1] == ports:
+                return usb_path
+        # No sysfs. Ask libusb
+        with usb1.USBContext() as ctx:
+            for dev in ctx.getDeviceList():
+                if dev.getPortNumberList() == ports and (dev.getVendorID(), dev.getProductID()) == descriptor.dev_id:
+                    return f"{dev.getBusNumber()}-{'.'.join(map(str, ports))}"
+        return "?-" + ".".join(map(str, ports))
+
+    @classmethod
+    def enumerate(cls) -> list:
+        """
+        Returns a MagnumProbeInfo for every connected Magnum probe, sorted by USB path.
+
+        Probes that can't be opened (i.e. no access rights, or busy because another process
+        has them) are listed with a serial number and revisions of None, and the reason in
+        error.
+        """
+        probes = []
+        cache = ProbeCache()
+        for descriptor in cls._find_descriptors():
+            device, serial, error = cls._try_open(descriptor)
+            if device is None:
+                probes.append(MagnumProbeInfo(None, cls._descriptor_usb_path(descriptor), None, None, None,
+                                              descriptor, error))
+                continue
+            info = MagnumProbeInfo(serial, device.device_path, device.hw_id, device.hw_revision,
+                                   device.fw_revision, descriptor)
+            _close_device(device)
+            cache.update(info.serial, usb_path=info.usb_path, vid_pid="%04x:%04x" % descriptor.dev_id)
+            probes.append(info)
+        return sorted(probes, key=lambda info: _usb_path_key(info.usb_path))
+
+    @property
+    def serial(self) -> str:
+        if self._serial is None:
+            self._serial = self.device.get_serial()
+        return self._serial
+
+    def get_info(self) -> MagnumProbeInfo:
+        return MagnumProbeInfo(self.serial, self.device.device_path, self.device.hw_id,
+                               self.device.hw_revision, self.device.fw_revision, None)
+
+    def close(self):
+        """Releases the USB device, so it can be opened by another process"""
+        _close_device(self.device)
+
+    def get_target_serial_port(self):
+        cache = self._cache
+        if cache is not None:
+            cached = cache.get(self.serial)
+            if cached is not None:
+                entry = cached[1]
+                if entry.get("tty") and tty_on_usb_path(entry["tty"], entry.get("usb_path", "")):
+                    return entry["tty"]
+
+        from deputy.serialmon.serialmon import PortRegistry
+        serial_ports = PortRegistry().find_by_usb_path(self.device.device_path)
+        port = serial_ports[0].path if len(serial_ports) == 1 else None
+        if cache is not None and port is not None:
+            cache.update(self.serial, tty=port)
+        return port
 
     def get_power_state(self) -> bool:
         data = self.interface.controlRead(request=MagnumCtrlOpcode.POWER_STATE)
@@ -87,7 +295,55 @@ class MagnumProbe():
         data = self.interface.controlRead(request=MagnumCtrlOpcode.TARGET_REFERENCE)
         target_vref, = struct.unpack("<H", data)
         return target_vref
-    
+
+    def get_telemetry(self) -> MagnumTelemetry:
+        """
+        Returns power state, power control, target voltage/current/presence and VREF in a
+        single control transfer.
+
+        Older firmware doesn't know the TELEMETRY opcode and stalls the request. In that case
+        the values are collected with the individual per-opcode reads instead, and the
+        fallback is remembered for all subsequent calls.
+        """
+        if self._telemetry_supported is not False:
+            try:
+                data = self.interface.controlRead(request=MagnumCtrlOpcode.TELEMETRY,
+                                                  dataLen=MagnumTelemetry.STRUCT.size)
+            except RecomDeviceException.TransportException as e:
+                # Only a stall means the opcode is unknown, other errors aren't the firmware's
+                if self._telemetry_supported or not _is_stall(e):
+                    raise
+                data = None
+            if data is not None and len(data) == MagnumTelemetry.STRUCT.size:
+                self._telemetry_supported = True
+                return MagnumTelemetry.from_bytes(data)
+            self._telemetry_supported = False
+        return MagnumTelemetry(self.get_power_state(),
+                               self.get_power_ctrl(),
+                               self.get_target_voltage(),
+                               self.get_target_current(),
+                               self.get_target_presence(),
+                               self.get_target_reference())
+
+    def get_target_voltage_current(self):
+        """
+        Returns a (voltage mV, current mA) tuple. Uses a single TELEMETRY transfer when the
+        firmware supports it, otherwise two separate reads.
+        """
+        if self._telemetry_supported is False:
+            return self.get_target_voltage(), self.get_target_current()
+        telemetry = self.get_telemetry()
+        return telemetry.voltage_mv, telemetry.current_ma
+
+    def stream(self, rate_hz: float, batch_size: int = None, duration: float = None,
+               start_ns: int = None, presence: bool = False) -> MagnumStream:
+        """
+        Returns a MagnumStream sampling target voltage and current at rate_hz.
+
+        Iterate over the returned stream to get batches of time.monotonic_ns() stamped
+        samples. See MagnumStream for details on scheduling and overrun reporting.
+        """
+        return MagnumStream(self, rate_hz, batch_size, duration, start_ns, presence)
 
     def get_fusb303_regs(self):
         return self.interface.controlRead(request=MagnumCtrlOpcode.FUSB303_REGS)
@@ -0,0 +1,136 @@
+from array import array
+import time
+
+
+class MagnumSampleBatch:
+    """
+    A batch of voltage/current samples taken by a MagnumStream.
+
+    Timestamps are time.monotonic_ns() values taken at the midpoint of each sample's USB
+    transfer. Voltage is in mV, current in mA. ticks holds the number of the deadline each
+    sample was scheduled for. missed and overruns count the deadlines that were skipped and
+    the samples that completed late while this batch was being collected. presence is the
+    target presence read at the end of the batch if the stream was asked to, None otherwise.
+    """
+
+    __slots__ = ("ticks", "timestamps", "voltage", "current", "missed", "overruns", "presence")
+
+    def __init__(self):
+        self.ticks = array("q")
+        self.timestamps = array("q")
+        self.voltage = array("H")
+        self.current = array("H")
+        self.missed = 0
+        self.overruns = 0
+        self.presence = None
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __repr__(self):
+        return f"MagnumSampleBatch(samples={len(self)}, missed={self.missed}, overruns={self.overruns})"
+
+
+class MagnumStream:
+    """
+    Fixed-rate voltage/current sampler for a Magnum probe.
+
+    Samples are scheduled on absolute deadlines (start + n * period) on the monotonic clock,
+    so the sample rate doesn't drift with the time spent in USB transfers or by the consumer.
+    If a sample completes after the next deadline it is counted as an overrun, and any
+    deadlines that have already passed are skipped (and counted as missed) instead of being
+    sampled back-to-back to catch up.
+
+    Iterating over the stream yields MagnumSampleBatch objects of up to batch_size samples.
+    The stream ends after duration seconds (if given) or once stop() has been called.
+
+    By default the schedule starts with the first read. Streams given the same start_ns
+    (a time.monotonic_ns() value) and rate share their deadlines, which lets samples of
+    different probes be lined up by tick.
+
+    With presence, the target presence is read after every batch, between two samples, so
+    consumers don't have to make transfers of their own on the probe while it's streaming.
+    """
+
+    def __init__(self, probe, rate_hz: float, batch_size: int = None, duration: float = None,
+                 start_ns: int = None, presence: bool = False):
+        if rate_hz <= 0:
+            raise ValueError(f"Invalid sample rate {rate_hz}")
+        self.probe = probe
+        self.rate_hz = rate_hz
+        self.period_ns = round(1e9 / rate_hz)
+        # By default, hand out about 10 batches per second
+        self.batch_size = batch_size if batch_size else max(1, int(rate_hz // 10))
+        self.duration = duration
+        self.presence = presence
+
+        self.start_ns = start_ns
+        self.samples = 0
+        self.missed = 0
+        self.overruns = 0
+
+        self._tick = 0
+        self._end_ns = None
+        self._stopped = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> MagnumSampleBatch:
+        batch = self.read_batch()
+        if len(batch) == 0:
+            raise StopIteration
+        return batch
+
+    def stop(self):
+        """Ends the stream. Safe to call from another thread."""
+        self._stopped = True
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped
+
+    def read_batch(self) -> MagnumSampleBatch:
+        """Samples until the batch is full or the stream ends and returns the batch"""
+        if self.start_ns is None:
+            self.start_ns = time.monotonic_ns()
+        if self.duration is not None and self._end_ns is None:
+            self._end_ns = self.start_ns + round(self.duration * 1e9)
+
+        batch = MagnumSampleBatch()
+        period = self.period_ns
+        while len(batch) < self.batch_size and not self._stopped:
+            deadline = self.start_ns + self._tick * period
+            if self._end_ns is not None and deadline >= self._end_ns:
+                self._stopped = True
+                break
+
+            delay = deadline - time.monotonic_ns()
+            if delay > 0:
+                time.sleep(delay / 1e9)
+
+            t_start = time.monotonic_ns()
+            voltage, current = self.probe.get_target_voltage_current()
+            t_end = time.monotonic_ns()
+
+            batch.ticks.append(self._tick)
+            batch.timestamps.append((t_start + t_end) // 2)
+            batch.voltage.append(voltage)
+            batch.current.append(current)
+
+            self._tick += 1
+            next_deadline = self.start_ns + self._tick * period
+            if t_end > next_deadline:
+                # Too late for the next deadline. Skip every deadline that has already passed
+                batch.overruns += 1
+                skipped = (t_end - next_deadline) // period + 1
+                batch.missed += skipped
+                self._tick += skipped
+
+        if self.presence and len(batch):
+            batch.presence = int(self.probe.get_target_presence())
+
+        self.samples += len(batch)
+        self.missed += batch.missed
+        self.overruns += batch.overruns
+        return batch
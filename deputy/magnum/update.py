@@ -0,0 +1,356 @@
+"""
+Firmware update of Magnum probes.
+
+Every probe goes through the same phases, and all probes are updated in parallel:
+
+  reboot     reset into the bootloader, until it enumerates at the probe's USB path
+  mount      until the bootloader's mass storage drive is mounted
+  copy       write the image to the drive and fsync() it
+  verify     read the image back (see below)
+  restart    until the probe enumerates again with the new firmware, and getFwRev()
+
+Waiting is event driven (see deputy.hotplug): USB devices are waited for with the hotplug
+watcher and mounts by polling /proc/self/mounts for changes, instead of sleeping and
+rescanning. The image is checked before any probe is rebooted (UF2 images block by block),
+and exactly the bytes that were checked are written.
+
+UF2 bootloaders flash the image as it's written and reboot as soon as the last block lands,
+so there's nothing to read back: for them the restart with the new firmware revision is the
+verification. Other images are read back from the drive, past the page cache, and compared.
+"""
+
+import hashlib
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from deputy.magnum.cache import usb_device_id
+from deputy.magnum.defs import MAGNUM_VID_PIDS
+
+UF2_BLOCK = struct.Struct("<IIIIIIII476sI")
+UF2_MAGIC_START0 = 0x0A324655
+UF2_MAGIC_START1 = 0x9E5D5157
+UF2_MAGIC_END = 0x0AB16F30
+UF2_FLAG_NOT_MAIN_FLASH = 0x00000001
+
+REBOOT_TIMEOUT_S = 10
+MOUNT_TIMEOUT_S = 15
+RESTART_TIMEOUT_S = 20
+# Without automounting, mount the drive ourselves after this long
+AUTOMOUNT_WAIT_S = 3
+
+PHASES = ["reboot", "mount", "copy", "verify", "restart"]
+
+
+class FirmwareImage:
+    """A firmware image, read and checked once for all probes"""
+
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            raise Exception(f"Cannot find the firmware file {path}")
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path, "rb") as f:
+            self.data = f.read()
+        if not self.data:
+            raise Exception(f"Firmware file {path} is empty")
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        self.is_uf2 = self.data[:4] == struct.pack("<I", UF2_MAGIC_START0)
+        self.blocks = self._check_uf2() if self.is_uf2 else None
+
+    def _check_uf2(self) -> int:
+        if len(self.data) % UF2_BLOCK.size:
+            raise Exception(f"{self.name} is not a valid UF2 file (size isn't a multiple of 512)")
+        blocks = {}
+        for pos in range(0, len(self.data), UF2_BLOCK.size):
+            (magic0, magic1, flags, _, _, block_no, num_blocks, family, _,
+             magic_end) = UF2_BLOCK.unpack_from(self.data, pos)
+            if magic0 != UF2_MAGIC_START0 or magic1 != UF2_MAGIC_START1 or magic_end != UF2_MAGIC_END:
+                raise Exception(f"{self.name} is not a valid UF2 file (bad block at offset {pos})")
+            if flags & UF2_FLAG_NOT_MAIN_FLASH:
+                continue
+            # A file can hold images for several families, each numbering its own blocks
+            numbered = blocks.setdefault(family, (num_blocks, set()))
+            if num_blocks != numbered[0] or block_no >= num_blocks:
+                raise Exception(f"{self.name} is not a valid UF2 file (inconsistent block numbers)")
+            numbered[1].add(block_no)
+        for num_blocks, seen in blocks.values():
+            if len(seen) != num_blocks:
+                raise Exception(f"{self.name} is truncated ({len(seen)} of {num_blocks} blocks)")
+        return len(self.data) // UF2_BLOCK.size
+
+
+def _block_devices(usb_path: str) -> list:
+    """Returns the /dev nodes of the disks and partitions of the USB device at usb_path"""
+    devices = []
+    try:
+        names = os.listdir("/sys/block")
+    except OSError:
+        return devices
+    for name in names:
+        if f"/{usb_path}:" not in os.path.realpath(os.path.join("/sys/block", name, "device")):
+            continue
+        devices.append(f"/dev/{name}")
+        devices.extend(f"/dev/{part}" for part in os.listdir(os.path.join("/sys/block", name))
+                       if part.startswith(name))
+    return devices
+
+
+def _mount_point(devices: list):
+    with open("/proc/self/mounts") as f:
+        for line in f:
+            source, mount_point = line.split()[:2]
+            if source in devices:
+                # Spaces and such are octal escaped
+                return mount_point.encode().decode("unicode_escape")
+    return None
+
+
+def _try_mount(devices: list):
+    """Mounts the drive with udisksctl (as a desktop would), if that's available"""
+    import shutil
+    import subprocess
+    udisksctl = shutil.which("udisksctl")
+    if udisksctl is None:
+        return
+    # The partition if there is one, the whole disk otherwise
+    for device in reversed(devices):
+        result = subprocess.run([udisksctl, "mount", "--no-user-interaction", "-b", device],
+                                capture_output=True)
+        if result.returncode == 0:
+            return
+
+
+def wait_for_mount(usb_path: str, timeout: float):
+    """Returns the mount point of the USB drive at usb_path once it's mounted, or None on timeout"""
+    deadline = time.monotonic() + timeout
+    tried_mount = False
+    started = time.monotonic()
+    with open("/proc/self/mounts") as mounts:
+        poller = select.poll()
+        # The mount table signals POLLPRI (and POLLERR) when it changes
+        poller.register(mounts, select.POLLPRI | select.POLLERR)
+        while True:
+            devices = _block_devices(usb_path)
+            if devices:
+                mount_point = _mount_point(devices)
+                if mount_point is not None:
+                    return mount_point
+                if not tried_mount and time.monotonic() - started >= AUTOMOUNT_WAIT_S:
+                    tried_mount = True
+                    _try_mount(devices)
+                    continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            # The block device shows up before its mount. It's quick, so check again soon
+            poller.poll(min(remaining, 0.25 if not devices else 1.0) * 1000)
+
+
+def _wait_usb(watcher, usb_path: str, predicate, timeout: float):
+    """
+    Waits until the device at usb_path has a VID:PID for which predicate(vid_pid) is True and
+    returns that VID:PID, or None on timeout. Events only wake us up: the device is checked
+    in sysfs, so nothing is missed whatever the hotplug backend.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        vid_pid = usb_device_id(usb_path)
+        if vid_pid is not None and predicate(vid_pid):
+            return vid_pid
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        watcher.poll(min(remaining, 0.5))
+
+
+def _write_synced(path, data, may_vanish: bool = False):
+    """
+    Writes data to path and fsync()s it. With may_vanish, the drive is allowed to go away
+    once all the data was written (a UF2 bootloader reboots as soon as it has the last block),
+    so fsync() and close() failing then isn't an error.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            n = os.write(fd, view)
+            view = view[n:]
+        try:
+            os.fsync(fd)
+        except OSError:
+            if not may_vanish:
+                raise
+    finally:
+        try:
+            os.close(fd)
+        except OSError:
+            if not may_vanish:
+                raise
+
+
+def _read_back(path) -> bytes:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            # Drop the pages we just wrote, so the data is read from the drive itself
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        chunks = []
+        while True:
+            chunk = os.read(fd, 1 << 20)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+
+
+class ProbeUpdate:
+    """The update of one probe: its phases' durations, and how it went"""
+
+    def __init__(self, serial: str, usb_path: str, old_rev=None, error=None):
+        self.serial = serial
+        self.usb_path = usb_path
+        self.old_rev = old_rev
+        self.new_rev = None
+        self.bootloader = None
+        self.mount_point = None
+        self.verified = None
+        # The bootloader is up, but the image has to be copied by hand (no mount detection)
+        self.manual_copy = False
+        self.timings = {}
+        self.error = error
+        self._phase = None
+        self._phase_start = None
+
+    def _start(self, phase, log):
+        now = time.monotonic()
+        if self._phase is not None:
+            self.timings[self._phase] = now - self._phase_start
+        self._phase, self._phase_start = phase, now
+        if phase is not None:
+            log(f"{self.serial}: {phase}")
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def total(self) -> float:
+        return sum(self.timings.values())
+
+    def run(self, probe, image: FirmwareImage, log=print):
+        """Updates probe (a MagnumProbe, closed once it's in the bootloader) with image"""
+        from deputy.hotplug import HotplugWatcher
+        # Watch before rebooting, so no event is missed
+        watcher = HotplugWatcher()
+        try:
+            self._start("reboot", log)
+            old_vid_pid = usb_device_id(self.usb_path)
+            probe.device.reset(2)
+            probe.close()
+            self.bootloader = _wait_usb(watcher, self.usb_path, lambda vp: vp != old_vid_pid, REBOOT_TIMEOUT_S)
+            if self.bootloader is None:
+                raise Exception(f"Bootloader didn't show up within {REBOOT_TIMEOUT_S}s")
+
+            if not sys.platform.startswith("linux"):
+                self._start(None, log)
+                self.manual_copy = True
+                return self
+
+            self._start("mount", log)
+            self.mount_point = wait_for_mount(self.usb_path, MOUNT_TIMEOUT_S)
+            if self.mount_point is None:
+                raise Exception(f"Bootloader drive wasn't mounted within {MOUNT_TIMEOUT_S}s")
+
+            self._start("copy", log)
+            dest = os.path.join(self.mount_point, image.name)
+            _write_synced(dest, image.data, may_vanish=image.is_uf2)
+
+            self._start("verify", log)
+            if not image.is_uf2:
+                read = _read_back(dest)
+                if hashlib.sha256(read).hexdigest() != image.sha256:
+                    raise Exception(f"Read back of {dest} doesn't match {image.name}")
+                self.verified = "read back"
+
+            self._start("restart", log)
+            vid_pid = _wait_usb(watcher, self.usb_path, lambda vp: vp in MAGNUM_VID_PIDS, RESTART_TIMEOUT_S)
+            if vid_pid is None:
+                raise Exception(f"Probe didn't restart within {RESTART_TIMEOUT_S}s")
+            from deputy.magnum.magnum import MagnumProbe
+            restarted = _open_when_ready(MagnumProbe, self.usb_path, vid_pid)
+            try:
+                if restarted.serial != self.serial:
+                    raise Exception(f"Restarted as probe {restarted.serial}")
+                self.new_rev = restarted.device.getFwRev()
+            finally:
+                restarted.close()
+            if self.verified is None:
+                self.verified = "restarted"
+            self._start(None, log)
+        except Exception as e:
+            self._start(None, log)
+            self.error = str(e)
+        finally:
+            watcher.close()
+        return self
+
+
+def _open_when_ready(probe_class, usb_path: str, vid_pid: str, timeout: float = 5):
+    """
+    Opens the probe at usb_path (like the daemon's rescan, without looking at every probe's
+    serial number), retrying while its USB interface is still being set up
+    """
+    from recom.backend.backend import RecomDeviceDescriptor
+    from deputy.magnum.cache import usb_path_to_ports
+    vid, pid = (int(x, 16) for x in vid_pid.split(":"))
+    descriptor = RecomDeviceDescriptor("usb", (vid, pid), (usb_path_to_ports(usb_path)[1],))
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return probe_class(descriptor=descriptor)
+        except Exception:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+
+def update_probes(probes, image: FirmwareImage, max_workers: int = 16, log=print) -> list:
+    """Updates the MagnumProbes in parallel. Returns a ProbeUpdate per probe"""
+    updates = [ProbeUpdate(probe.serial, probe.device.device_path, probe.device.getFwRev())
+               for probe in probes]
+    lock = threading.Lock()
+
+    def locked_log(text):
+        with lock:
+            log(text)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(probes)))) as pool:
+        return list(pool.map(lambda pair: pair[0].run(pair[1], image, locked_log), zip(updates, probes)))
+
+
+def print_update_report(updates: list, image: FirmwareImage):
+    print(f"\n{image.name} ({len(image.data)} bytes, sha256 {image.sha256[:16]}...)")
+    header = f"{'Probe':<20} {'USB':<10} " + " ".join(f"{p:>8}" for p in PHASES) + f" {'total':>8}  Result"
+    print(header)
+    for update in updates:
+        phases = " ".join(f"{update.timings[p]:7.2f}s" if p in update.timings else f"{'-':>8}"
+                          for p in PHASES)
+        if update.manual_copy:
+            result = f"Manual copy required: copy {image.name} to the drive that just showed up"
+        elif update.ok:
+            result = f"OK {update.old_rev} -> {update.new_rev} ({update.verified})"
+            if update.new_rev == update.old_rev:
+                result += ", same revision as before"
+        else:
+            result = f"FAILED: {update.error}"
+        print(f"{update.serial:<20} {update.usb_path:<10} {phases} {update.total:7.2f}s  {result}")
+    failed = sum(1 for u in updates if not u.ok)
+    manual = sum(1 for u in updates if u.manual_copy)
+    print(f"{len(updates) - failed - manual} of {len(updates)} probe(s) updated" +
+          (f", {manual} waiting for a manual copy" if manual else ""))
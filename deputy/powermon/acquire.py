@@ -0,0 +1,73 @@
+import queue
+import threading
+
+
+class AcquisitionThread(threading.Thread):
+    """
+    Runs a MagnumStream on a dedicated thread and hands its sample batches to consumers
+    through a bounded queue.
+
+    The acquisition side never blocks on the consumer. If the queue is full, the oldest
+    batch is dropped to make room and counted in dropped_batches/dropped_samples, so a slow
+    consumer can't disturb the sample timing.
+    """
+
+    def __init__(self, probe, rate_hz: float, batch_size: int = None, duration: float = None,
+                 max_batches: int = 256, start_ns: int = None, presence: bool = False):
+        super().__init__(daemon=True)
+        self.stream = probe.stream(rate_hz, batch_size, duration, start_ns, presence=presence)
+        self.queue = queue.Queue(maxsize=max_batches)
+        self.dropped_batches = 0
+        self.dropped_samples = 0
+        self.error = None
+
+    def run(self):
+        try:
+            for batch in self.stream:
+                self._put(batch)
+        except Exception as e:
+            self.error = e
+        finally:
+            # Wake up any consumer blocked in get()
+            self._put(None)
+
+    def _put(self, batch):
+        while True:
+            try:
+                self.queue.put_nowait(batch)
+                return
+            except queue.Full:
+                try:
+                    old = self.queue.get_nowait()
+                except queue.Empty:
+                    continue
+                if old is not None:
+                    self.dropped_batches += 1
+                    self.dropped_samples += len(old)
+
+    def stop(self, timeout: float = None):
+        """Stops the stream and waits for the thread to finish"""
+        self.stream.stop()
+        if self.is_alive():
+            self.join(timeout)
+
+    def drain(self) -> list:
+        """Returns all batches that are currently queued, without blocking"""
+        batches = []
+        while True:
+            try:
+                batch = self.queue.get_nowait()
+            except queue.Empty:
+                return batches
+            if batch is not None:
+                batches.append(batch)
+
+    def get(self, timeout: float = None):
+        """
+        Returns the next batch, blocking for up to timeout seconds. Returns None once the
+        stream has ended (or on timeout).
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
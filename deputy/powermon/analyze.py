@@ -0,0 +1,164 @@
+import json
+import math
+
+import numpy as np
+
+from deputy.powermon.capture import CaptureReader
+
+DEFAULT_PERCENTILES = (50, 90, 99, 99.9)
+
+
+def _percentile_from_histogram(cumulative, p):
+    """Nearest-rank percentile of integer samples, given their cumulative histogram"""
+    n = cumulative[-1]
+    rank = max(1, int(np.ceil(p / 100 * n)))
+    return int(np.searchsorted(cumulative, rank, side="left"))
+
+
+def _probe_prefixes(capture) -> list:
+    """Returns the column name prefixes ('SERIAL.') of the probes of a fleet capture"""
+    return [name[:-len("t_ns")] for name in capture.column_names if name.endswith(".t_ns")]
+
+
+def _probe_prefix(capture, probe):
+    """Returns the column name prefix of a probe in a fleet capture"""
+    prefixes = _probe_prefixes(capture)
+    matches = [p for p in prefixes if p == f"{probe}."] or [p for p in prefixes if probe in p]
+    if len(matches) == 0:
+        raise Exception(f"No probe {probe} in {capture.path}. Available: "
+                        + ", ".join(p[:-1] for p in prefixes))
+    if len(matches) > 1:
+        raise Exception(f"Multiple probes match {probe} in {capture.path}")
+    return matches[0]
+
+
+def analyze_capture(path, start_s: float = None, end_s: float = None,
+                    percentiles=DEFAULT_PERCENTILES, chunk_samples: int = 1 << 22,
+                    probe: str = None) -> dict:
+    """
+    Computes summary statistics of a power capture file, optionally limited to the time
+    range [start_s, end_s) in seconds from the start of the capture.
+
+    The capture is memory-mapped and processed in chunks of chunk_samples samples, so the
+    file size is not limited by the available RAM. Voltage and current are integers (mV/mA),
+    so percentiles are computed exactly from a histogram instead of sorting the samples.
+    Charge and energy are integrated with the trapezoidal rule over the sample timestamps.
+
+    For fleet captures (see deputy.magnum.fleet), probe selects the probe by serial number.
+    Its rows are one per sample deadline, and deadlines the probe missed are skipped.
+    """
+    capture = CaptureReader(path)
+    if probe is None:
+        if "t_ns" not in capture.column_names and _probe_prefixes(capture):
+            raise Exception(f"{capture.path} is a fleet capture, select one with --probe (available: "
+                            + ", ".join(p[:-1] for p in _probe_prefixes(capture)) + ")")
+        prefix = ""
+        start = capture.time_to_index(start_s) if start_s is not None else 0
+        stop = capture.time_to_index(end_s) if end_s is not None else capture.num_samples
+    else:
+        prefix = _probe_prefix(capture, probe)
+        # Fleet rows are sample deadlines, so the row index follows from the rate
+        start = max(0, math.ceil(start_s * capture.rate_hz)) if start_s is not None else 0
+        stop = max(0, math.ceil(end_s * capture.rate_hz)) if end_s is not None else capture.num_samples
+    names = [prefix + "t_ns", prefix + "voltage_mv", prefix + "current_ma"]
+
+    n = 0
+    current_hist = np.zeros(1 << 16, dtype=np.int64)
+    current_sum = current_sq_sum = voltage_sum = 0.0
+    voltage_min = current_min = None
+    voltage_max = current_max = None
+    charge_mas = 0.0    # mA * s
+    energy_mws = 0.0    # mW * s
+    first_t = last_t = None
+    prev = None
+
+    for chunk in capture.chunks(names, start, stop, chunk_samples):
+        t, v, i = (chunk[name] for name in names)
+        if prefix:
+            valid = t != 0
+            t, v, i = t[valid], v[valid], i[valid]
+        if len(t) == 0:
+            continue
+
+        n += len(t)
+        current_hist += np.bincount(i, minlength=1 << 16)
+        i_f = i.astype(np.float64)
+        v_f = v.astype(np.float64)
+        current_sum += i_f.sum()
+        current_sq_sum += np.dot(i_f, i_f)
+        voltage_sum += v_f.sum()
+        current_min = min(int(i.min()), current_min) if current_min is not None else int(i.min())
+        current_max = max(int(i.max()), current_max) if current_max is not None else int(i.max())
+        voltage_min = min(int(v.min()), voltage_min) if voltage_min is not None else int(v.min())
+        voltage_max = max(int(v.max()), voltage_max) if voltage_max is not None else int(v.max())
+
+        # Include the last sample of the previous chunk so the interval between chunks is
+        # integrated as well
+        p_f = v_f * i_f / 1000
+        t_s = t / 1e9
+        if prev is not None:
+            t_s = np.concatenate(([prev[0]], t_s))
+            i_f = np.concatenate(([prev[1]], i_f))
+            p_f = np.concatenate(([prev[2]], p_f))
+        if len(t_s) > 1:
+            dt = np.diff(t_s)
+            charge_mas += np.dot(dt, (i_f[1:] + i_f[:-1]) / 2)
+            energy_mws += np.dot(dt, (p_f[1:] + p_f[:-1]) / 2)
+        prev = (t_s[-1], i_f[-1], p_f[-1])
+
+        if first_t is None:
+            first_t = int(t[0])
+        last_t = int(t[-1])
+
+    result = {
+        "file": str(path),
+        "label": prefix[:-1] if prefix else capture.label,
+        "samples": n,
+    }
+    if n == 0:
+        return result
+
+    duration_s = (last_t - first_t) / 1e9
+    cumulative = np.cumsum(current_hist)
+    result.update({
+        "start_s": (first_t - capture.start_mono_ns) / 1e9,
+        "duration_s": duration_s,
+        "voltage_mv": {
+            "min": voltage_min,
+            "max": voltage_max,
+            "mean": voltage_sum / n,
+        },
+        "current_ma": {
+            "min": current_min,
+            "max": current_max,
+            "mean": current_sum / n,
+            "rms": float(np.sqrt(current_sq_sum / n)),
+            "percentiles": {f"p{p:g}": _percentile_from_histogram(cumulative, p)
+                            for p in percentiles},
+        },
+        "charge_mah": charge_mas / 3600,
+        "energy_mwh": energy_mws / 3600,
+        "average_power_mw": energy_mws / duration_s if duration_s > 0 else 0.0,
+    })
+    return result
+
+
+def print_summary(summary: dict, as_json: bool = False):
+    if as_json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    print(f"File:\t\t{summary['file']}" + (f" ({summary['label']})" if summary["label"] else ""))
+    print(f"Samples:\t{summary['samples']}")
+    if summary["samples"] == 0:
+        return
+    print(f"Start:\t\t{summary['start_s']:.3f}s")
+    print(f"Duration:\t{summary['duration_s']:.3f}s")
+    v = summary["voltage_mv"]
+    print(f"Voltage:\tmin {v['min']}mV, max {v['max']}mV, mean {v['mean']:.1f}mV")
+    i = summary["current_ma"]
+    print(f"Current:\tmin {i['min']}mA, max {i['max']}mA, mean {i['mean']:.2f}mA, rms {i['rms']:.2f}mA")
+    print("Percentiles:\t" + ", ".join(f"{k} {val}mA" for k, val in i["percentiles"].items()))
+    print(f"Charge:\t\t{summary['charge_mah']:.4f}mAh")
+    print(f"Energy:\t\t{summary['energy_mwh']:.4f}mWh")
+    print(f"Avg. power:\t{summary['average_power_mw']:.2f}mW")
@@ -0,0 +1,274 @@
+"""
+Capture file format
+
+A capture file is an append-only sequence of fixed-size blocks following a small header:
+
+  Header:   magic, version, header size, column count, samples per block, sample rate,
+            wall clock and monotonic start time (ns), label, followed by one (name, dtype)
+            descriptor per column. Padded to a multiple of 64 bytes.
+  Block:    block magic, block index, sample count, followed by one fixed-width array of
+            samples-per-block values for each column (columnar layout). Padded to 8 bytes.
+
+Every block has the same size, so a reader can memory-map the whole file as an array of
+blocks. Only the last block can be partially filled (its sample count says how many values
+are valid). The writer periodically rewrites that last block in place while it fills up, so
+a crash only loses the samples since the last flush. A block that was cut short by a crash
+is simply ignored by the reader.
+"""
+
+import os
+import struct
+import time
+
+import numpy as np
+
+CAPTURE_MAGIC = b"DPCAP\x00\x00\x00"
+# Version 2 widened the column names (fleet captures prefix them with the probe serial)
+CAPTURE_VERSION = 2
+BLOCK_MAGIC = b"DPBK"
+
+HEADER_STRUCT = struct.Struct("<8sHHHHIIdqq32s")
+COLUMN_STRUCT = struct.Struct("<56s8s")
+# Column descriptor of each version the reader supports
+COLUMN_STRUCTS = {1: struct.Struct("<24s8s"), 2: COLUMN_STRUCT}
+
+# Default block size. 4096 samples of the power columns is a 48 KiB write
+DEFAULT_BLOCK_SAMPLES = 4096
+
+# Columns of a Magnum power capture
+POWER_COLUMNS = [("t_ns", "<i8"), ("voltage_mv", "<u2"), ("current_ma", "<u2")]
+
+
+class CaptureFormatException(Exception):
+    pass
+
+
+def _block_dtype(columns, block_samples):
+    fields = [("magic", "S4"), ("index", "<u4"), ("count", "<u4"), ("reserved", "<u4")]
+    fields += [(name, dtype, (block_samples,)) for name, dtype in columns]
+    dtype = np.dtype(fields)
+    padding = -dtype.itemsize % 8
+    if padding:
+        dtype = np.dtype(fields + [("padding", f"V{padding}")])
+    return dtype
+
+
+class CaptureWriter:
+    """
+    Writes samples to a capture file.
+
+    Samples are collected in a preallocated block buffer and written out with a single
+    write() as soon as a block is full, so memory use is constant no matter how long the
+    capture runs. The partially filled block is flushed to disk every flush_interval seconds
+    and by close().
+    """
+
+    def __init__(self, path, columns=POWER_COLUMNS, rate_hz: float = 0.0, label: str = "",
+                 block_samples: int = DEFAULT_BLOCK_SAMPLES, start_mono_ns: int = None,
+                 start_wall_ns: int = None, flush_interval: float = 1.0):
+        self.path = path
+        self.columns = [(name, np.dtype(dtype).str) for name, dtype in columns]
+        self.block_samples = block_samples
+        self.rate_hz = rate_hz
+        self.label = label
+        self.start_wall_ns = start_wall_ns if start_wall_ns is not None else time.time_ns()
+        self.start_mono_ns = start_mono_ns if start_mono_ns is not None else time.monotonic_ns()
+        self.samples = 0
+
+        self._block_dtype = _block_dtype(self.columns, block_samples)
+        self._block = np.zeros(1, dtype=self._block_dtype)
+        self._views = [self._block[name][0] for name, _ in self.columns]
+        self._index = 0
+        self._fill = 0
+        self._flush_interval_ns = round(flush_interval * 1e9)
+        self._last_flush_ns = time.monotonic_ns()
+
+        self._file = open(path, "wb", buffering=0)
+        header = self._pack_header()
+        self._file.write(header)
+        self._block_pos = len(header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _pack_header(self) -> bytes:
+        header = HEADER_STRUCT.pack(CAPTURE_MAGIC, CAPTURE_VERSION, 0, len(self.columns), 0,
+                                    self.block_samples, 0, self.rate_hz, self.start_wall_ns,
+                                    self.start_mono_ns, self.label.encode("utf-8")[:32])
+        for name, dtype in self.columns:
+            header += COLUMN_STRUCT.pack(name.encode("utf-8"), dtype.encode("ascii"))
+        header += bytes(-len(header) % 64)
+        # Fill in the header size now that we know it
+        return header[:10] + struct.pack("<H", len(header)) + header[12:]
+
+    def write(self, *columns):
+        """Appends samples. Takes one array-like per column, all of the same length"""
+        if len(columns) != len(self.columns):
+            raise ValueError(f"Expected {len(self.columns)} columns, got {len(columns)}")
+        columns = [np.asarray(c) for c in columns]
+        n = len(columns[0])
+        pos = 0
+        while pos < n:
+            take = min(n - pos, self.block_samples - self._fill)
+            for view, data in zip(self._views, columns):
+                view[self._fill:self._fill + take] = data[pos:pos + take]
+            self._fill += take
+            pos += take
+            if self._fill == self.block_samples:
+                self._write_block()
+        self.samples += n
+        if self._fill and time.monotonic_ns() - self._last_flush_ns >= self._flush_interval_ns:
+            self.flush()
+
+    def flush(self):
+        """Writes the partially filled block to disk. It gets overwritten once it fills up"""
+        if self._fill == 0:
+            return
+        block = self._block[0]
+        block["magic"] = BLOCK_MAGIC
+        block["index"] = self._index
+        block["count"] = self._fill
+        self._file.seek(self._block_pos)
+        self._file.write(self._block.data)
+        self._last_flush_ns = time.monotonic_ns()
+
+    def write_batch(self, batch):
+        """Appends a MagnumSampleBatch to a power capture"""
+        self.write(batch.timestamps, batch.voltage, batch.current)
+
+    def _write_block(self):
+        block = self._block[0]
+        block["magic"] = BLOCK_MAGIC
+        block["index"] = self._index
+        block["count"] = self._fill
+        self._file.seek(self._block_pos)
+        self._file.write(self._block.data)
+        self._block_pos += self._block_dtype.itemsize
+        self._index += 1
+        self._fill = 0
+        self._last_flush_ns = time.monotonic_ns()
+
+    def close(self):
+        if self._file is None:
+            return
+        if self._fill:
+            # Clear out stale samples from the previous block before writing the partial one
+            for view in self._views:
+                view[self._fill:] = 0
+            self._write_block()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+
+class CaptureReader:
+    """
+    Memory-maps a capture file for reading.
+
+    blocks is a NumPy structured array with one record per complete block. Column data is
+    best read through chunks(), which hands out the valid samples of a range of blocks as
+    flat arrays.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(HEADER_STRUCT.size)
+            if len(header) < HEADER_STRUCT.size:
+                raise CaptureFormatException(f"{path} is not a capture file (too short)")
+            (magic, version, header_size, num_columns, _, self.block_samples, _, self.rate_hz,
+             self.start_wall_ns, self.start_mono_ns, label) = HEADER_STRUCT.unpack(header)
+            if magic != CAPTURE_MAGIC:
+                raise CaptureFormatException(f"{path} is not a capture file")
+            column_struct = COLUMN_STRUCTS.get(version)
+            if column_struct is None:
+                raise CaptureFormatException(f"Unsupported capture file version {version}")
+            self.label = label.rstrip(b"\x00").decode("utf-8", errors="replace")
+            self.columns = []
+            for _ in range(num_columns):
+                name, dtype = column_struct.unpack(f.read(column_struct.size))
+                self.columns.append((name.rstrip(b"\x00").decode("utf-8"),
+                                     dtype.rstrip(b"\x00").decode("ascii")))
+        self.header_size = header_size
+
+        block_dtype = _block_dtype(self.columns, self.block_samples)
+        num_blocks = (os.path.getsize(path) - header_size) // block_dtype.itemsize
+        if num_blocks > 0:
+            blocks = np.memmap(path, dtype=block_dtype, mode="r", offset=header_size,
+                               shape=(num_blocks,))
+            # Blocks that were never completely written (i.e. crash) don't have a valid magic
+            invalid = np.flatnonzero(blocks["magic"] != BLOCK_MAGIC)
+            if len(invalid):
+                blocks = blocks[:invalid[0]]
+        else:
+            blocks = np.zeros(0, dtype=block_dtype)
+        self.blocks = blocks
+        counts = self.blocks["count"].astype(np.int64)
+        # Index of the first sample of every block
+        self.block_offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.num_samples = int(self.block_offsets[-1])
+
+    @property
+    def column_names(self):
+        return [name for name, _ in self.columns]
+
+    def chunks(self, names=None, start: int = 0, stop: int = None, chunk_samples: int = 1 << 20):
+        """
+        Yields dictionaries of column name -> flat array for consecutive chunks of samples in
+        the range [start, stop), reading about chunk_samples values per column at a time.
+        """
+        names = names or self.column_names
+        stop = self.num_samples if stop is None else min(stop, self.num_samples)
+        blocks_per_chunk = max(1, chunk_samples // self.block_samples)
+        first_block = int(np.searchsorted(self.block_offsets, start, side="right")) - 1
+        block = max(first_block, 0)
+        while block < len(self.blocks):
+            block_start = int(self.block_offsets[block])
+            if block_start >= stop:
+                break
+            end_block = min(block + blocks_per_chunk, len(self.blocks))
+            chunk = self.blocks[block:end_block]
+            counts = chunk["count"]
+            full = bool(np.all(counts == self.block_samples))
+            data = {}
+            for name in names:
+                values = chunk[name]
+                if full:
+                    values = values.reshape(-1)
+                else:
+                    values = np.concatenate([v[:c] for v, c in zip(values, counts)])
+                lo = max(start - block_start, 0)
+                hi = min(stop - block_start, len(values))
+                data[name] = values[lo:hi]
+            yield data
+            block = end_block
+
+    def read(self, names=None, start: int = 0, stop: int = None) -> dict:
+        """Reads a range of samples into memory. Use chunks() for large captures"""
+        names = names or self.column_names
+        parts = {name: [] for name in names}
+        for chunk in self.chunks(names, start, stop):
+            for name in names:
+                parts[name].append(chunk[name])
+        return {name: np.concatenate(p) if p else np.zeros(0, dtype=dict(self.columns)[name])
+                for name, p in parts.items()}
+
+    def time_to_index(self, t_s: float, column: str = "t_ns") -> int:
+        """
+        Returns the index of the first sample at or after t_s seconds from the start of the
+        capture. Relies on the timestamps being sorted, which lets it work one block at a time.
+        """
+        target = self.start_mono_ns + round(t_s * 1e9)
+        if len(self.blocks) == 0:
+            return 0
+        # First timestamp of every block, then a search within the block
+        firsts = self.blocks[column][:, 0]
+        block = int(np.searchsorted(firsts, target, side="right")) - 1
+        if block < 0:
+            return 0
+        count = int(self.blocks["count"][block])
+        idx = int(np.searchsorted(self.blocks[column][block][:count], target, side="left"))
+        return int(self.block_offsets[block]) + idx
@@ -2,14 +2,24 @@ import tkinter as tk
 from tkinter import ttk
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.animation import FuncAnimation
 import numpy as np
 import platform
 
 from deputy.magnum.magnum import MagnumPowerCtrl
+from deputy.powermon.acquire import AcquisitionThread
+from deputy.powermon.ringbuffer import RingBuffer
+from deputy.powermon.stats import PowerAccumulator
 
-MAX_DATAPOINTS = 200
-UPDATE_RATE_HZ = 10
+SAMPLE_RATE_HZ = 100
+FRAME_RATE_HZ = 25
+FRAME_INTERVAL_MS = 1000 // FRAME_RATE_HZ
+WINDOW_S = 10
+MAX_DATAPOINTS = SAMPLE_RATE_HZ * WINDOW_S
+STATS_INTERVAL_MS = 250
+
+STATS_COLUMNS = ["Time (s)", "Charge (mAh)", "Energy (mWh)", "Mean (mA)", "RMS (mA)",
+                 "Peak (mA)", "p50 (mA)", "p99 (mA)", "Power (mW)"]
+STATS_ROWS = ["Total", "Lap", "Last lap"]
 
 class MagnumVIPlot:
     def __init__(self, tk_root, probe):
@@ -38,14 +48,14 @@ class MagnumVIPlot:
         self.auto_voltage_var = tk.BooleanVar(value=False)
         self.auto_voltage_check = ttk.Checkbutton(
             self.controls_frame, text="Auto Voltage Range",
-            variable=self.auto_voltage_var, command=self.update_plot
+            variable=self.auto_voltage_var, command=self.on_limits_changed
         )
         self.auto_voltage_check.pack(side=tk.LEFT, padx=5)
 
         self.auto_current_var = tk.BooleanVar(value=False)
         self.auto_current_check = ttk.Checkbutton(
             self.controls_frame, text="Auto Current Range",
-            variable=self.auto_current_var, command=self.update_plot
+            variable=self.auto_current_var, command=self.on_limits_changed
         )
         self.auto_current_check.pack(side=tk.LEFT, padx=5)
 
@@ -59,68 +69,141 @@ class MagnumVIPlot:
         self.auto_button = ttk.Button(self.controls_frame, text="Auto", command=self.auto_callback)
         self.auto_button.pack(side=tk.LEFT, expand=True)
 
+        self.reset_button = ttk.Button(self.controls_frame, text="Reset", command=self.reset_callback)
+        self.reset_button.pack(side=tk.LEFT, expand=True)
+
+        self.lap_button = ttk.Button(self.controls_frame, text="Lap", command=self.lap_callback)
+        self.lap_button.pack(side=tk.LEFT, expand=True)
+
+        self.status_label = ttk.Label(self.controls_frame, text="")
+        self.status_label.pack(side=tk.RIGHT, padx=5)
+
+        # Statistics panel between the plots and the controls
+        self.stats_frame = ttk.Frame(self.root)
+        self.stats_frame.pack(side=tk.BOTTOM, fill=tk.X)
+        for col, name in enumerate(STATS_COLUMNS):
+            ttk.Label(self.stats_frame, text=name).grid(row=0, column=col + 1, padx=5)
+        self.stats_labels = {}
+        for row, name in enumerate(STATS_ROWS):
+            ttk.Label(self.stats_frame, text=name).grid(row=row + 1, column=0, padx=5, sticky=tk.W)
+            self.stats_labels[name] = []
+            for col in range(len(STATS_COLUMNS)):
+                label = ttk.Label(self.stats_frame, text="-")
+                label.grid(row=row + 1, column=col + 1, padx=5)
+                self.stats_labels[name].append(label)
+
+        self.total_stats = PowerAccumulator()
+        self.lap_stats = PowerAccumulator()
+
         self.ax[0].set_title("Voltage")
         self.ax[1].set_title("Current")
-        self.ax[0].set_ylim(0, 6)  # Example voltage range
-        self.ax[1].set_ylim(0, 5)  # Example current range
         self.ax[0].set_ylabel("Voltage (V)")
         self.ax[1].set_ylabel("Current (A)")
-        self.ax[1].set_xlabel("Time (s)")
-
-        self.x_data = []
-        self.voltage_data = []
-        self.current_data = []
-
-        # Create initial plot lines
-        self.voltage_line, = self.ax[0].plot([], [], color='blue')
-        self.current_line, = self.ax[1].plot([], [], color='red')
-
-        self.ani = FuncAnimation(self.fig, self.update_plot, interval=UPDATE_RATE_HZ)
-
-    def update_plot(self, frame = None):
-        if frame is not None:
-            new_time = frame / UPDATE_RATE_HZ
-            new_voltage = self.probe.get_target_voltage() / 1000
-            new_current = self.probe.get_target_current() / 1000
-
-            self.x_data.append(new_time)
-            self.voltage_data.append(new_voltage)
-            self.current_data.append(new_current)
-
-            if len(self.x_data) > MAX_DATAPOINTS:  # Keep the last MAX_DATAPOINTS data points
-                self.x_data = self.x_data[-MAX_DATAPOINTS:]
-                self.voltage_data = self.voltage_data[-MAX_DATAPOINTS:]
-                self.current_data = self.current_data[-MAX_DATAPOINTS:]
-
-        # Update the plot lines with the new data
-        self.voltage_line.set_data(self.x_data, self.voltage_data)
-        self.current_line.set_data(self.x_data, self.current_data)
-
-        # Update the plot limits
-        self.ax[0].set_xlim(self.x_data[0], self.x_data[-1])
-        self.ax[1].set_xlim(self.x_data[0], self.x_data[-1])
-
-        # Update y-axis range based on checkbox state
-        if self.auto_voltage_var.get():
-            y_min = min(self.voltage_data)
-            y_max = max(self.voltage_data)
-            self.ax[0].set_ylim(y_min, y_max)
-            #self.ax[0].relim()
-            #self.ax[0].autoscale_view()
+        self.ax[1].set_xlabel("Time relative to latest sample (s)")
+
+        self.x_data = RingBuffer(MAX_DATAPOINTS, dtype=np.int64)
+        self.voltage_data = RingBuffer(MAX_DATAPOINTS, track_extrema=True)
+        self.current_data = RingBuffer(MAX_DATAPOINTS, track_extrema=True)
+
+        # Create initial plot lines. They are animated, i.e. left out of regular canvas draws
+        # and blitted on top of a cached background instead
+        self.voltage_line, = self.ax[0].plot([], [], color='blue', animated=True)
+        self.current_line, = self.ax[1].plot([], [], color='red', animated=True)
+
+        # The x axis shows the time relative to the latest sample, so it never has to move
+        self.ax[0].set_xlim(-WINDOW_S, 0)
+        self.ax[1].set_xlim(-WINDOW_S, 0)
+        self.ax[0].set_ylim(0, 10)  # Fixed voltage range
+        self.ax[1].set_ylim(0, 10)  # Fixed current range
+
+        self.background = None
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+
+        # Sample on a separate thread so USB transfers and GUI redraws don't hold up each other
+        self.acquisition = AcquisitionThread(self.probe, SAMPLE_RATE_HZ)
+        self.acquisition.start()
+        self.root.after(FRAME_INTERVAL_MS, self.update_plot)
+        self.root.after(STATS_INTERVAL_MS, self.update_stats)
+
+    def on_draw(self, event):
+        """Called after every full canvas draw (i.e. resize, axis change) to grab the new background"""
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_lines()
+
+    def draw_lines(self):
+        self.ax[0].draw_artist(self.voltage_line)
+        self.ax[1].draw_artist(self.current_line)
+
+    def update_plot(self):
+        for batch in self.acquisition.drain():
+            self.x_data.extend(np.frombuffer(batch.timestamps, dtype=np.int64))
+            self.voltage_data.extend(np.frombuffer(batch.voltage, dtype=np.uint16) / 1000)
+            self.current_data.extend(np.frombuffer(batch.current, dtype=np.uint16) / 1000)
+            self.total_stats.add_batch(batch)
+            self.lap_stats.add_batch(batch)
+
+        if len(self.x_data):
+            # The voltage/current views are not copies of the buffers
+            x = (self.x_data.view() - self.x_data.last()) / 1e9
+            self.voltage_line.set_data(x, self.voltage_data.view())
+            self.current_line.set_data(x, self.current_data.view())
+
+        if self.update_limits() or self.background is None:
+            # Full redraw. on_draw() takes care of the lines
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_lines()
+            self.canvas.blit(self.fig.bbox)
+
+        stream = self.acquisition.stream
+        self.status_label.config(text=f"Samples: {stream.samples}  Missed: {stream.missed}  "
+                                      f"Overruns: {stream.overruns}  Dropped: {self.acquisition.dropped_samples}")
+        self.root.after(FRAME_INTERVAL_MS, self.update_plot)
+
+    def update_stats(self):
+        self._show_stats("Total", self.total_stats)
+        self._show_stats("Lap", self.lap_stats)
+        self.root.after(STATS_INTERVAL_MS, self.update_stats)
+
+    def _show_stats(self, row, stats):
+        if stats is None or stats.samples == 0:
+            values = ["-"] * len(STATS_COLUMNS)
         else:
-            self.ax[0].set_ylim(0, 10)  # Fixed voltage range
-
-        if self.auto_current_var.get():
-            y_min = min(self.current_data)
-            y_max = max(self.current_data)
-            self.ax[1].set_ylim(y_min, y_max)
-            #self.ax[1].relim()
-            #self.ax[1].autoscale_view()
+            values = [f"{stats.duration_s:.1f}", f"{stats.charge_mah:.4f}", f"{stats.energy_mwh:.4f}",
+                      f"{stats.mean_ma:.2f}", f"{stats.rms_ma:.2f}", f"{stats.peak_ma}",
+                      f"{stats.p50.value:.1f}", f"{stats.p99.value:.1f}", f"{stats.mean_power_mw:.2f}"]
+        for label, value in zip(self.stats_labels[row], values):
+            label.config(text=value)
+
+    def update_limits(self) -> bool:
+        """Updates the y-axis ranges based on the checkbox states. Returns True if any changed"""
+        changed = self._update_axis_limits(self.ax[0], self.voltage_data, self.auto_voltage_var.get())
+        changed |= self._update_axis_limits(self.ax[1], self.current_data, self.auto_current_var.get())
+        return changed
+
+    def _update_axis_limits(self, ax, data, auto) -> bool:
+        lo, hi = ax.get_ylim()
+        if not auto or len(data) == 0:
+            new_lim = (0, 10)
         else:
-            self.ax[1].set_ylim(0, 10)  # Fixed current range
+            y_min = data.min()
+            y_max = data.max()
+            # Only rescale when the data leaves the range or shrinks well inside it, so the
+            # background doesn't have to be redrawn on every frame
+            if lo <= y_min and y_max <= hi and (y_max - y_min) > (hi - lo) / 2:
+                return False
+            margin = max((y_max - y_min) * 0.1, 0.01)
+            new_lim = (y_min - margin, y_max + margin)
+        if new_lim == (lo, hi):
+            return False
+        ax.set_ylim(*new_lim)
+        return True
+
+    def on_limits_changed(self):
+        if self.update_limits():
+            self.canvas.draw_idle()
 
-        self.canvas.draw_idle()
-    
     def on_callback(self):
         self.probe.set_power_ctrl(MagnumPowerCtrl.FORCE_ON)
 
@@ -130,8 +213,18 @@ class MagnumVIPlot:
     def auto_callback(self):
         self.probe.set_power_ctrl(MagnumPowerCtrl.AUTOMATIC)
 
+    def reset_callback(self):
+        self.total_stats.reset()
+        self.lap_stats.reset()
+        self._show_stats("Last lap", None)
+
+    def lap_callback(self):
+        self._show_stats("Last lap", self.lap_stats)
+        self.lap_stats.reset()
+
     def on_closing(self):
         print("Closing the application...")
+        self.acquisition.stop(timeout=1)
         self.root.quit()
         self.root.destroy()
         #sys.exit()
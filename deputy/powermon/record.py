@@ -0,0 +1,48 @@
+import os
+import time
+
+from deputy.powermon.acquire import AcquisitionThread
+from deputy.powermon.capture import CaptureWriter, POWER_COLUMNS
+
+
+def record_power(probe, path, rate_hz: float, duration: float = None, label: str = ""):
+    """
+    Records target voltage and current to a capture file without a GUI.
+
+    Runs until duration seconds have passed or until interrupted (Ctrl-C). Either way, all
+    samples taken so far are written out and the file is closed properly.
+    """
+    writer = CaptureWriter(path, POWER_COLUMNS, rate_hz=rate_hz, label=label)
+    acquisition = AcquisitionThread(probe, rate_hz, duration=duration)
+    acquisition.start()
+    print(f"Recording to {path} at {rate_hz:g} Hz" +
+          (f" for {duration:g}s" if duration else " (Ctrl-C to stop)"))
+
+    last_status = time.monotonic()
+    try:
+        while True:
+            batch = acquisition.get(timeout=0.5)
+            if batch is None:
+                if not acquisition.is_alive():
+                    break
+                continue
+            writer.write_batch(batch)
+
+            now = time.monotonic()
+            if now - last_status >= 1:
+                last_status = now
+                print(f"\r{writer.samples} samples, {batch.voltage[-1]}mV, {batch.current[-1]}mA   ",
+                      end="", flush=True)
+    finally:
+        acquisition.stop()
+        for batch in acquisition.drain():
+            writer.write_batch(batch)
+        writer.close()
+        stream = acquisition.stream
+        print(f"\nRecorded {writer.samples} samples ({os.path.getsize(path)} bytes). "
+              f"Missed: {stream.missed}, overruns: {stream.overruns}, "
+              f"dropped: {acquisition.dropped_samples}")
+
+    if acquisition.error is not None:
+        raise acquisition.error
+    return writer.samples
@@ -0,0 +1,123 @@
+from collections import deque
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Fixed-capacity FIFO of numbers backed by a preallocated NumPy array.
+
+    Every value is stored twice, at position p and p + capacity of a 2 * capacity array.
+    This way the buffer contents (oldest first) are always available as one contiguous slice
+    of the array, and view() can hand them out without copying.
+
+    If track_extrema is set, the minimum and maximum of the buffer contents are maintained
+    incrementally with monotonic deques, so min()/max() are O(1) regardless of capacity.
+    """
+
+    def __init__(self, capacity: int, dtype=np.float64, track_extrema: bool = False):
+        if capacity <= 0:
+            raise ValueError(f"Invalid ring buffer capacity {capacity}")
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.track_extrema = track_extrema
+        self._buf = np.zeros(2 * capacity, dtype=self.dtype)
+        # Total number of values written since the last clear(). Doubles as sequence number
+        self._written = 0
+        # Monotonic deques of (sequence number, value) tuples
+        self._min = deque()
+        self._max = deque()
+
+    def __len__(self):
+        return min(self._written, self.capacity)
+
+    def clear(self):
+        self._written = 0
+        self._min.clear()
+        self._max.clear()
+
+    def append(self, value):
+        pos = self._written % self.capacity
+        self._buf[pos] = value
+        self._buf[pos + self.capacity] = value
+        if self.track_extrema:
+            self._track(self._written, self._buf[pos])
+        self._written += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        n = len(values)
+        if n == 0:
+            return
+        cap = self.capacity
+        first_seq = self._written
+        if n > cap:
+            # Only the last capacity values survive
+            first_seq += n - cap
+            values = values[-cap:]
+            n = cap
+
+        pos = first_seq % cap
+        head = min(n, cap - pos)
+        self._buf[pos:pos + head] = values[:head]
+        self._buf[pos + cap:pos + cap + head] = values[:head]
+        tail = n - head
+        if tail:
+            self._buf[0:tail] = values[head:]
+            self._buf[cap:cap + tail] = values[head:]
+
+        if self.track_extrema:
+            if n == cap:
+                self._min.clear()
+                self._max.clear()
+            for i, value in enumerate(values.tolist()):
+                self._track(first_seq + i, value)
+        self._written = first_seq + n
+
+    def view(self) -> np.ndarray:
+        """
+        Returns a read-only view of the buffer contents, oldest value first.
+
+        The view is not a copy, so it will change as new values are added.
+        """
+        count = len(self)
+        start = (self._written - count) % self.capacity
+        view = self._buf[start:start + count]
+        view.flags.writeable = False
+        return view
+
+    def last(self):
+        """Returns the most recently added value"""
+        if self._written == 0:
+            raise IndexError("Ring buffer is empty")
+        return self._buf[(self._written - 1) % self.capacity]
+
+    def min(self):
+        if not self.track_extrema:
+            return self.view().min()
+        if not self._min:
+            raise ValueError("Ring buffer is empty")
+        return self._min[0][1]
+
+    def max(self):
+        if not self.track_extrema:
+            return self.view().max()
+        if not self._max:
+            raise ValueError("Ring buffer is empty")
+        return self._max[0][1]
+
+    def _track(self, seq, value):
+        expired = seq - self.capacity
+        mins = self._min
+        while mins and mins[-1][1] >= value:
+            mins.pop()
+        mins.append((seq, value))
+        if mins[0][0] <= expired:
+            mins.popleft()
+
+        maxs = self._max
+        while maxs and maxs[-1][1] <= value:
+            maxs.pop()
+        maxs.append((seq, value))
+        if maxs[0][0] <= expired:
+            maxs.popleft()
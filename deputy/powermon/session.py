@@ -0,0 +1,272 @@
+"""
+Power and serial capture sessions.
+
+A session records the target's voltage/current and its serial port together, into one
+directory:
+
+  session.json       what was recorded: probe, port, rate and the session's start time
+  power.dcap         the power capture (see deputy.powermon.capture)
+  serial-*.bin       the serial data, as timestamped chunks (see deputy.serialmon.logger)
+
+Power samples and serial chunks are both stamped with time.monotonic_ns(), so they're on the
+same clock and a serial line can be matched with the samples taken while it was printed.
+A line's time is when the chunk holding its first byte was read, which is a few ms (the USB
+latency of the serial adapter) after the target sent it.
+"""
+
+import csv
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from deputy.powermon.acquire import AcquisitionThread
+from deputy.powermon.capture import CaptureReader, CaptureWriter, POWER_COLUMNS
+from deputy.serialmon.logger import RotatingLogWriter, SerialLogger, read_chunks
+
+SESSION_FILE = "session.json"
+POWER_FILE = "power.dcap"
+SESSION_VERSION = 1
+
+
+def _write_manifest(directory, manifest):
+    path = os.path.join(directory, SESSION_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def record_session(probe, directory, rate_hz: float, duration: float = None, baud: int = 115200,
+                   config: str = "8N1", port: str = None):
+    """
+    Records power and the probe's target serial port (or port) into directory until duration
+    seconds have passed or until interrupted (Ctrl-C).
+    """
+    port = port or probe.get_target_serial_port()
+    if port is None:
+        raise Exception("Unable to find probe serial port")
+    os.makedirs(directory, exist_ok=True)
+
+    start_mono_ns, start_wall_ns = time.monotonic_ns(), time.time_ns()
+    manifest = {"version": SESSION_VERSION, "probe": probe.serial, "port": port, "baud": baud,
+                "config": config, "rate_hz": rate_hz, "start_mono_ns": start_mono_ns,
+                "start_wall_ns": start_wall_ns, "power": POWER_FILE, "serial": []}
+    _write_manifest(directory, manifest)
+
+    power = CaptureWriter(os.path.join(directory, POWER_FILE), POWER_COLUMNS, rate_hz=rate_hz,
+                          label=probe.serial, start_mono_ns=start_mono_ns, start_wall_ns=start_wall_ns)
+    serial_writer = RotatingLogWriter(directory, "serial", "bin")
+    logger = SerialLogger(port, baud, config, serial_writer, binary=True)
+    logger_error = []
+
+    def run_logger():
+        try:
+            logger.run()
+        except Exception as e:
+            logger_error.append(e)
+
+    serial_thread = threading.Thread(target=run_logger, daemon=True)
+    acquisition = AcquisitionThread(probe, rate_hz, duration=duration, start_ns=start_mono_ns)
+    serial_thread.start()
+    acquisition.start()
+    print(f"Recording power at {rate_hz:g} Hz and {port} at {baud} to {directory}" +
+          (f" for {duration:g}s" if duration else " (Ctrl-C to stop)"))
+
+    last_status = time.monotonic()
+    try:
+        while True:
+            batch = acquisition.get(timeout=0.5)
+            if batch is None:
+                if not acquisition.is_alive() or logger_error:
+                    break
+                continue
+            power.write_batch(batch)
+
+            now = time.monotonic()
+            if now - last_status >= 1:
+                last_status = now
+                print(f"\r{power.samples} samples, {batch.current[-1]}mA, "
+                      f"{logger.rx_bytes} serial bytes   ", end="", flush=True)
+    finally:
+        acquisition.stop()
+        for batch in acquisition.drain():
+            power.write_batch(batch)
+        power.close()
+        logger.stop()
+        serial_thread.join()
+        logger.close()
+        manifest["serial"] = [os.path.basename(path) for path in serial_writer.segments]
+        manifest["samples"] = power.samples
+        manifest["serial_bytes"] = logger.rx_bytes
+        _write_manifest(directory, manifest)
+        print(f"\nRecorded {power.samples} samples and {logger.rx_bytes} serial bytes "
+              f"({logger.disconnects} disconnect(s)). Missed: {acquisition.stream.missed}, "
+              f"dropped: {acquisition.dropped_samples}")
+
+    if logger_error:
+        raise logger_error[0]
+    if acquisition.error is not None:
+        raise acquisition.error
+    return manifest
+
+
+class Session:
+    """A recorded session, with its serial output split into timestamped lines"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, SESSION_FILE)) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("version") != SESSION_VERSION:
+            raise Exception(f"Unsupported session version {self.manifest.get('version')}")
+        self.start_ns = self.manifest["start_mono_ns"]
+        self.power = CaptureReader(os.path.join(directory, self.manifest["power"]))
+        segments = self.manifest["serial"]
+        if not segments:
+            # The session didn't end cleanly. Take whatever serial data is there
+            segments = sorted(name for name in os.listdir(directory) if name.startswith("serial-"))
+        self.lines = self._read_lines([os.path.join(directory, name) for name in segments])
+        self.line_times = np.array([t for t, _ in self.lines], dtype=np.int64)
+
+    @staticmethod
+    def _read_lines(paths) -> list:
+        """Returns (monotonic ns of the first byte, text) for every serial line"""
+        lines = []
+        partial = bytearray()
+        partial_ns = 0
+        for path in paths:
+            for mono_ns, _, data in read_chunks(path):
+                pos = 0
+                while pos < len(data):
+                    if not partial:
+                        partial_ns = mono_ns
+                    end = data.find(b"\n", pos)
+                    if end < 0:
+                        partial += data[pos:]
+                        break
+                    partial += data[pos:end]
+                    lines.append((partial_ns, partial.decode(errors="replace").rstrip("\r")))
+                    partial.clear()
+                    pos = end + 1
+        if partial:
+            lines.append((partial_ns, partial.decode(errors="replace").rstrip("\r")))
+        return lines
+
+    def seconds(self, t_ns) -> float:
+        """Session time (seconds since the start) of a monotonic timestamp"""
+        return (t_ns - self.start_ns) / 1e9
+
+    def power_at(self, t_ns: int, window_ms: float = 100) -> dict:
+        """
+        Power around t_ns: the sample nearest to it, and mean/max current over window_ms
+        centered on it. Returns None if there are no samples then.
+        """
+        half_s = window_ms / 2000
+        t_s = self.seconds(t_ns)
+        start = self.power.time_to_index(t_s - half_s)
+        stop = max(self.power.time_to_index(t_s + half_s), start + 1)
+        samples = self.power.read(["t_ns", "voltage_mv", "current_ma"], start, stop)
+        if len(samples["t_ns"]) == 0:
+            return None
+        nearest = int(np.argmin(np.abs(samples["t_ns"] - t_ns)))
+        return {"t_ns": int(samples["t_ns"][nearest]),
+                "voltage_mv": int(samples["voltage_mv"][nearest]),
+                "current_ma": int(samples["current_ma"][nearest]),
+                "mean_ma": float(samples["current_ma"].mean()),
+                "max_ma": int(samples["current_ma"].max()),
+                "index": start + nearest}
+
+    def find_lines(self, pattern: str = None) -> list:
+        """Returns (line number, monotonic ns, text) of the lines matching the regex pattern"""
+        import re
+        regex = re.compile(pattern) if pattern else None
+        return [(n, t, text) for n, (t, text) in enumerate(self.lines, 1)
+                if regex is None or regex.search(text)]
+
+    def lines_between(self, start_ns: int, end_ns: int) -> list:
+        """Returns the (monotonic ns, text) lines printed in [start_ns, end_ns)"""
+        lo, hi = np.searchsorted(self.line_times, [start_ns, end_ns], side="left")
+        return self.lines[lo:hi]
+
+
+def print_session_lines(session: Session, pattern: str = None, window_ms: float = 100,
+                        context_ms: float = None):
+    """
+    Prints the serial lines (those matching pattern, if given), each with the power at the
+    time it was printed. With context_ms, the power trace around each line is printed too.
+    """
+    for n, t_ns, text in session.find_lines(pattern):
+        power = session.power_at(t_ns, window_ms)
+        if power is None:
+            power_str = "           no samples           "
+        else:
+            power_str = (f"{power['voltage_mv']:5d}mV {power['current_ma']:5d}mA "
+                         f"(avg {power['mean_ma']:7.1f} max {power['max_ma']:5d})")
+        print(f"{n:6d} {session.seconds(t_ns):11.6f}s  {power_str}  {text}")
+        if context_ms:
+            _print_trace(session, t_ns, context_ms)
+
+
+def _print_trace(session: Session, t_ns: int, context_ms: float, max_rows: int = 20):
+    t_s = session.seconds(t_ns)
+    start = session.power.time_to_index(t_s - context_ms / 1000)
+    stop = session.power.time_to_index(t_s + context_ms / 1000)
+    samples = session.power.read(["t_ns", "voltage_mv", "current_ma"], start, stop)
+    step = max(1, len(samples["t_ns"]) // max_rows)
+    for i in range(0, len(samples["t_ns"]), step):
+        dt_ms = (int(samples["t_ns"][i]) - t_ns) / 1e6
+        current = int(samples["current_ma"][i:i + step].max())
+        print(f"{'':6s} {dt_ms:+10.3f}ms  {int(samples['voltage_mv'][i]):5d}mV {current:5d}mA  "
+              + "#" * min(60, current // 2))
+
+
+def export_session_csv(session: Session, path, chunk_samples: int = 1 << 20):
+    """
+    Writes one merged, time ordered CSV: a row per power sample and a row per serial line,
+    with the session time in seconds in the first column
+    """
+    line_pos = 0
+    lines = session.lines
+    with open(path, "w", newline="") as f:
+        out = csv.writer(f)
+        out.writerow(["t_s", "voltage_mv", "current_ma", "serial"])
+        for chunk in session.power.chunks(["t_ns", "voltage_mv", "current_ma"], chunk_samples=chunk_samples):
+            t = chunk["t_ns"]
+            t_s = (t - session.start_ns) / 1e9
+            # Where this chunk's lines go between its samples
+            end = int(np.searchsorted(session.line_times, t[-1], side="right")) if len(t) else line_pos
+            insert_at = np.searchsorted(t, session.line_times[line_pos:end], side="left")
+            pos = 0
+            for k, at in enumerate(insert_at):
+                out.writerows(zip(np.round(t_s[pos:at], 6), chunk["voltage_mv"][pos:at].tolist(),
+                                  chunk["current_ma"][pos:at].tolist(), [""] * (at - pos)))
+                line_t, text = lines[line_pos + k]
+                out.writerow([f"{session.seconds(line_t):.6f}", "", "", text])
+                pos = at
+            out.writerows(zip(np.round(t_s[pos:], 6), chunk["voltage_mv"][pos:].tolist(),
+                              chunk["current_ma"][pos:].tolist(), [""] * (len(t) - pos)))
+            line_pos = end
+        for line_t, text in lines[line_pos:]:
+            out.writerow([f"{session.seconds(line_t):.6f}", "", "", text])
+
+
+def plot_session(session: Session, pattern: str = None, max_labels: int = 50):
+    """Plots the current with a marker at each serial line (those matching pattern, if given)"""
+    import matplotlib.pyplot as plt
+    samples = session.power.read(["t_ns", "current_ma"])
+    fig, ax = plt.subplots(figsize=(12, 6))
+    ax.plot((samples["t_ns"] - session.start_ns) / 1e9, samples["current_ma"], linewidth=0.8)
+    ax.set_xlabel("Time (s)")
+    ax.set_ylabel("Current (mA)")
+    ax.set_title(f"{session.manifest['probe']} / {session.manifest['port']}")
+    lines = session.find_lines(pattern)
+    for i, (n, t_ns, text) in enumerate(lines):
+        t_s = session.seconds(t_ns)
+        ax.axvline(t_s, color="tab:red", alpha=0.3, linewidth=0.8)
+        if i < max_labels:
+            ax.annotate(text[:40], (t_s, 1), xycoords=("data", "axes fraction"), rotation=90,
+                        va="top", ha="right", fontsize=7)
+    plt.tight_layout()
+    plt.show()
@@ -0,0 +1,157 @@
+import math
+
+
+class P2Quantile:
+    """
+    Streaming quantile estimate using the P-square algorithm (Jain & Chlamtac, 1985).
+
+    Keeps five markers instead of the samples, so memory and time per sample are O(1).
+    Up to the first five samples, the exact quantile of those samples is returned.
+    """
+
+    def __init__(self, p: float):
+        if not 0 < p < 1:
+            raise ValueError(f"Invalid quantile {p}")
+        self.p = p
+        self.reset()
+
+    def reset(self):
+        self._q = []                    # Marker heights
+        self._n = [0, 1, 2, 3, 4]       # Marker positions
+        p = self.p
+        self._np = [0, 2 * p, 4 * p, 2 + 2 * p, 4]      # Desired marker positions
+        self._dn = [0, p / 2, p, (1 + p) / 2, 1]        # Desired position increments
+        self.count = 0
+
+    def add(self, x):
+        self.count += 1
+        q = self._q
+        if self.count <= 5:
+            q.append(x)
+            if self.count == 5:
+                q.sort()
+            return
+
+        n = self._n
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        desired = self._np
+        for i in range(5):
+            desired[i] += self._dn[i]
+
+        # Adjust the middle markers if they are off their desired positions
+        for i in range(1, 4):
+            d = desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                qp = self._parabolic(i, d)
+                if not q[i - 1] < qp < q[i + 1]:
+                    qp = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = qp
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        q = self._q
+        n = self._n
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    @property
+    def value(self):
+        if self.count == 0:
+            return None
+        if self.count <= 5:
+            ordered = sorted(self._q)
+            return ordered[max(0, math.ceil(self.p * self.count) - 1)]
+        return self._q[2]
+
+
+class PowerAccumulator:
+    """
+    Running statistics of a voltage/current sample stream, updated in O(1) per sample.
+
+    Tracks charge (coulomb counting) and energy integrated with the trapezoidal rule over the
+    sample timestamps, mean and RMS current, peak current and streaming p50/p99 estimates.
+    """
+
+    def __init__(self):
+        self.p50 = P2Quantile(0.5)
+        self.p99 = P2Quantile(0.99)
+        self.reset()
+
+    def reset(self):
+        self.samples = 0
+        self.first_t_ns = None
+        self.last_t_ns = None
+        self.charge_mas = 0.0       # mA * s
+        self.energy_mws = 0.0       # mW * s
+        self.current_sum = 0.0
+        self.current_sq_sum = 0.0
+        self.peak_ma = None
+        self._last_current = None
+        self._last_power = None
+        self.p50.reset()
+        self.p99.reset()
+
+    def add(self, t_ns: int, voltage_mv: int, current_ma: int):
+        power_mw = voltage_mv * current_ma / 1000
+        if self.last_t_ns is None:
+            self.first_t_ns = t_ns
+        else:
+            dt = (t_ns - self.last_t_ns) / 1e9
+            self.charge_mas += dt * (current_ma + self._last_current) / 2
+            self.energy_mws += dt * (power_mw + self._last_power) / 2
+        self.last_t_ns = t_ns
+        self._last_current = current_ma
+        self._last_power = power_mw
+
+        self.samples += 1
+        self.current_sum += current_ma
+        self.current_sq_sum += current_ma * current_ma
+        if self.peak_ma is None or current_ma > self.peak_ma:
+            self.peak_ma = current_ma
+        self.p50.add(current_ma)
+        self.p99.add(current_ma)
+
+    def add_batch(self, batch):
+        """Adds all samples of a MagnumSampleBatch"""
+        for t_ns, voltage_mv, current_ma in zip(batch.timestamps, batch.voltage, batch.current):
+            self.add(t_ns, voltage_mv, current_ma)
+
+    @property
+    def duration_s(self) -> float:
+        if self.samples < 2:
+            return 0.0
+        return (self.last_t_ns - self.first_t_ns) / 1e9
+
+    @property
+    def charge_mah(self) -> float:
+        return self.charge_mas / 3600
+
+    @property
+    def energy_mwh(self) -> float:
+        return self.energy_mws / 3600
+
+    @property
+    def mean_ma(self) -> float:
+        return self.current_sum / self.samples if self.samples else 0.0
+
+    @property
+    def rms_ma(self) -> float:
+        return math.sqrt(self.current_sq_sum / self.samples) if self.samples else 0.0
+
+    @property
+    def mean_power_mw(self) -> float:
+        duration = self.duration_s
+        return self.energy_mws / duration if duration > 0 else 0.0
@@ -0,0 +1,264 @@
+import math
+import operator
+import os
+import re
+
+import numpy as np
+
+from deputy.powermon.acquire import AcquisitionThread
+from deputy.powermon.capture import CaptureWriter, POWER_COLUMNS
+from deputy.powermon.ringbuffer import RingBuffer
+
+_OPERATORS = {">": operator.gt, "<": operator.lt, ">=": operator.ge, "<=": operator.le}
+
+
+class Trigger:
+    """
+    Base class of all trigger conditions.
+
+    fires() gets the samples of a batch and returns a boolean array marking the samples at
+    which the trigger fires. Triggers fire on the edge, i.e. when their condition becomes
+    true, not for as long as it stays true.
+    """
+
+    needs_presence = False
+
+    def __init__(self, description: str):
+        self.description = description
+        self._prev_cond = False
+
+    def __repr__(self):
+        return self.description
+
+    def condition(self, t, v, i) -> np.ndarray:
+        raise NotImplementedError
+
+    def fires(self, t, v, i, presence=None) -> np.ndarray:
+        cond = self.condition(t, v, i)
+        prev = np.concatenate(([self._prev_cond], cond[:-1]))
+        self._prev_cond = bool(cond[-1])
+        return cond & ~prev
+
+
+class LevelTrigger(Trigger):
+    """Fires when voltage (mV) or current (mA) crosses a threshold, i.e. 'current>50'"""
+
+    def __init__(self, description, column, op, threshold):
+        super().__init__(description)
+        self.column = column
+        self.op = op
+        self.threshold = threshold
+
+    def condition(self, t, v, i):
+        values = v if self.column == "voltage" else i
+        return self.op(values.astype(np.float64), self.threshold)
+
+
+class SlopeTrigger(Trigger):
+    """Fires when the voltage or current slope (per ms) crosses a threshold, i.e. 'dv/dt>5'"""
+
+    def __init__(self, description, column, op, threshold):
+        super().__init__(description)
+        self.column = column
+        self.op = op
+        self.threshold = threshold
+        self._prev = None
+
+    def condition(self, t, v, i):
+        values = (v if self.column == "voltage" else i).astype(np.float64)
+        t = t.astype(np.float64)
+        if self._prev is None:
+            prev_t, prev_value = t[0], values[0]
+        else:
+            prev_t, prev_value = self._prev
+        self._prev = (t[-1], values[-1])
+        dt_ms = np.diff(t, prepend=prev_t) / 1e6
+        dv = np.diff(values, prepend=prev_value)
+        slope = np.divide(dv, dt_ms, out=np.zeros_like(dv), where=dt_ms > 0)
+        return self.op(slope, self.threshold) & (dt_ms > 0)
+
+
+class PresenceTrigger(Trigger):
+    """Fires when the target presence (see MagnumProbe.get_target_presence) changes"""
+
+    needs_presence = True
+
+    def __init__(self, description):
+        super().__init__(description)
+        self._presence = None
+
+    def fires(self, t, v, i, presence=None):
+        fired = np.zeros(len(t), dtype=bool)
+        if presence is not None:
+            if self._presence is not None and presence != self._presence:
+                # Presence is polled once per batch, so the change happened somewhere in it
+                fired[-1] = True
+            self._presence = presence
+        return fired
+
+
+def parse_trigger(spec: str) -> Trigger:
+    """
+    Creates a trigger from a string:
+
+      current>50, voltage<3000      Current (mA) or voltage (mV) crossing a level
+      di/dt>10, dv/dt<-5            Current (mA/ms) or voltage (mV/ms) slope crossing a level
+      presence                      Change of the target presence
+    """
+    spec = spec.strip().replace(" ", "")
+    if spec == "presence":
+        return PresenceTrigger(spec)
+    m = re.fullmatch(r"(current|voltage|i|v|di/dt|dv/dt)(>=|<=|>|<)(-?[0-9.]+)", spec)
+    if m is None:
+        raise ValueError(f"Invalid trigger '{spec}'")
+    what, op, threshold = m.group(1), _OPERATORS[m.group(2)], float(m.group(3))
+    if what.startswith("d"):
+        return SlopeTrigger(spec, "voltage" if what == "dv/dt" else "current", op, threshold)
+    return LevelTrigger(spec, "voltage" if what in ("voltage", "v") else "current", op, threshold)
+
+
+class _Event:
+    def __init__(self, number, reason, t_ns, pre, post_samples):
+        self.number = number
+        self.reason = reason
+        self.t_ns = t_ns
+        self.parts = [pre]
+        self.remaining = post_samples
+
+    def add(self, t, v, i):
+        self.parts.append((t, v, i))
+        self.remaining -= len(t)
+
+    def columns(self):
+        return [np.concatenate([p[c] for p in self.parts]) for c in range(3)]
+
+
+class TriggerEngine:
+    """
+    Watches a sample stream for trigger conditions and saves pre_ms before and post_ms after
+    each trigger to its own capture file in output_dir.
+
+    The samples leading up to a trigger are kept in a fixed-size ring buffer, so memory use
+    doesn't depend on how long the engine runs. Triggers are ignored while an event is being
+    recorded and for holdoff_ms after it.
+    """
+
+    def __init__(self, probe, triggers, rate_hz: float, pre_ms: float, post_ms: float,
+                 output_dir, holdoff_ms: float = 0, max_events: int = None):
+        self.probe = probe
+        self.triggers = triggers
+        self.rate_hz = rate_hz
+        self.pre_samples = max(1, math.ceil(pre_ms * rate_hz / 1000))
+        self.post_samples = max(1, math.ceil(post_ms * rate_hz / 1000))
+        self.output_dir = output_dir
+        self.holdoff_ns = round(holdoff_ms * 1e6)
+        self.max_events = max_events
+        self.events = []
+
+        self._pre = [RingBuffer(self.pre_samples, dtype) for dtype in (np.int64, np.uint16, np.uint16)]
+        self._event = None
+        self._holdoff_until = None
+        # The acquisition has to read the target presence along with the samples
+        self.needs_presence = any(trigger.needs_presence for trigger in triggers)
+        os.makedirs(output_dir, exist_ok=True)
+
+    @property
+    def done(self) -> bool:
+        return self.max_events is not None and len(self.events) >= self.max_events
+
+    def process(self, batch):
+        """Runs a MagnumSampleBatch through the triggers. Returns the paths of saved events"""
+        t = np.frombuffer(batch.timestamps, dtype=np.int64)
+        v = np.frombuffer(batch.voltage, dtype=np.uint16)
+        i = np.frombuffer(batch.current, dtype=np.uint16)
+        if len(t) == 0:
+            return []
+        # Read by the acquisition thread: the probe is busy streaming, so no transfers from here
+        presence = batch.presence
+
+        # Evaluate all triggers for the whole batch, so they see every sample exactly once
+        fired = np.zeros(len(t), dtype=bool)
+        reasons = []
+        for trigger in self.triggers:
+            f = trigger.fires(t, v, i, presence)
+            fired |= f
+            reasons.append(f)
+
+        saved = []
+        pos = 0
+        while pos < len(t) and not self.done:
+            if self._event is None:
+                candidates = np.flatnonzero(fired[pos:]) + pos
+                if self._holdoff_until is not None:
+                    candidates = candidates[t[candidates] >= self._holdoff_until]
+                end = int(candidates[0]) if len(candidates) else len(t)
+                self._push_pre(t[pos:end], v[pos:end], i[pos:end])
+                pos = end
+                if len(candidates):
+                    reason = ",".join(trig.description for trig, f in zip(self.triggers, reasons) if f[end])
+                    pre = tuple(buf.view().copy() for buf in self._pre)
+                    self._event = _Event(len(self.events) + 1, reason, int(t[end]), pre, self.post_samples)
+            else:
+                take = min(self._event.remaining, len(t) - pos)
+                segment = (t[pos:pos + take], v[pos:pos + take], i[pos:pos + take])
+                self._event.add(*segment)
+                self._push_pre(*segment)
+                pos += take
+                if self._event.remaining <= 0:
+                    saved.append(self._save_event())
+        if pos < len(t):
+            self._push_pre(t[pos:], v[pos:], i[pos:])
+        return saved
+
+    def flush(self):
+        """Saves an event that is still collecting post-trigger samples (i.e. at shutdown)"""
+        if self._event is not None:
+            return self._save_event()
+        return None
+
+    def _push_pre(self, t, v, i):
+        for buf, values in zip(self._pre, (t, v, i)):
+            buf.extend(values)
+
+    def _save_event(self):
+        event = self._event
+        self._event = None
+        t, v, i = event.columns()
+        self._holdoff_until = int(t[-1]) + self.holdoff_ns
+        path = os.path.join(self.output_dir, f"event_{event.number:04d}.cap")
+        with CaptureWriter(path, POWER_COLUMNS, rate_hz=self.rate_hz, label=event.reason,
+                           block_samples=max(len(t), 1), start_mono_ns=event.t_ns) as writer:
+            writer.write(t, v, i)
+        self.events.append(path)
+        print(f"Event {event.number}: {event.reason} -> {path} ({len(t)} samples)")
+        return path
+
+
+def run_triggers(probe, triggers, rate_hz: float, pre_ms: float, post_ms: float, output_dir,
+                 duration: float = None, holdoff_ms: float = 0, max_events: int = None):
+    """Samples headless and runs a TriggerEngine until duration, max_events or Ctrl-C"""
+    engine = TriggerEngine(probe, triggers, rate_hz, pre_ms, post_ms, output_dir, holdoff_ms, max_events)
+    acquisition = AcquisitionThread(probe, rate_hz, duration=duration, presence=engine.needs_presence)
+    acquisition.start()
+    print(f"Waiting for {', '.join(map(repr, triggers))} at {rate_hz:g} Hz (Ctrl-C to stop)")
+
+    try:
+        while not engine.done:
+            batch = acquisition.get(timeout=0.5)
+            if batch is None:
+                if not acquisition.is_alive():
+                    break
+                continue
+            engine.process(batch)
+    finally:
+        acquisition.stop()
+        for batch in acquisition.drain():
+            engine.process(batch)
+        engine.flush()
+        stream = acquisition.stream
+        print(f"{len(engine.events)} events in {stream.samples} samples. Missed: {stream.missed}, "
+              f"overruns: {stream.overruns}, dropped: {acquisition.dropped_samples}")
+
+    if acquisition.error is not None:
+        raise acquisition.error
+    return engine.events
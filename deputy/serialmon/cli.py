@@ -3,27 +3,38 @@ import colorama
 from colorama import Fore, Style
 import os
 import sys
+import time
 import traceback
 
-from deputy import __version__
-from deputy.serialmon.serialmon import SerialPort
+from deputy.serialmon.serialmon import PortRegistry, find_tty_users
 from deputy.serialmon.term import Term
+from deputy.util import VersionAction
 
 
 def serialmon_cli_print_port_list(verbose, check_availability):
     if os.name == "nt":
         colorama.init(convert=True)
-    port_list = SerialPort.get_port_list()
+    port_list = PortRegistry().ports
     if not port_list:
         print("No serial ports available.")
         return
+    # Find the processes using any of the ports in one go, instead of checking port by port
+    port_users = None
+    if check_availability and os.name == "posix":
+        port_users = find_tty_users(port.path for port in port_list)
     print("Available serial ports:")
     for i, port in enumerate(port_list):
         dev_str = f"{i+1}. {port.path}"
         if check_availability:
             print(dev_str, end='')
-            if port.is_available():
+            if port_users is None:
+                users = None if port.is_available() else []
+            else:
+                users = port_users[port.path] or None
+            if users is None:
                 print(Fore.GREEN + "\tAvailable")
+            elif users:
+                print(Fore.RED + "\tIn use by " + ", ".join(f"{name} ({pid})" for pid, name in users))
             else:
                 print(Fore.RED + "\tIn use")
             print(Style.RESET_ALL, end='')
@@ -33,29 +44,42 @@ def serialmon_cli_print_port_list(verbose, check_availability):
             print(f"\r\tDesc: {port.description}\n\r\tHWID: {port.hwid}")
 
 
-def serialmon_cli_open_port(port: str, serialnumber: str, baudrate: int, config: str, term: str):
-    port_list = SerialPort.get_port_list()
+def serialmon_cli_resolve_port(port: str, serialnumber: str):
+    """Returns the path of the port given by -p (path, name or number) or -s, or None"""
+    registry = PortRegistry()
     p_path = None
 
     if port is not None:
         # Try to get the port path from the port string
         if port.isdecimal():
             try:
-                p_path = SerialPort.get_port_path_from_ID(int(port) - 1)
+                p_path = registry[int(port) - 1].path
             except Exception as e:
                 print(f"ERROR: {port} is not a valid serial port ID ({e})")
         else:
             try:
-                p_path = SerialPort.validate_port_string(port)
+                p_path = registry.resolve(port)
             except Exception as e:
                 print(f"ERROR: {e}")
+            else:
+                if p_path is None and os.path.exists(port):
+                    # Not a listed serial port, but a tty all the same (i.e. a pty)
+                    p_path = port
+                elif p_path is None:
+                    print(f"ERROR: Serial port {port} not found")
     elif serialnumber is not None:
         # Try to get the port path from the serial number
         try:
-            p_path = SerialPort.get_port_path_from_serialnumber(serialnumber)
+            p_path = registry.find_by_serialnumber(serialnumber).path
         except Exception as e:
-            print("ERROR: {e}")
+            print(f"ERROR: {e}")
+    else:
+        print("ERROR: No port given (use -p or -s)")
+    return p_path
+
 
+def serialmon_cli_open_port(port: str, serialnumber: str, baudrate: int, config: str, term: str):
+    p_path = serialmon_cli_resolve_port(port, serialnumber)
     if p_path is not None:
         try:
             t = Term(p_path, baudrate, config, term)
@@ -66,14 +90,97 @@ def serialmon_cli_open_port(port: str, serialnumber: str, baudrate: int, config:
             t.start()
 
 
+def serialmon_cli_log(args):
+    p_path = serialmon_cli_resolve_port(args.port, args.serial)
+    if p_path is None:
+        return -1
+    from deputy.serialmon.logger import parse_duration, parse_size, run_logger
+    max_bytes = parse_size(args.max_size) if args.max_size else None
+    max_seconds = parse_duration(args.max_time) if args.max_time else None
+    return run_logger(p_path, args.baud, args.config, args.output or "serial-logs", args.binary,
+                      max_bytes, max_seconds, args.compress)
+
+
+def serialmon_cli_multi(args):
+    if os.name == "nt":
+        colorama.init(convert=True)
+    ports = []
+    for port in args.ports or []:
+        p_path = serialmon_cli_resolve_port(port, None)
+        if p_path is None:
+            return -1
+        ports.append(p_path)
+    for serialnumber in args.serials or []:
+        p_path = serialmon_cli_resolve_port(None, serialnumber)
+        if p_path is None:
+            return -1
+        ports.append(p_path)
+    if not ports:
+        print("ERROR: No ports given (use -p and/or -s, once per port)")
+        return -1
+
+    from deputy.serialmon.logger import parse_duration, parse_size
+    from deputy.serialmon.multi import MultiMonitor
+    max_bytes = parse_size(args.max_size) if args.max_size else None
+    max_seconds = parse_duration(args.max_time) if args.max_time else None
+    monitor = MultiMonitor([(path, os.path.basename(path)) for path in dict.fromkeys(ports)],
+                           args.baud, args.config, args.output, max_bytes, max_seconds,
+                           args.compress, color=sys.stdout.isatty())
+    print(f"Monitoring {len(monitor.ports)} ports" +
+          (f", logging to {args.output}" if args.output else "") + ". Press Ctrl-C to stop.")
+    try:
+        monitor.run()
+    except KeyboardInterrupt:
+        pass
+    for name, stats in monitor.stats().items():
+        print(f"{name}: {stats['rx']} bytes, {stats['disconnects']} disconnect(s)")
+    return 0
+
+
+def serialmon_cli_serve(args):
+    p_path = serialmon_cli_resolve_port(args.port, args.serial)
+    if p_path is None:
+        return -1
+    from deputy.serialmon.share import run_server
+    return run_server(p_path, args.baud, args.config, args.listen, args.write_policy, args.stats)
+
+
+def serialmon_cli_watch(verbose):
+    if os.name == "nt":
+        colorama.init(convert=True)
+    from deputy.hotplug import HotplugWatcher
+    watcher = HotplugWatcher()
+
+    def print_event(event):
+        t = time.time()
+        stamp = time.strftime("%H:%M:%S", time.localtime(t)) + f".{int(t * 1000) % 1000:03d}"
+        color, sign = (Fore.GREEN, "+") if event.action == "add" else (Fore.RED, "-")
+        if event.kind == "port":
+            details = f"\t{event.port.description}" if verbose else ""
+            print(f"{stamp} {color}{sign} {event.path}{Style.RESET_ALL}{details}")
+        elif event.kind == "probe" or verbose:
+            print(f"{stamp} {color}{sign} {event.kind} USB {event.path} ({event.vid_pid}){Style.RESET_ALL}")
+
+    print(f"Watching for serial ports and probes ({watcher.backend}). Press Ctrl-C to stop.")
+    for port in watcher.registry:
+        print(f"  {port.path}" + (f"\t{port.description}" if verbose else ""))
+    watcher.add_callback(print_event)
+    try:
+        watcher.run()
+    finally:
+        watcher.close()
+
+
 def cli(argv):
     parser = argparse.ArgumentParser(description="Serial monitor CLI.")
-    parser.add_argument("command", nargs="?", choices=["listports", "open", "listterm"], help="Command to execute")
+    parser.add_argument("command", nargs="?", choices=["listports", "open", "listterm", "watch", "log", "multi", "serve"], help="Command to execute")
     parser.add_argument("term", nargs="?", help="Terminal program name (for 'open')")
-    parser.add_argument('--version', action='version', version=__version__,
+    parser.add_argument('--version', action=VersionAction,
                                                 help="Print package version")
-    parser.add_argument('-s', '--serial', help='Serial number to search for')
-    parser.add_argument('-p', '--port', help="Serial port path or number")
+    parser.add_argument('-s', '--serial', action='append', dest='serials',
+                                                help="Serial number to search for (repeat for 'multi')")
+    parser.add_argument('-p', '--port', action='append', dest='ports',
+                                                help="Serial port path or number (repeat for 'multi')")
     parser.add_argument('-b', '--baud', type=int, default=115200,
                                                 help="Baud rate (default: 115200)")
     parser.add_argument('-c', '--config', default="8N1", help="Port configuration (default: 8N1)")
@@ -81,8 +188,28 @@ def cli(argv):
                                                 help="Print more information")
     parser.add_argument('-t', '--test', action='store_true',
                                                 help="Check if serial port is available")
+    parser.add_argument('-o', '--output',
+                                                help="Log directory (for 'log', default: serial-logs, and 'multi')")
+    parser.add_argument('--binary', action='store_true',
+                                                help="Log timestamped raw chunks instead of lines (for 'log')")
+    parser.add_argument('--max-size', help="Start a new log file after this size, i.e. 100M (for 'log')")
+    parser.add_argument('--max-time', help="Start a new log file after this time, i.e. 1h (for 'log')")
+    parser.add_argument('--compress', action='store_true',
+                                                help="Gzip closed log files (for 'log')")
+    parser.add_argument('-l', '--listen', action='append',
+                                                help="Address to serve on: [host:]port or a Unix socket path, "
+                                                     "can be repeated (for 'serve', default: a Unix socket "
+                                                     "named after the port)")
+    parser.add_argument('--write-policy', choices=["lock", "all", "none"], default="lock",
+                                                help="Which clients may write (for 'serve', default: lock, "
+                                                     "i.e. one at a time)")
+    parser.add_argument('--stats', type=float, metavar="SECONDS",
+                                                help="Print throughput statistics periodically (for 'serve')")
 
     args, remaining_args = parser.parse_known_args(argv)
+    # Single port commands use the last -p/-s given
+    args.port = args.ports[-1] if args.ports else None
+    args.serial = args.serials[-1] if args.serials else None
 
     command = args.command or "listports"
 
@@ -101,10 +228,27 @@ def cli(argv):
                 print(f"{term}")
         return 0
 
+    elif command == "watch":
+        # Print serial ports and probes as they come and go
+        serialmon_cli_watch(args.verbose)
+        return 0
+
     elif command == "open":
         # Try to open the serial port
         return serialmon_cli_open_port(args.port, args.serial, args.baud, args.config, args.term)
 
+    elif command == "log":
+        # Log the serial port to timestamped, rotated files
+        return serialmon_cli_log(args)
+
+    elif command == "multi":
+        # Monitor several ports in one merged, timestamped stream
+        return serialmon_cli_multi(args)
+
+    elif command == "serve":
+        # Share the port with many clients over TCP/Unix sockets
+        return serialmon_cli_serve(args)
+
 
 def main(argv=None):
     """Serialmon CLI Main entry point"""
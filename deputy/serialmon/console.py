@@ -0,0 +1,227 @@
+"""
+Builtin serial terminal.
+
+Runs in-process instead of starting serial.tools.miniterm in a second interpreter, and is
+built to keep up with sustained multi-Mbaud output: a reader thread waits for the port in
+select() and reads straight into a pool of preallocated buffers with readinto(), and the
+main thread writes all filled buffers to stdout with a single writev(). If stdout can't keep
+up for long enough to use up the whole pool, the data is counted as dropped instead of
+stalling the reader (which would overrun the UART). Keyboard input is passed through raw.
+"""
+
+import collections
+import io
+import os
+import select
+import selectors
+import struct
+import sys
+import threading
+
+import serial
+
+# Ctrl-], like miniterm
+EXIT_CHAR = b"\x1d"
+
+# struct serial_icounter_struct: cts, dsr, rng, dcd, rx, tx, frame, overrun, parity, brk, buf_overrun
+ICOUNT_STRUCT = struct.Struct("11i")
+ICOUNT_FIELDS = ("cts", "dsr", "rng", "dcd", "rx", "tx", "frame", "overrun", "parity", "brk", "buf_overrun")
+
+_PARITIES = {"N": serial.PARITY_NONE, "E": serial.PARITY_EVEN, "O": serial.PARITY_ODD,
+             "M": serial.PARITY_MARK, "S": serial.PARITY_SPACE}
+_STOPBITS = {"1": serial.STOPBITS_ONE, "1.5": serial.STOPBITS_ONE_POINT_FIVE, "2": serial.STOPBITS_TWO}
+
+
+def parse_config(config: str) -> dict:
+    """Turns a port configuration like '8N1' or '7E1.5' into pyserial keyword arguments"""
+    config = config.strip().upper()
+    if len(config) < 3 or config[0] not in "5678" or config[1] not in _PARITIES or config[2:] not in _STOPBITS:
+        raise Exception(f"Invalid port configuration '{config}' (expected i.e. 8N1, 7E1, 8N2)")
+    return {"bytesize": int(config[0]), "parity": _PARITIES[config[1]], "stopbits": _STOPBITS[config[2:]]}
+
+
+def read_icount(fd):
+    """Returns the driver's line error counters (Linux TIOCGICOUNT) as a dict, or None"""
+    try:
+        import fcntl
+        import termios
+    except ImportError:
+        return None
+    request = getattr(termios, "TIOCGICOUNT", None)
+    if request is None:
+        return None
+    buf = bytearray(80)
+    try:
+        fcntl.ioctl(fd, request, buf)
+    except OSError:
+        return None
+    return dict(zip(ICOUNT_FIELDS, ICOUNT_STRUCT.unpack_from(buf)))
+
+
+def _write_all(fd, views):
+    """Writes a list of memoryviews to fd, with as few system calls as possible"""
+    while views:
+        written = os.writev(fd, views)
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if views and written:
+            views[0] = views[0][written:]
+
+
+class SerialConsole:
+    """
+    Interactive terminal on a serial port (POSIX only). run() blocks until the exit character
+    (Ctrl-]) is typed and returns the transfer statistics.
+    """
+
+    def __init__(self, port: str, baud: int, config: str = "8N1", chunk_size: int = 64 * 1024,
+                 chunks: int = 64):
+        self.serial = serial.Serial(port, baud, timeout=0, **parse_config(config))
+        self.port = port
+        self.baud = baud
+        self.config = config
+        self.chunk_size = chunk_size
+        self._buffers = [bytearray(chunk_size) for _ in range(chunks)]
+        self._free = collections.deque(range(chunks))
+        self._filled = collections.deque()
+        self._scratch = bytearray(chunk_size)
+        self._wake_r, self._wake_w = os.pipe()
+        self._stop_r, self._stop_w = os.pipe()
+        self._error = None
+
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.dropped_bytes = 0
+
+    def _reader(self):
+        fd = self.serial.fileno()
+        raw = io.FileIO(fd, "rb", closefd=False)
+        try:
+            while True:
+                ready, _, _ = select.select([fd, self._stop_r], [], [])
+                if self._stop_r in ready:
+                    return
+                try:
+                    index = self._free.popleft()
+                except IndexError:
+                    # All buffers are waiting for stdout. Keep draining the port, so the UART
+                    # doesn't overrun, but count the data as lost
+                    n = raw.readinto(self._scratch)
+                    self.dropped_bytes += n or 0
+                    continue
+                view = memoryview(self._buffers[index])
+                used = 0
+                # Fill the buffer with whatever is already there, to save wake-ups
+                while used < self.chunk_size:
+                    n = raw.readinto(view[used:])
+                    if not n:
+                        break
+                    used += n
+                if used == 0:
+                    self._free.appendleft(index)
+                    if n == 0:
+                        # A readable fd without data: the port is gone
+                        raise serial.SerialException("Serial port closed")
+                    continue
+                self.rx_bytes += used
+                self._filled.append((index, used))
+                os.write(self._wake_w, b"\0")
+        except Exception as e:
+            self._error = e
+            os.write(self._wake_w, b"\0")
+
+    def _flush_to_stdout(self, out_fd):
+        entries = []
+        while self._filled:
+            entries.append(self._filled.popleft())
+        if entries:
+            _write_all(out_fd, [memoryview(self._buffers[index])[:used] for index, used in entries])
+            self._free.extend(index for index, _ in entries)
+
+    def run(self) -> dict:
+        import termios
+        import tty
+        in_fd = sys.stdin.fileno()
+        out_fd = sys.stdout.fileno()
+        sys.stdout.flush()
+        icount_start = read_icount(self.serial.fileno())
+
+        print(f"--- {self.port} {self.baud} {self.config} --- Quit: Ctrl-] ---", file=sys.stderr)
+        old_attrs = termios.tcgetattr(in_fd) if os.isatty(in_fd) else None
+        reader = threading.Thread(target=self._reader, daemon=True)
+        try:
+            if old_attrs is not None:
+                tty.setraw(in_fd)
+                # Keep translating '\n' to '\r\n' on output, for targets that only send '\n'
+                attrs = termios.tcgetattr(in_fd)
+                attrs[1] |= termios.OPOST | termios.ONLCR
+                termios.tcsetattr(in_fd, termios.TCSANOW, attrs)
+            reader.start()
+
+            with selectors.DefaultSelector() as selector:
+                selector.register(self._wake_r, selectors.EVENT_READ)
+                selector.register(in_fd, selectors.EVENT_READ)
+                running = True
+                while running:
+                    for key, _ in selector.select():
+                        if key.fd == self._wake_r:
+                            os.read(self._wake_r, 4096)
+                            self._flush_to_stdout(out_fd)
+                            if self._error is not None:
+                                raise self._error
+                        else:
+                            data = os.read(in_fd, 1024)
+                            if not data:
+                                # stdin isn't interactive. Keep monitoring until Ctrl-C
+                                selector.unregister(in_fd)
+                                continue
+                            if EXIT_CHAR in data:
+                                data = data.split(EXIT_CHAR)[0]
+                                running = False
+                            if data:
+                                self.serial.write(data)
+                                self.tx_bytes += len(data)
+        finally:
+            os.write(self._stop_w, b"\0")
+            if reader.is_alive():
+                reader.join(1)
+            self._flush_to_stdout(out_fd)
+            if old_attrs is not None:
+                termios.tcsetattr(in_fd, termios.TCSADRAIN, old_attrs)
+            stats = self.stats(icount_start)
+            self.close()
+        print(f"\n--- {self.port}: " + ", ".join(f"{k}: {v}" for k, v in stats.items()) + " ---",
+              file=sys.stderr)
+        return stats
+
+    def stats(self, icount_start=None) -> dict:
+        """Bytes received, sent and dropped, and the driver's overrun/error counters if known"""
+        stats = {"rx": self.rx_bytes, "tx": self.tx_bytes, "dropped": self.dropped_bytes}
+        icount = read_icount(self.serial.fileno()) if self.serial.is_open else None
+        if icount is not None and icount_start is not None:
+            for field in ("overrun", "buf_overrun", "frame", "parity"):
+                stats[field] = icount[field] - icount_start[field]
+        return stats
+
+    def close(self):
+        self.serial.close()
+        for fd in (self._wake_r, self._wake_w, self._stop_r, self._stop_w):
+            os.close(fd)
+
+
+def run_miniterm(port: str, baud: int, config: str = "8N1"):
+    """In-process pyserial miniterm, for systems where SerialConsole doesn't work (Windows)"""
+    from serial.tools.miniterm import Miniterm
+    ser = serial.Serial(port, baud, **parse_config(config))
+    miniterm = Miniterm(ser)
+    miniterm.set_rx_encoding("UTF-8")
+    miniterm.set_tx_encoding("UTF-8")
+    print(f"--- {port} {baud} {config} --- Quit: Ctrl-] ---", file=sys.stderr)
+    miniterm.start()
+    try:
+        miniterm.join(True)
+    except KeyboardInterrupt:
+        pass
+    miniterm.join()
+    miniterm.close()
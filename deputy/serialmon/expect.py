@@ -0,0 +1,374 @@
+"""
+Waiting for patterns in serial output, for test automation.
+
+A PatternSet compiles any number of patterns into one automaton: literal patterns (str or
+bytes) go into an Aho-Corasick automaton, regular expressions (re.Pattern) into one combined
+regex. A Scanner feeds chunks through it incrementally:
+
+- literals are matched byte by byte with the automaton state carried from one chunk to the
+  next, so they're found even when split across chunks and data is never looked at twice.
+- regexes are matched within a line. Complete lines are searched once; the unterminated
+  last line is kept (up to max_line bytes) and searched again as more of it arrives, so a
+  prompt like 'login: ' without a newline is still found. Like pexpect, a regex matches as
+  soon as possible, i.e. r'\\d+' can match a number before all of its digits arrived.
+
+SerialExpect reads a serial port and waits for a PatternSet, and expect_any() waits on many
+ports at once in a single select() loop.
+"""
+
+import collections
+import io
+import re
+import selectors
+import time
+
+import serial
+
+from deputy.serialmon.console import parse_config
+
+_REGEX_FLAGS = ((re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s"), (re.VERBOSE, "x"))
+
+
+class ExpectTimeout(Exception):
+    """None of the patterns was seen in time. before is {port name: data received meanwhile}"""
+
+    def __init__(self, message, before=None):
+        super().__init__(message)
+        self.before = before or {}
+
+
+class Match:
+    """
+    A pattern seen in the stream. index is the pattern's position in the PatternSet, start
+    and end are stream offsets, data the matched bytes and groups the regex groups (empty
+    for literals). port is set by SerialExpect, t_ns is the time.monotonic_ns() the chunk
+    completing the match was read.
+    """
+
+    __slots__ = ("index", "pattern", "start", "end", "data", "groups", "port", "t_ns")
+
+    def __init__(self, index, pattern, start, end, data, groups=(), t_ns=None):
+        self.index = index
+        self.pattern = pattern
+        self.start = start
+        self.end = end
+        self.data = data
+        self.groups = groups
+        self.port = None
+        self.t_ns = t_ns
+
+    def __repr__(self):
+        return f"Match(index={self.index}, data={self.data!r}, start={self.start}, port={self.port})"
+
+
+def _to_bytes(pattern):
+    return pattern.encode() if isinstance(pattern, str) else bytes(pattern)
+
+
+def _regex_source(regex) -> bytes:
+    """Returns the source of a compiled regex as bytes, with its flags inlined"""
+    source = _to_bytes(regex.pattern)
+    flags = "".join(letter for flag, letter in _REGEX_FLAGS if regex.flags & flag)
+    if flags:
+        source = b"(?" + flags.encode() + b":" + source + b")"
+    return source
+
+
+class _AhoCorasick:
+    """
+    Aho-Corasick automaton for a list of byte strings, flattened into a DFA: delta[state + byte]
+    is the next state, with states numbered in multiples of 256 so a step is one list lookup.
+    """
+
+    def __init__(self, literals: list):
+        goto = [{}]
+        outputs = [[]]
+        for i, literal in enumerate(literals):
+            state = 0
+            for byte in literal:
+                nxt = goto[state].get(byte)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto.append({})
+                    outputs.append([])
+                    goto[state][byte] = nxt
+                state = nxt
+            outputs[state].append(i)
+
+        # Breadth first, so a state's failure link is always complete before the state
+        fail = [0] * len(goto)
+        order = collections.deque()
+        for state in goto[0].values():
+            order.append(state)
+        bfs = []
+        while order:
+            state = order.popleft()
+            bfs.append(state)
+            for byte, nxt in goto[state].items():
+                order.append(nxt)
+                if state:
+                    f = fail[state]
+                    while f and byte not in goto[f]:
+                        f = fail[f]
+                    fail[nxt] = goto[f].get(byte, 0)
+                outputs[nxt] = outputs[nxt] + outputs[fail[nxt]]
+
+        delta = [0] * (len(goto) * 256)
+        for byte, nxt in goto[0].items():
+            delta[byte] = nxt * 256
+        for state in bfs:
+            base = state * 256
+            fail_base = fail[state] * 256
+            for byte in range(256):
+                nxt = goto[state].get(byte)
+                delta[base + byte] = nxt * 256 if nxt is not None else delta[fail_base + byte]
+
+        self.delta = delta
+        self.outputs = {state * 256: out for state, out in enumerate(outputs) if out}
+        # From the start state only a pattern's first byte leads anywhere, so skip to the next
+        # one of those with a (C speed) regex search instead of stepping through every byte
+        self.first = re.compile(b"[" + b"".join(re.escape(bytes([b])) for b in sorted(goto[0])) + b"]")
+
+    def scan(self, data, state: int, hits: list):
+        """
+        Runs data through the automaton starting in state and appends (end, literal index) to
+        hits for every literal that ends in data (end is relative to data). Returns the new state.
+        """
+        delta = self.delta
+        outputs = self.outputs
+        search = self.first.search
+        pos = 0
+        size = len(data)
+        while pos < size:
+            if not state:
+                m = search(data, pos)
+                if m is None:
+                    return 0
+                pos = m.start()
+            state = delta[state + data[pos]]
+            pos += 1
+            if state in outputs:
+                hits.extend((pos, i) for i in outputs[state])
+        return state
+
+
+class PatternSet:
+    """
+    Compiled set of patterns. str and bytes patterns are literals, re.Pattern objects
+    regexes (str regexes are applied to the UTF-8 encoded data).
+    """
+
+    def __init__(self, patterns, max_line: int = 4096):
+        self.patterns = list(patterns)
+        if not self.patterns:
+            raise Exception("No patterns given")
+        self.max_line = max_line
+        self.literals = []
+        self._literal_index = []
+        self._regex_index = {}
+        alternatives = []
+        for i, pattern in enumerate(self.patterns):
+            if isinstance(pattern, re.Pattern):
+                regex = re.compile(_regex_source(pattern))
+                self._regex_index[f"_{i}"] = (i, regex)
+                alternatives.append(b"(?P<_%d>" % i + _regex_source(pattern) + b")")
+            else:
+                literal = _to_bytes(pattern)
+                if not literal:
+                    raise Exception(f"Empty pattern at position {i}")
+                self.literals.append(literal)
+                self._literal_index.append(i)
+        self.automaton = _AhoCorasick(self.literals) if self.literals else None
+        self.regex = re.compile(b"|".join(alternatives)) if alternatives else None
+
+    def scanner(self):
+        return Scanner(self)
+
+
+class Scanner:
+    """Incremental matching of a PatternSet against a stream of chunks"""
+
+    def __init__(self, patterns: PatternSet):
+        self.patterns = patterns
+        self.offset = 0
+        self._state = 0
+        # Unterminated last line, for the regexes
+        self._line = bytearray()
+        self._line_start = 0
+        self._regex_from = 0
+
+    def feed(self, data, t_ns: int = None) -> list:
+        """Scans the next chunk and returns the Matches completed in it, in order of their end"""
+        ps = self.patterns
+        base = self.offset
+        self.offset += len(data)
+        matches = []
+
+        if ps.automaton is not None:
+            hits = []
+            self._state = ps.automaton.scan(data, self._state, hits)
+            for end, i in hits:
+                literal = ps.literals[i]
+                index = ps._literal_index[i]
+                matches.append(Match(index, ps.patterns[index], base + end - len(literal), base + end,
+                                     literal, t_ns=t_ns))
+
+        if ps.regex is not None:
+            self._scan_lines(data, base, t_ns, matches)
+
+        if len(matches) > 1:
+            matches.sort(key=lambda m: (m.end, m.start))
+        return matches
+
+    def _scan_lines(self, data, base, t_ns, matches):
+        ps = self.patterns
+        last_newline = data.rfind(b"\n")
+        if last_newline < 0:
+            self._line += data
+            text = self._line
+        else:
+            # The complete lines, searched once, with what was left of the previous chunk
+            text = bytes(self._line) + data[:last_newline + 1]
+        self._search(text, t_ns, matches)
+        if last_newline >= 0:
+            self._line = bytearray(data[last_newline + 1:])
+            self._line_start = base + last_newline + 1
+            self._search(self._line, t_ns, matches)
+        if len(self._line) > ps.max_line:
+            # A runaway line without newlines. Only keep its end
+            drop = len(self._line) - ps.max_line
+            del self._line[:drop]
+            self._line_start += drop
+
+    def _search(self, text, t_ns, matches):
+        pos = max(0, self._regex_from - self._line_start)
+        regex = self.patterns.regex
+        while pos < len(text):
+            m = regex.search(text, pos)
+            if m is None:
+                return
+            index, single = self.patterns._regex_index[m.lastgroup]
+            groups = single.match(text, m.start(), m.end())
+            matches.append(Match(index, self.patterns.patterns[index], self._line_start + m.start(),
+                                 self._line_start + m.end(), bytes(m.group()),
+                                 groups.groups() if groups is not None else (), t_ns))
+            # Empty matches would match again at the same place
+            pos = m.end() if m.end() > m.start() else m.end() + 1
+            self._regex_from = self._line_start + pos
+
+
+def compile_patterns(patterns) -> PatternSet:
+    """Returns patterns as a PatternSet (patterns can already be one)"""
+    if isinstance(patterns, PatternSet):
+        return patterns
+    if isinstance(patterns, (str, bytes, re.Pattern)):
+        patterns = [patterns]
+    return PatternSet(patterns)
+
+
+class SerialExpect:
+    """
+    Expect on a serial port. Data received after a match is kept for the next expect() call,
+    and the data received before the match is kept in before.
+    """
+
+    def __init__(self, port: str, baud: int = 115200, config: str = "8N1", name: str = None,
+                 max_buffer: int = 1 << 20, read_size: int = 64 * 1024):
+        self.serial = serial.Serial(port, baud, timeout=0, **parse_config(config))
+        self.port = port
+        self.name = name or port
+        self.max_buffer = max_buffer
+        self.before = b""
+        # Received data that wasn't consumed by a match yet
+        self._buffer = bytearray()
+        self._scanner = None
+        # Bytes dropped from the front of _buffer since the scanner was started
+        self._trimmed = 0
+        self._raw = io.FileIO(self.serial.fileno(), "rb", closefd=False)
+        self._read_buf = bytearray(read_size)
+
+    def fileno(self):
+        return self.serial.fileno()
+
+    def _start(self, patterns: PatternSet):
+        """Starts matching patterns, beginning with the data already received"""
+        self._scanner = patterns.scanner()
+        self._trimmed = 0
+        if self._buffer:
+            return self._scan(bytes(self._buffer), time.monotonic_ns())
+        return None
+
+    def _scan(self, data, t_ns):
+        matches = self._scanner.feed(data, t_ns)
+        if not matches:
+            if len(self._buffer) > self.max_buffer:
+                drop = len(self._buffer) - self.max_buffer
+                del self._buffer[:drop]
+                self._trimmed += drop
+            return None
+        match = matches[0]
+        match.port = self.name
+        self.before = bytes(self._buffer[:max(0, match.start - self._trimmed)])
+        del self._buffer[:match.end - self._trimmed]
+        self._scanner = None
+        return match
+
+    def read(self):
+        """Reads what's available from the port and returns the next Match, if any"""
+        n = self._raw.readinto(self._read_buf)
+        if n == 0:
+            raise serial.SerialException(f"{self.port} closed")
+        if not n:
+            return None
+        data = bytes(self._read_buf[:n])
+        self._buffer += data
+        if self._scanner is None:
+            return None
+        return self._scan(data, time.monotonic_ns())
+
+    def expect(self, patterns, timeout: float = None) -> Match:
+        """Waits for any of patterns. Raises ExpectTimeout if none is seen within timeout seconds"""
+        return expect_any([self], patterns, timeout)
+
+    def send(self, data):
+        self.serial.write(_to_bytes(data))
+
+    def sendline(self, data=b""):
+        self.send(_to_bytes(data) + b"\n")
+
+    def close(self):
+        self.serial.close()
+
+
+def expect_any(ports: list, patterns, timeout: float = None) -> Match:
+    """
+    Waits until any of patterns is seen on any of ports (SerialExpects) and returns the
+    Match (match.port tells where). patterns can also be a dict of {port: patterns}, to wait
+    for different patterns on each port. Raises ExpectTimeout after timeout seconds.
+    """
+    if isinstance(patterns, dict):
+        compiled = {port: compile_patterns(p) for port, p in patterns.items()}
+        ports = list(compiled)
+    else:
+        shared = compile_patterns(patterns)
+        compiled = {port: shared for port in ports}
+
+    for port in ports:
+        match = port._start(compiled[port])
+        if match is not None:
+            return match
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with selectors.DefaultSelector() as selector:
+        for port in ports:
+            selector.register(port, selectors.EVENT_READ)
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            for key, _ in selector.select(remaining):
+                match = key.fileobj.read()
+                if match is not None:
+                    return match
+    before = {port.name: bytes(port._buffer) for port in ports}
+    raise ExpectTimeout(f"None of the patterns seen within {timeout} s", before)
@@ -0,0 +1,333 @@
+"""
+Headless, timestamped serial capture to rotating log files.
+
+In text mode every line is prefixed with the wall-clock time and the time.monotonic() time at
+which its first byte was read. In binary mode every chunk read from the port is written as a
+record: a CHUNK_HEADER (monotonic ns, wall-clock ns, length) followed by the data.
+
+Reads go into a preallocated buffer and the logger sleeps in select() between reads, so it
+doesn't busy-wait. Segment files are written through a large buffer and flushed at least
+every flush_interval seconds. Closed segments can be gzip-compressed on a background thread,
+so compressing never holds up the capture. If the port goes away (i.e. the board reboots),
+the logger notes it in the log and waits for the port to come back.
+"""
+
+import datetime
+import gzip
+import io
+import os
+import re
+import select
+import shutil
+import struct
+import threading
+import time
+
+import serial
+
+from deputy.serialmon.console import parse_config
+
+CHUNK_HEADER = struct.Struct("<qqI")
+
+_SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+_TIME_UNITS = {"": 1, "S": 1, "M": 60, "H": 3600, "D": 86400}
+
+
+def parse_size(text: str) -> int:
+    """Parses a size like '500K', '100M' or '2G' into bytes"""
+    m = re.fullmatch(r"([0-9.]+)\s*([KMG]?)I?B?", text.strip().upper())
+    if m is None:
+        raise ValueError(f"Invalid size '{text}'")
+    return int(float(m.group(1)) * _SIZE_UNITS[m.group(2)])
+
+
+def parse_duration(text: str) -> float:
+    """Parses a duration like '90', '30m', '12h' or '1d' into seconds"""
+    m = re.fullmatch(r"([0-9.]+)\s*([SMHD]?)", text.strip().upper())
+    if m is None:
+        raise ValueError(f"Invalid duration '{text}'")
+    return float(m.group(1)) * _TIME_UNITS[m.group(2)]
+
+
+def _compress(path):
+    with open(path, "rb") as src, gzip.open(path + ".gz", "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    os.remove(path)
+
+
+def read_chunks(path):
+    """
+    Yields the (monotonic ns, wall-clock ns, data) records of a binary log segment (plain or
+    gzipped). A record cut short (i.e. the logger was killed) ends the segment.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        while True:
+            header = f.read(CHUNK_HEADER.size)
+            if len(header) < CHUNK_HEADER.size:
+                return
+            mono_ns, wall_ns, size = CHUNK_HEADER.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            yield mono_ns, wall_ns, data
+
+
+class RotatingLogWriter:
+    """
+    Writes to segment files named <prefix>-<start time>-<n>.<ext> in directory, starting a
+    new segment once the current one exceeds max_bytes or is older than max_seconds.
+    """
+
+    def __init__(self, directory, prefix: str, ext: str = "log", max_bytes: int = None,
+                 max_seconds: float = None, compress: bool = False, buffer_size: int = 1 << 20):
+        self.directory = directory
+        self.prefix = prefix
+        self.ext = ext
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.segments = []
+        self.bytes_written = 0
+        self._file = None
+        self._size = 0
+        self._opened = 0
+        self._compressors = []
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def path(self):
+        return self.segments[-1] if self.segments else None
+
+    def _open_segment(self):
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.directory, f"{self.prefix}-{stamp}-{len(self.segments):04d}.{self.ext}")
+        self._file = open(path, "wb", buffering=self.buffer_size)
+        self._size = 0
+        self._opened = time.monotonic()
+        self.segments.append(path)
+
+    def _close_segment(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if self.compress:
+            thread = threading.Thread(target=_compress, args=(self.path,), daemon=False)
+            thread.start()
+            self._compressors = [t for t in self._compressors if t.is_alive()] + [thread]
+
+    def rotation_due(self) -> bool:
+        if self._file is None:
+            return False
+        if self.max_bytes is not None and self._size >= self.max_bytes:
+            return True
+        return self.max_seconds is not None and time.monotonic() - self._opened >= self.max_seconds
+
+    def write(self, data):
+        """
+        Writes data. Rotation only happens between writes, so a record (line or chunk) is never
+        split across segments, and an idle port doesn't produce empty segments.
+        """
+        if self.rotation_due():
+            self._close_segment()
+        if self._file is None:
+            self._open_segment()
+        self._file.write(data)
+        self._size += len(data)
+        self.bytes_written += len(data)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        self._close_segment()
+        for thread in self._compressors:
+            thread.join()
+
+
+class LineStamper:
+    """Splits a byte stream into lines and prefixes each with the time its first byte arrived"""
+
+    def __init__(self):
+        self._partial = bytearray()
+        self._stamp = None
+
+    @staticmethod
+    def format_stamp(mono_ns: int, wall_ns: int) -> bytes:
+        wall = datetime.datetime.fromtimestamp(wall_ns / 1e9).isoformat(timespec="milliseconds")
+        return f"[{wall} {mono_ns / 1e9:.6f}] ".encode()
+
+    def feed(self, data, mono_ns: int, wall_ns: int) -> bytes:
+        """Returns the complete, stamped lines, keeping a trailing partial line for later"""
+        out = bytearray()
+        pos = 0
+        while True:
+            end = data.find(b"\n", pos)
+            if end < 0:
+                break
+            if self._stamp is None:
+                self._stamp = self.format_stamp(mono_ns, wall_ns)
+            out += self._stamp
+            out += self._partial
+            out += data[pos:end + 1]
+            self._partial.clear()
+            self._stamp = None
+            pos = end + 1
+        if pos < len(data):
+            if self._stamp is None:
+                self._stamp = self.format_stamp(mono_ns, wall_ns)
+            self._partial += data[pos:]
+        return bytes(out)
+
+    def flush_pending(self) -> bool:
+        return len(self._partial) > 0
+
+    def flush(self) -> bytes:
+        """Returns the partial line (if any), terminated, i.e. when the port goes away"""
+        if not self._partial:
+            return b""
+        out = self._stamp + bytes(self._partial) + b"\n"
+        self._partial.clear()
+        self._stamp = None
+        return out
+
+
+class SerialLogger:
+    """
+    Captures a serial port to a RotatingLogWriter until stop() is called. stop() may still be
+    called after run() has returned, the pipe waking run() up is only closed by close()
+    """
+
+    def __init__(self, port: str, baud: int, config: str, writer: RotatingLogWriter,
+                 binary: bool = False, flush_interval: float = 1.0, read_size: int = 64 * 1024):
+        self.port = port
+        self.baud = baud
+        self.config = config
+        self.writer = writer
+        self.binary = binary
+        self.flush_interval = flush_interval
+        self.stamper = None if binary else LineStamper()
+        self.rx_bytes = 0
+        self.disconnects = 0
+        self._buf = bytearray(read_size)
+        self._stop_r, self._stop_w = os.pipe()
+        self._stopped = False
+
+    def stop(self):
+        """Ends run(). Safe to call from another thread or a signal handler"""
+        self._stopped = True
+        if self._stop_w is not None:
+            os.write(self._stop_w, b"\0")
+
+    def close(self):
+        """Closes the stop pipe, once run() has returned"""
+        self._stopped = True
+        if self._stop_w is not None:
+            os.close(self._stop_r)
+            os.close(self._stop_w)
+            self._stop_r = self._stop_w = None
+
+    def __del__(self):
+        self.close()
+
+    def _note(self, text: str):
+        """Writes a logger message (i.e. port disconnected) into the log"""
+        if self.binary:
+            return
+        mono_ns, wall_ns = time.monotonic_ns(), time.time_ns()
+        self.writer.write(self.stamper.flush() + LineStamper.format_stamp(mono_ns, wall_ns) + f"--- {text} ---\n".encode())
+
+    def _record(self, data, mono_ns, wall_ns):
+        if self.binary:
+            self.writer.write(CHUNK_HEADER.pack(mono_ns, wall_ns, len(data)) + data)
+        else:
+            lines = self.stamper.feed(data, mono_ns, wall_ns)
+            if lines:
+                self.writer.write(lines)
+
+    def _open(self):
+        return serial.Serial(self.port, self.baud, timeout=0, **parse_config(self.config))
+
+    def _wait_for_port(self):
+        """Waits for the port to come back. Returns the opened port, or None if stopped"""
+        from deputy.hotplug import HotplugWatcher
+        watcher = HotplugWatcher()
+        try:
+            while not self._stopped:
+                if os.path.exists(self.port):
+                    try:
+                        return self._open()
+                    except serial.SerialException:
+                        # Node exists, but the device isn't ready yet
+                        pass
+                ready, _, _ = select.select([self._stop_r] + ([watcher] if watcher.fileno() is not None else []),
+                                            [], [], 0.5)
+                if watcher in ready:
+                    watcher.poll(0)
+        finally:
+            watcher.close()
+        return None
+
+    def run(self):
+        ser = self._open()
+        self._note(f"{self.port} opened at {self.baud} {self.config}")
+        last_flush = time.monotonic()
+        try:
+            while not self._stopped:
+                raw = io.FileIO(ser.fileno(), "rb", closefd=False)
+                while not self._stopped:
+                    ready, _, _ = select.select([ser.fileno(), self._stop_r], [], [], self.flush_interval)
+                    now = time.monotonic()
+                    if ser.fileno() in ready:
+                        try:
+                            n = raw.readinto(self._buf)
+                        except OSError:
+                            n = 0
+                        if n == 0:
+                            break
+                        if n:
+                            mono_ns, wall_ns = time.monotonic_ns(), time.time_ns()
+                            self.rx_bytes += n
+                            self._record(memoryview(self._buf)[:n].tobytes(), mono_ns, wall_ns)
+                    if now - last_flush >= self.flush_interval:
+                        self.writer.flush()
+                        last_flush = now
+                ser.close()
+                if self._stopped:
+                    break
+                self.disconnects += 1
+                self._note(f"{self.port} disconnected")
+                self.writer.flush()
+                ser = self._wait_for_port()
+                if ser is None:
+                    break
+                self._note(f"{self.port} reconnected")
+        finally:
+            if ser is not None and ser.is_open:
+                ser.close()
+            if not self.binary and self.stamper.flush_pending():
+                self.writer.write(self.stamper.flush())
+            self.writer.close()
+
+
+def run_logger(port: str, baud: int, config: str, directory, binary: bool = False,
+               max_bytes: int = None, max_seconds: float = None, compress: bool = False):
+    """Logs a serial port until Ctrl-C or SIGTERM"""
+    import signal
+    prefix = os.path.basename(port)
+    writer = RotatingLogWriter(directory, prefix, "bin" if binary else "log", max_bytes, max_seconds, compress)
+    logger = SerialLogger(port, baud, config, writer, binary)
+    signal.signal(signal.SIGTERM, lambda signum, frame: logger.stop())
+    print(f"Logging {port} to {directory} (Ctrl-C to stop)")
+    try:
+        logger.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.close()
+    print(f"Logged {logger.rx_bytes} bytes to {len(writer.segments)} file(s), "
+          f"{logger.disconnects} disconnect(s)")
+    return 0
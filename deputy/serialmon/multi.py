@@ -0,0 +1,235 @@
+"""
+Monitoring many serial ports in one process.
+
+All ports are read in a single selectors loop. Their lines are merged into one stream on
+stdout, tagged with the port's name in its own colour and ordered by the time each line's
+first byte was read: a complete line is held back while another port has an older line still
+coming in (for at most max_delay seconds). A line that stays unterminated for max_delay (i.e.
+a shell prompt) is printed as it is.
+
+Optionally every port is also logged to its own rotating log file (see deputy.serialmon.logger).
+Ports that disconnect are reopened when the hotplug watcher sees them come back.
+"""
+
+import datetime
+import heapq
+import io
+import os
+import selectors
+import sys
+import time
+
+import serial
+from colorama import Fore, Style
+
+from deputy.serialmon.console import parse_config
+from deputy.serialmon.logger import LineStamper, RotatingLogWriter
+
+COLORS = [Fore.CYAN, Fore.YELLOW, Fore.MAGENTA, Fore.GREEN, Fore.BLUE, Fore.RED,
+          Fore.LIGHTCYAN_EX, Fore.LIGHTYELLOW_EX, Fore.LIGHTMAGENTA_EX, Fore.LIGHTGREEN_EX,
+          Fore.LIGHTBLUE_EX, Fore.LIGHTRED_EX]
+
+RETRY_INTERVAL_S = 0.5
+
+
+class _MonitoredPort:
+    """One port of a MultiMonitor, with its unterminated line and log writer"""
+
+    def __init__(self, path, name, color, writer=None):
+        self.path = path
+        self.name = name
+        self.color = color
+        self.writer = writer
+        self.stamper = LineStamper() if writer is not None else None
+        self.serial = None
+        self.raw = None
+        self.partial = bytearray()
+        self.partial_ns = 0
+        self.partial_wall_ns = 0
+        self.rx_bytes = 0
+        self.disconnects = 0
+
+    def fileno(self):
+        return self.serial.fileno()
+
+
+class MultiMonitor:
+    """
+    Prints the merged output of ports (a list of (path, name) tuples) until interrupted.
+    If log_dir is given, each port is also logged to <log_dir>/<name>-*.log.
+    """
+
+    def __init__(self, ports: list, baud: int = 115200, config: str = "8N1", log_dir=None,
+                 max_bytes: int = None, max_seconds: float = None, compress: bool = False,
+                 max_delay: float = 0.2, out=None, color: bool = True, read_size: int = 64 * 1024):
+        if os.name != "posix":
+            raise Exception("Monitoring multiple ports is only supported on POSIX systems")
+        self.baud = baud
+        self.config = config
+        self.max_delay_ns = int(max_delay * 1e9)
+        self.out = out or sys.stdout
+        self.color = color
+        self.ports = []
+        for i, (path, name) in enumerate(ports):
+            writer = None
+            if log_dir is not None:
+                writer = RotatingLogWriter(log_dir, name, "log", max_bytes, max_seconds, compress)
+            self.ports.append(_MonitoredPort(path, name, COLORS[i % len(COLORS)], writer))
+        self.name_width = max(len(port.name) for port in self.ports)
+        self._buf = bytearray(read_size)
+        # Complete lines waiting to be printed: (first byte time, sequence, wall-clock time, port,
+        # line, is a monitor message)
+        self._pending = []
+        self._seq = 0
+        self._selector = selectors.DefaultSelector()
+        self._watcher = None
+
+    def _open(self, port):
+        port.serial = serial.Serial(port.path, self.baud, timeout=0, **parse_config(self.config))
+        port.raw = io.FileIO(port.serial.fileno(), "rb", closefd=False)
+        self._selector.register(port, selectors.EVENT_READ)
+
+    def _close(self, port):
+        self._selector.unregister(port)
+        port.serial.close()
+        port.serial = None
+        port.raw = None
+
+    def _note(self, port, text):
+        """Adds a monitor message (i.e. port disconnected) to the merged stream and the port's log"""
+        mono_ns, wall_ns = time.monotonic_ns(), time.time_ns()
+        self._queue(port, mono_ns, wall_ns, f"--- {text} ---".encode(), note=True)
+        if port.writer is not None:
+            port.writer.write(port.stamper.flush() + LineStamper.format_stamp(mono_ns, wall_ns) +
+                              f"--- {text} ---\n".encode())
+
+    def _queue(self, port, mono_ns, wall_ns, line, note=False):
+        self._seq += 1
+        heapq.heappush(self._pending, (mono_ns, self._seq, wall_ns, port, line, note))
+
+    def _receive(self, port, data, mono_ns, wall_ns):
+        port.rx_bytes += len(data)
+        if port.writer is not None:
+            lines = port.stamper.feed(data, mono_ns, wall_ns)
+            if lines:
+                port.writer.write(lines)
+        pos = 0
+        while True:
+            end = data.find(b"\n", pos)
+            if end < 0:
+                break
+            if not port.partial:
+                port.partial_ns, port.partial_wall_ns = mono_ns, wall_ns
+            port.partial += data[pos:end]
+            self._queue(port, port.partial_ns, port.partial_wall_ns, bytes(port.partial))
+            port.partial.clear()
+            pos = end + 1
+        if pos < len(data):
+            if not port.partial:
+                port.partial_ns, port.partial_wall_ns = mono_ns, wall_ns
+            port.partial += data[pos:]
+
+    def _read(self, port):
+        try:
+            n = port.raw.readinto(self._buf)
+        except OSError:
+            n = 0
+        if n is None:
+            return
+        if n == 0:
+            port.disconnects += 1
+            self._close(port)
+            self._note(port, f"{port.path} disconnected")
+            return
+        self._receive(port, memoryview(self._buf)[:n].tobytes(), time.monotonic_ns(), time.time_ns())
+
+    def _format(self, mono_ns, wall_ns, port, line, note):
+        stamp = datetime.datetime.fromtimestamp(wall_ns / 1e9).strftime("%H:%M:%S.%f")[:-3]
+        text = line.decode(errors="replace").rstrip("\r")
+        tag = f"[{port.name:<{self.name_width}}]"
+        if not self.color:
+            return f"{stamp} {tag} {text}\n"
+        if note:
+            return f"{stamp} {port.color}{tag} {Style.BRIGHT}{text}{Style.RESET_ALL}\n"
+        return f"{stamp} {port.color}{tag}{Style.RESET_ALL} {text}\n"
+
+    def _emit(self, now_ns, flush_all=False):
+        """Prints the lines that no older line can come before anymore"""
+        for port in self.ports:
+            if port.partial and (flush_all or now_ns - port.partial_ns >= self.max_delay_ns):
+                # Unterminated for too long (i.e. a prompt). Print what there is
+                self._queue(port, port.partial_ns, port.partial_wall_ns, bytes(port.partial))
+                port.partial.clear()
+        watermark = min((port.partial_ns for port in self.ports if port.partial), default=None)
+        out = []
+        while self._pending and (watermark is None or self._pending[0][0] < watermark):
+            mono_ns, _, wall_ns, port, line, note = heapq.heappop(self._pending)
+            out.append(self._format(mono_ns, wall_ns, port, line, note))
+        if out:
+            self.out.write("".join(out))
+            self.out.flush()
+
+    def _on_hotplug(self, event):
+        if event.kind != "port" or event.action != "add":
+            return
+        for port in self.ports:
+            if port.serial is None and port.path == event.path:
+                try:
+                    self._open(port)
+                except serial.SerialException:
+                    # Not ready yet. _retry_closed() tries again
+                    continue
+                self._note(port, f"{port.path} reconnected")
+
+    def _retry_closed(self):
+        for port in self.ports:
+            if port.serial is None and os.path.exists(port.path):
+                try:
+                    self._open(port)
+                except serial.SerialException:
+                    continue
+                self._note(port, f"{port.path} reconnected")
+
+    def run(self):
+        from deputy.hotplug import HotplugWatcher
+        timeout = self.max_delay_ns / 4e9
+        try:
+            for port in self.ports:
+                self._open(port)
+                self._note(port, f"{port.path} opened at {self.baud} {self.config}")
+            self._watcher = HotplugWatcher()
+            self._watcher.add_callback(self._on_hotplug)
+            if self._watcher.fileno() is not None:
+                self._selector.register(self._watcher, selectors.EVENT_READ)
+            last_retry = time.monotonic()
+            while True:
+                for key, _ in self._selector.select(timeout):
+                    if key.fileobj is self._watcher:
+                        self._watcher.poll(0)
+                    else:
+                        self._read(key.fileobj)
+                now = time.monotonic()
+                if now - last_retry >= RETRY_INTERVAL_S:
+                    # In case a port's node appeared before it could be opened (i.e. udev
+                    # hadn't set its permissions yet), or there are no hotplug events
+                    self._retry_closed()
+                    last_retry = now
+                self._emit(time.monotonic_ns())
+        finally:
+            self._emit(time.monotonic_ns(), flush_all=True)
+            self.close()
+
+    def close(self):
+        for port in self.ports:
+            if port.serial is not None:
+                self._close(port)
+            if port.writer is not None:
+                if port.stamper.flush_pending():
+                    port.writer.write(port.stamper.flush())
+                port.writer.close()
+        if self._watcher is not None:
+            self._watcher.close()
+        self._selector.close()
+
+    def stats(self) -> dict:
+        return {port.name: {"rx": port.rx_bytes, "disconnects": port.disconnects} for port in self.ports}
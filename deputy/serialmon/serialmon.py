@@ -1,47 +1,131 @@
 import os
+import stat
 import serial
 import serial.tools.list_ports
 
 
-class SerialPort:
+def _proc_tty_users(paths) -> dict:
+    """find_tty_users() for Linux: a single pass over /proc/*/fd, matching device numbers"""
+    users = {path: [] for path in paths}
+    paths_by_rdev = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISCHR(st.st_mode):
+            paths_by_rdev.setdefault(st.st_rdev, []).append(path)
+    if not paths_by_rdev:
+        return users
 
-    def __init__(self, port_obj):
-        self.handle = port_obj
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        fd_dir = f"/proc/{pid}/fd"
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            # Process is gone, or belongs to another user
+            continue
+        found = set()
+        for fd in fds:
+            fd_path = f"{fd_dir}/{fd}"
+            try:
+                # Only device files are worth a stat()
+                if not os.readlink(fd_path).startswith("/dev/"):
+                    continue
+                rdev = os.stat(fd_path).st_rdev
+            except OSError:
+                continue
+            if rdev in paths_by_rdev:
+                found.add(rdev)
+        if not found:
+            continue
+        try:
+            with open(f"/proc/{pid}/comm") as f:
+                name = f.read().strip()
+        except OSError:
+            name = None
+        for rdev in found:
+            for path in paths_by_rdev[rdev]:
+                users[path].append((int(pid), name))
+    return users
 
 
-    def __repr__(self):
-        return f"Port: {self.handle[0]} - Desc: {self.handle[1]} - HWID: {self.handle[2]}"
+def _lsof_tty_users(paths) -> dict:
+    """find_tty_users() for other POSIX systems: a single lsof call for all ports"""
+    import subprocess
+    users = {path: [] for path in paths}
+    if not paths:
+        return users
+    result = subprocess.run(["lsof", "-F", "pcn", *paths], stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, text=True)
+    pid = name = None
+    for line in result.stdout.splitlines():
+        tag, value = line[:1], line[1:]
+        if tag == "p":
+            pid = int(value)
+        elif tag == "c":
+            name = value
+        elif tag == "n" and value in users and (pid, name) not in users[value]:
+            users[value].append((pid, name))
+    return users
 
 
-    @property
-    def path(self):
-        """Returns the serial port's port path/description (i.e. COMx, /dev/ttyx)"""
-        return self.handle[0]
+def find_tty_users(paths) -> dict:
+    """
+    Returns {path: [(pid, process name), ...]} of the processes that have each of the given
+    serial ports open. All ports are checked in one scan, so the cost doesn't grow with the
+    number of ports. POSIX only; processes of other users are only seen when running as root.
+    """
+    paths = list(paths)
+    if os.path.isdir("/proc/self/fd"):
+        return _proc_tty_users(paths)
+    return _lsof_tty_users(paths)
 
 
-    @property
-    def description(self):
-        """Returns the serial port's description string"""
-        return self.handle[1]
+class SerialPort:
+    """
+    A serial port as found by get_port_list(). All fields are parsed once, when the port is
+    enumerated.
+    """
 
+    __slots__ = ("handle", "path", "name", "description", "hwid", "serialnumber", "vid", "pid",
+                 "location", "usb_path")
 
-    @property
-    def hwid(self):
-        """Returns the serial port's HW ID string"""
-        return self.handle[2]
+    def __init__(self, port_obj):
+        self.handle = port_obj
+        self.path = port_obj[0]
+        self.name = os.path.basename(self.path)
+        self.description = port_obj[1]
+        self.hwid = port_obj[2]
+        self.serialnumber = getattr(port_obj, "serial_number", None) or self._parse_hwid("SER")
+        self.vid = getattr(port_obj, "vid", None)
+        self.pid = getattr(port_obj, "pid", None)
+        self.location = getattr(port_obj, "location", None) or self._parse_hwid("LOCATION")
+        # USB path of the device the port belongs to, i.e. '1-4.2' of location '1-4.2:1.0'
+        self.usb_path = self.location.split(":")[0] if self.location else None
 
 
-    @property
-    def serialnumber(self):
-        """Returns the serial port's serial number"""
-        if "SER=" in self.hwid:
-            items = self.hwid.split(" ")
-            for item in items:
-                if "SER=" in item:
-                    return item.split("=")[1].strip()
+    def __repr__(self):
+        return f"Port: {self.path} - Desc: {self.description} - HWID: {self.hwid}"
+
+
+    def _parse_hwid(self, key):
+        for item in self.hwid.split(" "):
+            if item.startswith(f"{key}="):
+                return item.split("=", 1)[1].strip() or None
         return None
 
 
+    @property
+    def vid_pid(self):
+        """Returns the '<vid>:<pid>' string of a USB serial port, or None"""
+        if self.vid is None or self.pid is None:
+            return None
+        return "%04x:%04x" % (self.vid, self.pid)
+
+
     def is_available(self) -> bool:
         """
         Returns True if the serial port is available (i.e. not already open)
@@ -50,9 +134,7 @@ class SerialPort:
             # Posix systems (i.e. Linux) don't inherently lock serial ports, meaning more than one
             # process could open it. To determine if the port is available (i.e. no process is using
             # it at the moment), we need to check if any processes have opened the port.
-            import subprocess
-            result = subprocess.run(["lsof", self.path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            return result.returncode != 0  # If return code is 0, something has it open
+            return len(find_tty_users([self.path])[self.path]) == 0
         else:
             # For all others (i.e. Windows) we simply try to open the port directly. Since the OS
             # locks the port resource when it's in use, opening a port that is already in use will
@@ -67,7 +149,7 @@ class SerialPort:
 
     def is_usb(self) -> bool:
         """Returns True if the serial port is a USB device (i.e connected via USB)"""
-        return True if "USB" in self.handle[2] else False
+        return True if "USB" in self.hwid else False
 
 
     @classmethod
@@ -90,16 +172,7 @@ class SerialPort:
         Using this functions allows the use of incomplete serial device identifier strings
         such as 'ttyACM0' instead of the full '/dev/ttyACM0'
         """
-        pl = cls.get_port_list()
-        port_paths = [p.path for p in pl]
-        path = [s for s in port_paths if port_str in s]
-        if len(path) == 0:
-            # No match found!
-            return None
-        if (len(path)> 1):
-            # Multiple matches found. Raise exception
-            raise Exception("Multiple matches found")
-        return path[0]
+        return PortRegistry().resolve(port_str)
 
 
     @classmethod
@@ -108,24 +181,113 @@ class SerialPort:
         Returns the port path of the specified  serial port in the list of available
         serial ports, where port_id specifies the port.
         """
-        pl = cls.get_port_list()
-        return pl[port_id].path
+        return PortRegistry()[port_id].path
 
 
     @classmethod
-    def get_port_path_from_serialnumber(cls, serialnumber: int):
+    def get_port_path_from_serialnumber(cls, serialnumber: str):
         """
         Returns the port path of the port with the specified serial number.
+        """
+        return PortRegistry().find_by_serialnumber(serialnumber).path
+
+
+class PortRegistry:
+    """
+    Snapshot of the serial ports from a single enumeration, indexed by path, name (i.e.
+    'ttyACM0'), serial number, VID:PID and USB path, so lookups don't enumerate the ports
+    again. Ports are in the order of SerialPort.get_port_list().
+    """
+
+    def __init__(self, ports: list = None):
+        self.ports = SerialPort.get_port_list() if ports is None else ports
+        self.by_path = {}
+        self.by_name = {}
+        self.by_serialnumber = {}
+        self.by_vid_pid = {}
+        self.by_usb_path = {}
+        for port in self.ports:
+            self._index(port)
+
+    def _index(self, port):
+        self.by_path[port.path] = port
+        self.by_name[port.name] = port
+        # Several ports can share these (i.e. the interfaces of a composite USB device)
+        if port.serialnumber is not None:
+            self.by_serialnumber.setdefault(port.serialnumber, []).append(port)
+        if port.vid_pid is not None:
+            self.by_vid_pid.setdefault(port.vid_pid, []).append(port)
+        if port.usb_path is not None:
+            self.by_usb_path.setdefault(port.usb_path, []).append(port)
+
+    @staticmethod
+    def _unindex(index, key, port):
+        ports = index.get(key)
+        if ports is not None and port in ports:
+            ports.remove(port)
+            if not ports:
+                del index[key]
+
+    def add(self, port: SerialPort):
+        """Adds a port that showed up after the snapshot was taken (replacing one at the same path)"""
+        self.remove(port.path)
+        self.ports.append(port)
+        self._index(port)
+
+    def remove(self, path: str):
+        """Removes a port that went away. Returns the removed SerialPort, or None"""
+        port = self.by_path.pop(path, None)
+        if port is None:
+            return None
+        self.ports.remove(port)
+        if self.by_name.get(port.name) is port:
+            del self.by_name[port.name]
+        self._unindex(self.by_serialnumber, port.serialnumber, port)
+        self._unindex(self.by_vid_pid, port.vid_pid, port)
+        self._unindex(self.by_usb_path, port.usb_path, port)
+        return port
 
+    def __len__(self):
+        return len(self.ports)
 
+    def __iter__(self):
+        return iter(self.ports)
+
+    def __getitem__(self, index: int) -> SerialPort:
+        return self.ports[index]
+
+    def resolve(self, port_str: str):
+        """
+        Returns the path of the port given by its full path, its name or a unique part of its
+        path (see SerialPort.validate_port_string()). Returns None if there's no such port.
+        """
+        port = self.by_path.get(port_str) or self.by_name.get(port_str)
+        if port is not None:
+            return port.path
+        matches = [p.path for p in self.ports if port_str in p.path]
+        if len(matches) == 0:
+            return None
+        if len(matches) > 1:
+            raise Exception("Multiple matches found")
+        return matches[0]
+
+    def find_by_serialnumber(self, serialnumber: str) -> SerialPort:
+        """
+        Returns the port with the given serial number, or the only one whose serial number
+        contains it. Ports without a serial number never match.
         """
-        pl = cls.get_port_list()
-        p_list = []
-        for p in pl:
-            if serialnumber in p.serialnumber:
-                p_list.append(p)
-        if len(p_list) > 1:
+        matches = self.by_serialnumber.get(serialnumber)
+        if matches is None:
+            matches = [p for s, ports in self.by_serialnumber.items() if serialnumber in s for p in ports]
+        if len(matches) > 1:
             raise Exception("Multiple matches found")
-        elif len(p_list) == 0:
+        elif len(matches) == 0:
             raise Exception("No matches found")
-        return p_list[0].path
+        return matches[0]
+
+    def find_by_vid_pid(self, vid_pid: str) -> list:
+        return self.by_vid_pid.get(vid_pid.lower(), [])
+
+    def find_by_usb_path(self, usb_path: str) -> list:
+        """Returns the ports of the USB device at usb_path (i.e. '1-4.2')"""
+        return self.by_usb_path.get(usb_path, [])
@@ -0,0 +1,422 @@
+"""
+Sharing one serial port between many clients.
+
+SerialShareServer owns the port and serves it on TCP and/or Unix stream sockets. Clients see
+a raw byte stream, so 'socat - UNIX-CONNECT:<path>' or 'nc <host> <port>' are enough to use it.
+
+Everything runs in one selectors loop, with non-blocking sockets:
+
+- Every read from the port is one bytes object that all clients queue a memoryview of, so
+  fanning out doesn't copy the data. Queued views are sent with a single sendmsg() per client,
+  and a partial send only moves the client's view forward.
+- A client that falls more than max_backlog bytes behind is disconnected, so one slow
+  consumer never holds up the port or the other clients.
+- Writes from clients are queued and written to the port as it accepts them. With the 'lock'
+  write policy, the client that wrote last owns the port until it's been quiet for
+  lock_timeout seconds and writes from the others are discarded, so two clients never
+  interleave their commands. 'all' lets every client write and 'none' makes the port read only.
+  When the port can't keep up, clients aren't read from until it catches up.
+
+If the port goes away (i.e. the board is power cycled), clients stay connected and the port
+is reopened once it's back.
+"""
+
+import collections
+import io
+import os
+import selectors
+import socket
+import time
+
+import serial
+
+from deputy.serialmon.console import parse_config
+
+WRITE_POLICIES = ("lock", "all", "none")
+RETRY_INTERVAL_S = 0.5
+# Most systems limit sendmsg() to 1024 buffers
+MAX_IOV = 512
+
+
+class _Client:
+    """A connected client and the chunks queued for it"""
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.queue = collections.deque()
+        self.queued = 0
+        self.sent = 0
+        self.received = 0
+        self.rejected = 0
+        self.connected = time.monotonic()
+        self.events = selectors.EVENT_READ
+        self.registered = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class SerialShareServer:
+    """
+    Serves the serial port on the given listen addresses: ('tcp', (host, port)) or
+    ('unix', path) tuples. run() serves until stop() is called or it's interrupted.
+    """
+
+    def __init__(self, port: str, baud: int = 115200, config: str = "8N1", listen: list = None,
+                 write_policy: str = "lock", lock_timeout: float = 1.0, max_backlog: int = 1 << 20,
+                 read_size: int = 64 * 1024, log=print):
+        if write_policy not in WRITE_POLICIES:
+            raise Exception(f"Invalid write policy '{write_policy}' (expected one of {', '.join(WRITE_POLICIES)})")
+        if not listen:
+            raise Exception("No address to listen on")
+        self.port = port
+        self.baud = baud
+        self.config = config
+        self.write_policy = write_policy
+        self.lock_timeout = lock_timeout
+        self.max_backlog = max_backlog
+        self.read_size = read_size
+        self.log = log
+        self.serial = None
+        self._raw = None
+        self.clients = []
+        self.listeners = []
+        self.writer = None
+        self._writer_until = 0
+        self._port_queue = collections.deque()
+        self._port_queued = 0
+        self._paused = False
+        self._stop_r, self._stop_w = os.pipe()
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._stop_r, selectors.EVENT_READ)
+        self._started = time.monotonic()
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.dropped_clients = 0
+        self.disconnects = 0
+        for kind, address in listen:
+            self._listen(kind, address)
+
+    def _listen(self, kind, address):
+        if kind == "unix":
+            if os.path.exists(address):
+                # Left behind by a server that didn't exit cleanly, unless one is still running
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    probe.connect(address)
+                except OSError:
+                    os.unlink(address)
+                else:
+                    probe.close()
+                    raise Exception(f"{address} is already being served")
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        elif kind == "tcp":
+            sock = socket.socket(socket.AF_INET6 if ":" in address[0] else socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            raise Exception(f"Unknown listen address type '{kind}'")
+        sock.bind(address)
+        sock.listen(16)
+        sock.setblocking(False)
+        self.listeners.append((kind, sock))
+        self._selector.register(sock, selectors.EVENT_READ, self._accept)
+
+    @property
+    def addresses(self) -> list:
+        """The addresses actually listened on (i.e. with the port picked for TCP port 0)"""
+        return [(kind, sock.getsockname()) for kind, sock in self.listeners]
+
+    def stop(self):
+        """Ends run(). Safe to call from another thread or a signal handler"""
+        os.write(self._stop_w, b"\0")
+
+    # Port
+
+    def _open_port(self):
+        self.serial = serial.Serial(self.port, self.baud, timeout=0, **parse_config(self.config))
+        self._raw = io.FileIO(self.serial.fileno(), "rb", closefd=False)
+        self._selector.register(self.serial.fileno(), self._port_events(), self._port_ready)
+
+    def _close_port(self):
+        self._selector.unregister(self.serial.fileno())
+        self.serial.close()
+        self.serial = None
+        self._port_queue.clear()
+        self._port_queued = 0
+        self._update_paused()
+
+    def _port_events(self):
+        return selectors.EVENT_READ | (selectors.EVENT_WRITE if self._port_queue else 0)
+
+    def _port_ready(self, fd, events):
+        if events & selectors.EVENT_READ:
+            try:
+                data = self._raw.read(self.read_size)
+            except OSError:
+                data = b""
+            if data is not None and not data:
+                self.disconnects += 1
+                self.log(f"{self.port} disconnected, waiting for it to come back")
+                self._close_port()
+                return
+            if data:
+                self.rx_bytes += len(data)
+                self._fan_out(data)
+        if events & selectors.EVENT_WRITE:
+            self._write_port()
+
+    def _write_port(self):
+        while self._port_queue:
+            view = self._port_queue[0]
+            try:
+                n = os.write(self.serial.fileno(), view)
+            except BlockingIOError:
+                break
+            except OSError:
+                # The port is gone. Reading it tells, and closes it
+                self._port_queue.clear()
+                self._port_queued = 0
+                break
+            self.tx_bytes += n
+            self._port_queued -= n
+            if n < len(view):
+                self._port_queue[0] = view[n:]
+                break
+            self._port_queue.popleft()
+        self._selector.modify(self.serial.fileno(), self._port_events(), self._port_ready)
+        self._update_paused()
+
+    def _retry_port(self):
+        if os.path.exists(self.port):
+            try:
+                self._open_port()
+            except serial.SerialException:
+                return
+            self.log(f"{self.port} reconnected")
+
+    # Clients
+
+    def _accept(self, sock, events):
+        try:
+            conn, address = sock.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        client = _Client(conn, address or "unix")
+        if self._paused:
+            client.events = 0
+        self.clients.append(client)
+        self._set_events(client)
+        self.log(f"Client {client.address} connected ({len(self.clients)} connected)")
+
+    def _drop(self, client, reason):
+        if self.writer is client:
+            self.writer = None
+        if client.registered:
+            self._selector.unregister(client)
+        client.sock.close()
+        self.clients.remove(client)
+        self.log(f"Client {client.address} {reason} ({len(self.clients)} connected)")
+
+    def _set_events(self, client):
+        events = client.events | (selectors.EVENT_WRITE if client.queue else 0)
+        # A selector can't hold a registration without events (a paused, idle client)
+        if events and client.registered:
+            self._selector.modify(client, events, self._client_ready)
+        elif events:
+            self._selector.register(client, events, self._client_ready)
+        elif client.registered:
+            self._selector.unregister(client)
+        client.registered = bool(events)
+
+    def _fan_out(self, data):
+        view = memoryview(data)
+        for client in list(self.clients):
+            if client.queued + len(data) > self.max_backlog:
+                self.dropped_clients += 1
+                self._drop(client, f"dropped ({client.queued} bytes behind)")
+                continue
+            was_idle = not client.queue
+            client.queue.append(view)
+            client.queued += len(data)
+            if was_idle:
+                # Most of the time the data goes out right away, without another select()
+                self._send(client)
+
+    def _send(self, client):
+        while client.queue:
+            views = list(client.queue) if len(client.queue) <= MAX_IOV else [client.queue[i] for i in range(MAX_IOV)]
+            try:
+                n = client.sock.sendmsg(views)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                self._drop(client, f"disconnected ({e})")
+                return
+            client.sent += n
+            client.queued -= n
+            while n:
+                head = client.queue[0]
+                if n >= len(head):
+                    n -= len(head)
+                    client.queue.popleft()
+                else:
+                    client.queue[0] = head[n:]
+                    n = 0
+            if client.queue and len(views) < MAX_IOV:
+                # The socket buffer is full
+                break
+        self._set_events(client)
+
+    def _client_ready(self, client, events):
+        if events & selectors.EVENT_READ:
+            try:
+                data = client.sock.recv(self.read_size)
+            except BlockingIOError:
+                data = None
+            except OSError:
+                data = b""
+            if data is not None and not data:
+                self._drop(client, "disconnected")
+                return
+            if data:
+                client.received += len(data)
+                self._client_write(client, data)
+        if events & selectors.EVENT_WRITE and client in self.clients:
+            self._send(client)
+
+    def _client_write(self, client, data):
+        now = time.monotonic()
+        if self.write_policy == "none" or self.serial is None:
+            client.rejected += len(data)
+            return
+        if self.write_policy == "lock":
+            if self.writer is not None and self.writer is not client and now < self._writer_until:
+                client.rejected += len(data)
+                return
+            if self.writer is not client:
+                self.writer = client
+                self.log(f"Client {client.address} is writing")
+            self._writer_until = now + self.lock_timeout
+        self._port_queue.append(memoryview(data))
+        self._port_queued += len(data)
+        self._write_port()
+
+    def _update_paused(self):
+        """Stops reading from clients while the port is behind with their writes, and resumes"""
+        paused = self._port_queued > self.max_backlog
+        if paused == self._paused:
+            return
+        self._paused = paused
+        for client in self.clients:
+            client.events = 0 if paused else selectors.EVENT_READ
+            self._set_events(client)
+
+    # Main loop
+
+    def run(self, stats_interval: float = None):
+        last_retry = last_stats = time.monotonic()
+        last_rx = 0
+        try:
+            self._open_port()
+            while True:
+                for key, events in self._selector.select(RETRY_INTERVAL_S):
+                    if key.fileobj == self._stop_r:
+                        return
+                    key.data(key.fileobj, events)
+                now = time.monotonic()
+                if self.serial is None and now - last_retry >= RETRY_INTERVAL_S:
+                    self._retry_port()
+                    last_retry = now
+                if stats_interval and now - last_stats >= stats_interval:
+                    rate = (self.rx_bytes - last_rx) / (now - last_stats)
+                    self.log(self.format_stats(rate))
+                    last_stats, last_rx = now, self.rx_bytes
+        finally:
+            self.close()
+
+    def stats(self) -> dict:
+        uptime = time.monotonic() - self._started
+        return {
+            "rx": self.rx_bytes,
+            "tx": self.tx_bytes,
+            "rx_rate": self.rx_bytes / uptime if uptime else 0,
+            "clients": len(self.clients),
+            "dropped_clients": self.dropped_clients,
+            "disconnects": self.disconnects,
+            "port_queued": self._port_queued,
+            "per_client": {str(c.address): {"sent": c.sent, "queued": c.queued, "received": c.received,
+                                            "rejected": c.rejected} for c in self.clients},
+        }
+
+    def format_stats(self, rx_rate: float = None) -> str:
+        stats = self.stats()
+        rate = stats["rx_rate"] if rx_rate is None else rx_rate
+        behind = max((c.queued for c in self.clients), default=0)
+        return (f"rx {stats['rx']} B ({rate / 1024:.1f} KiB/s), tx {stats['tx']} B, "
+                f"{stats['clients']} client(s), max {behind} B behind, "
+                f"{stats['dropped_clients']} dropped")
+
+    def close(self):
+        for client in list(self.clients):
+            self._drop(client, "closed")
+        for kind, sock in self.listeners:
+            address = sock.getsockname()
+            self._selector.unregister(sock)
+            sock.close()
+            if kind == "unix":
+                try:
+                    os.unlink(address)
+                except OSError:
+                    pass
+        self.listeners = []
+        if self.serial is not None:
+            self._close_port()
+        self._selector.close()
+        os.close(self._stop_r)
+        os.close(self._stop_w)
+
+
+def parse_listen(text: str):
+    """
+    Parses a listen address: 'unix:<path>', a path (containing '/'), '[host:]port' or
+    'tcp:[host:]port'. Returns a ('unix', path) or ('tcp', (host, port)) tuple.
+    """
+    if text.startswith("unix:"):
+        return "unix", text[5:]
+    if "/" in text:
+        return "unix", text
+    if text.startswith("tcp:"):
+        text = text[4:]
+    host, _, port = text.rpartition(":")
+    if not port.isdecimal():
+        raise Exception(f"Invalid listen address '{text}'")
+    return "tcp", (host.strip("[]") or "127.0.0.1", int(port))
+
+
+def default_listen_path(port: str) -> str:
+    """deputy-<port name>.sock in $XDG_RUNTIME_DIR (or the temp directory)"""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        import tempfile
+        runtime_dir = tempfile.gettempdir()
+    return os.path.join(runtime_dir, f"deputy-{os.path.basename(port)}.sock")
+
+
+def run_server(port: str, baud: int, config: str, listen: list, write_policy: str = "lock",
+               stats_interval: float = None):
+    """Serves port until Ctrl-C or SIGTERM"""
+    import signal
+    server = SerialShareServer(port, baud, config, [parse_listen(a) for a in listen] if listen else
+                               [("unix", default_listen_path(port))], write_policy)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    for kind, address in server.addresses:
+        print(f"Serving {port} on {kind}:{address if kind == 'unix' else '%s:%d' % address[:2]}")
+    print("Press Ctrl-C to stop.")
+    try:
+        server.run(stats_interval)
+    except KeyboardInterrupt:
+        pass
+    print(server.format_stats())
+    return 0
@@ -1,6 +1,5 @@
 import os
 import subprocess
-import sys
 import shutil
 
 class Term:
@@ -103,23 +102,32 @@ class Term:
             if path:
                 installed_terminal_programs[term] = path
         # Add the builtin terminal
-        installed_terminal_programs["builtin"] = "PySerial builtin"
+        installed_terminal_programs["builtin"] = "deputy builtin"
         return installed_terminal_programs
 
 
     def start(self):
         if self.term == "builtin":
-            term_str = [sys.executable, "-m", "serial.tools.miniterm", f"{self.port}", f"{self.baud}"]
-            wait_on_process = True
-        else:
-            term_str = [arg.format(path=self.term_path, baud=self.baud, port=self.port, config=self.config) for arg in self.terminal_programs[self.term]]
-            wait_on_process = False
+            return self._start_builtin()
 
+        term_str = [arg.format(path=self.term_path, baud=self.baud, port=self.port, config=self.config) for arg in self.terminal_programs[self.term]]
         try:
-            proc = subprocess.Popen(term_str)
-            if wait_on_process:
-                proc.wait()
+            subprocess.Popen(term_str)
         except FileNotFoundError:
             print(f"Error opening port {self.port}")
             return -1
         return 0
+
+
+    def _start_builtin(self):
+        from serial import SerialException
+        from deputy.serialmon.console import SerialConsole, run_miniterm
+        try:
+            if os.name == "posix":
+                SerialConsole(self.port, self.baud, self.config).run()
+            else:
+                run_miniterm(self.port, self.baud, self.config)
+        except SerialException as e:
+            print(f"Error opening port {self.port}: {e}")
+            return -1
+        return 0
@@ -0,0 +1,221 @@
+"""
+Index of the udev rules that grant access to USB devices.
+
+Every rules file is parsed once into UdevRules: the VID:PID it matches, in any of the ways a
+rule can say so (idVendor, ATTR{idVendor}, ATTRS{idVendor}, ENV{ID_VENDOR_ID}, in any
+order), and what it grants (MODE, GROUP, OWNER, TAG+="uaccess"). The parsed rules are
+cached per file and a file is only parsed again when its mtime or size changes (not just its
+directory's, which an in-place edit leaves alone), so a lookup on a host with hundreds of
+rule files costs a directory listing and a stat() per file.
+
+Like udev itself, a file in /etc/udev/rules.d hides one with the same name in /run or /lib,
+and the rules apply in file name order across all directories.
+"""
+
+import fnmatch
+import json
+import os
+import re
+
+CACHE_VERSION = 1
+
+# In order of precedence
+UDEV_RULES_DIRS = ["/etc/udev/rules.d", "/run/udev/rules.d", "/lib/udev/rules.d", "/usr/lib/udev/rules.d"]
+
+# key, optional {attribute}, operator, "value"
+_RULE_FIELD = re.compile(r'([A-Za-z_]+)(?:\{([^}]*)\})?\s*(==|!=|\+=|-=|:=|=)\s*"((?:[^"\\]|\\.)*)"')
+
+_VID_KEYS = {("ATTR", "idVendor"), ("ATTRS", "idVendor"), ("SYSFS", "idVendor"), ("ENV", "ID_VENDOR_ID"),
+             ("idVendor", None)}
+_PID_KEYS = {("ATTR", "idProduct"), ("ATTRS", "idProduct"), ("SYSFS", "idProduct"), ("ENV", "ID_MODEL_ID"),
+             ("idProduct", None)}
+
+
+def default_cache_path() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "deputy", "udev-rules.json")
+
+
+class UdevRule:
+    """A rule line that matches a USB VID (and usually a PID), and what it grants"""
+
+    __slots__ = ("file", "line", "vid", "pid", "subsystem", "mode", "group", "owner", "uaccess")
+
+    def __init__(self, file, line, vid, pid=None, subsystem=None, mode=None, group=None, owner=None,
+                 uaccess=False):
+        self.file = file
+        self.line = line
+        self.vid = vid
+        self.pid = pid
+        self.subsystem = subsystem
+        self.mode = mode
+        self.group = group
+        self.owner = owner
+        self.uaccess = uaccess
+
+    def __repr__(self):
+        return f"UdevRule({self.location}, {self.vid}:{self.pid or '*'}, {self.grants})"
+
+    @property
+    def location(self) -> str:
+        return f"{self.file}:{self.line}"
+
+    @property
+    def grants(self) -> str:
+        """What the rule sets, i.e. 'MODE=0666 GROUP=plugdev'"""
+        parts = [f"{key}={value}" for key, value in (("MODE", self.mode), ("GROUP", self.group),
+                                                     ("OWNER", self.owner)) if value is not None]
+        if self.uaccess:
+            parts.append('TAG+=uaccess')
+        return " ".join(parts) or "nothing"
+
+    def matches(self, vid: str, pid: str) -> bool:
+        # Rule values are glob patterns (i.e. "db6[0-9]")
+        return fnmatch.fnmatchcase(vid, self.vid) and (self.pid is None or fnmatch.fnmatchcase(pid, self.pid))
+
+    def to_list(self) -> list:
+        return [getattr(self, name) for name in self.__slots__]
+
+
+def _logical_lines(text):
+    """Yields (line number, line) with comments and blank lines removed and '\\' continuations joined"""
+    pending = ""
+    start = 0
+    for number, line in enumerate(text.splitlines(), 1):
+        stripped = line.strip()
+        if not pending and (not stripped or stripped.startswith("#")):
+            continue
+        if not pending:
+            start = number
+        if stripped.endswith("\\"):
+            pending += stripped[:-1] + " "
+            continue
+        yield start, pending + stripped
+        pending = ""
+    if pending:
+        yield start, pending
+
+
+def parse_rules(path, text: str) -> list:
+    """Returns the UdevRules in the text of the rules file at path"""
+    rules = []
+    for number, line in _logical_lines(text):
+        vid = pid = subsystem = mode = group = owner = None
+        uaccess = False
+        for key, attr, op, value in _RULE_FIELD.findall(line):
+            key_attr = (key, attr or None)
+            if op == "==":
+                if key_attr in _VID_KEYS:
+                    vid = value.lower()
+                elif key_attr in _PID_KEYS:
+                    pid = value.lower()
+                elif key == "SUBSYSTEM":
+                    subsystem = value
+            elif op in ("=", ":="):
+                if key == "MODE":
+                    mode = value
+                elif key == "GROUP":
+                    group = value
+                elif key == "OWNER":
+                    owner = value
+            elif op == "+=" and key == "TAG" and value == "uaccess":
+                uaccess = True
+        if vid is not None:
+            rules.append(UdevRule(path, number, vid, pid, subsystem, mode, group, owner, uaccess))
+    return rules
+
+
+class UdevRulesIndex:
+    """
+    The USB rules of all udev rules files, by VID:PID. Loads from the cache (see
+    default_cache_path()) and only parses the files that changed since.
+    """
+
+    def __init__(self, dirs: list = None, cache_path: str = None):
+        self.dirs = dirs or UDEV_RULES_DIRS
+        self.cache_path = cache_path if cache_path is not None else default_cache_path()
+        self.rules = []
+        self.files = []
+        self.parsed_files = 0
+        # Exact VID:PID -> rules, and the rules with glob patterns (or without a PID)
+        self._by_vid_pid = {}
+        self._patterns = []
+        self._load()
+
+    def _rule_files(self) -> dict:
+        """Returns {name: (path, mtime_ns, size)} of the files udev would use"""
+        files = {}
+        for directory in self.dirs:
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.name.endswith(".rules") or entry.name in files:
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files[entry.name] = (entry.path, st.st_mtime_ns, st.st_size)
+        return files
+
+    def _read_cache(self) -> dict:
+        try:
+            with open(self.cache_path) as f:
+                data = json.load(f)
+            if data.get("version") == CACHE_VERSION:
+                return data.get("files", {})
+        except (OSError, ValueError, AttributeError):
+            pass
+        return {}
+
+    def _write_cache(self, files: dict):
+        """Writes the cache atomically. Failing to write it (i.e. read-only home) is not an error"""
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump({"version": CACHE_VERSION, "files": files}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def _load(self):
+        cached = self._read_cache() if self.cache_path else {}
+        current = {}
+        for _, (path, mtime_ns, size) in sorted(self._rule_files().items()):
+            entry = cached.get(path)
+            if entry is None or entry["mtime_ns"] != mtime_ns or entry["size"] != size:
+                try:
+                    with open(path, errors="replace") as f:
+                        rules = parse_rules(path, f.read())
+                except OSError:
+                    continue
+                self.parsed_files += 1
+                entry = {"mtime_ns": mtime_ns, "size": size, "rules": [r.to_list() for r in rules]}
+            current[path] = entry
+            self.files.append(path)
+            for fields in entry["rules"]:
+                self._add(UdevRule(*fields))
+        if self.cache_path and (self.parsed_files or current.keys() != cached.keys()):
+            self._write_cache(current)
+
+    def _add(self, rule: UdevRule):
+        self.rules.append(rule)
+        if rule.pid is not None and not any(c in rule.vid + rule.pid for c in "*?["):
+            self._by_vid_pid.setdefault(f"{rule.vid}:{rule.pid}", []).append(rule)
+        else:
+            self._patterns.append(rule)
+
+    def find(self, vid_pid: str) -> list:
+        """Returns the rules that match '<vid>:<pid>', in the order udev applies them"""
+        vid, pid = vid_pid.lower().split(":")
+        rules = self._by_vid_pid.get(f"{vid}:{pid}", []) + [r for r in self._patterns if r.matches(vid, pid)]
+        if len(rules) > 1:
+            order = {path: i for i, path in enumerate(self.files)}
+            rules.sort(key=lambda r: (order[r.file], r.line))
+        return rules
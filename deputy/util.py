@@ -1,34 +1,23 @@
-import os
-import re
+import argparse
 
-# Function to search for udev rules with given VID:PID
-def find_udev_rule(vid, pid):
-    # Directories where udev rules are typically stored
-    udev_dirs = ['/etc/udev/rules.d/', '/lib/udev/rules.d/']
 
-    # Regular expression to match the VID:PID
-    vid_pid_pattern = re.compile(rf'\b(idVendor|ATTR{{idVendor}})=="{vid}"\s*(idProduct|ATTR{{idProduct}})=="{pid}"')
+class VersionAction(argparse.Action):
+    """argparse --version action that resolves the package version only when it's requested"""
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS, help=None):
+        super().__init__(option_strings=option_strings, dest=dest, default=default, nargs=0, help=help)
 
-    # Search for the rule in the udev rule directories
-    for udev_dir in udev_dirs:
-        if not os.path.isdir(udev_dir):
-            continue
+    def __call__(self, parser, namespace, values, option_string=None):
+        from deputy import __version__
+        parser.exit(message=f"{__version__}\n")
 
-        for rule_file in os.listdir(udev_dir):
-            rule_file_path = os.path.join(udev_dir, rule_file)
-            
-            # Only check .rules files
-            if rule_file.endswith('.rules'):
-                try:
-                    with open(rule_file_path, 'r') as f:
-                        content = f.read()
-                        # Check if the VID:PID exists in the file
-                        if re.search(vid_pid_pattern, content):
-                            print(f'Found rule in: {rule_file_path}')
-                            return True
-                except Exception as e:
-                    #print(f"Error reading {rule_file_path}: {e}")
-                    pass
-    
-    print('No matching udev rule found.')
-    return False
+
+def find_udev_rule(vid, pid):
+    """Prints and returns whether a udev rule matches the USB device VID:PID (see deputy.udev)"""
+    from deputy.udev import UdevRulesIndex
+    rules = UdevRulesIndex().find(f"{vid}:{pid}")
+    for rule in rules:
+        print(f"Found rule in: {rule.location} ({rule.grants})")
+    if not rules:
+        print('No matching udev rule found.')
+    return len(rules) > 0
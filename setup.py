@@ -46,7 +46,7 @@ setup(
         ]
     },
     python_requires=">=3.8",
-    install_requires=["recom>=0.1.1", "tk", "matplotlib"],
+    install_requires=["recom>=0.1.1", "tk", "matplotlib", "numpy"],
     entry_points={
         "console_scripts": [
             "deputy=deputy.__main__:main",
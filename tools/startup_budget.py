@@ -0,0 +1,73 @@
+"""
+Import-time budget check for the deputy CLIs.
+
+Imports each CLI module in a fresh interpreter with 'python -X importtime' and compares the
+cumulative import time (best of --runs) against its budget. It also fails if a CLI module
+pulls in a heavy module that only some commands need (i.e. matplotlib for 'magnum info').
+
+Run it with 'make startup-budget', or directly: python tools/startup_budget.py [--runs N]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+# Module: import time budget in ms
+BUDGETS = {
+    "deputy.magnum.cli": 60,
+    "deputy.serialmon.cli": 80,
+    "deputy.__main__": 70,
+}
+
+# Modules that must not be imported by just loading a CLI
+FORBIDDEN = ["numpy", "matplotlib", "tkinter", "recom", "pkg_resources", "deputy.powermon.plot"]
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module: str) -> dict:
+    """Returns {module: cumulative import time in us} for importing module in a new interpreter"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_DIR, env.get("PYTHONPATH")]))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"Importing {module} failed:\n{result.stderr}")
+    times = {}
+    for line in result.stderr.splitlines():
+        # 'import time:   self [us] |  cumulative | imported package'
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of the deputy CLIs.")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per module, the best counts (default: 5)")
+    parser.add_argument("--top", type=int, default=5, help="Slowest imports to list per module (default: 5)")
+    args = parser.parse_args()
+
+    failed = False
+    for module, budget_ms in BUDGETS.items():
+        runs = [import_times(module) for _ in range(args.runs)]
+        best = min(runs, key=lambda times: times[module])
+        total_ms = best[module] / 1000
+        status = "OK" if total_ms <= budget_ms else "OVER BUDGET"
+        print(f"{module}: {total_ms:.1f}ms (budget {budget_ms}ms) {status}")
+        failed |= total_ms > budget_ms
+
+        forbidden = [name for name in FORBIDDEN if name in best]
+        if forbidden:
+            print(f"  imports {', '.join(forbidden)}")
+            failed = True
+        slowest = sorted((t, name) for name, t in best.items() if name != module)[-args.top:]
+        for t, name in reversed(slowest):
+            print(f"  {t / 1000:7.1f}ms  {name}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())